@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+    The web applications: relay server and aggregating proxy.
+
+    Kept apart from main, so the server sets its relays before
+    importing aiohttp.
+"""
+
+import asyncio
+import logging
+import signal
+import time
+
+from aiohttp import web
+
+from . import routes
+from .config import read_config
+from .history import ORIGIN
+from .main import validate_relays, validate_groups, validate_inputs
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# I'm tired of my terminal getting messed up when testing using 'curl -v -X GET ...'
+@web.middleware
+async def terminate_exception_body_by_newline(request, handler):
+    try:
+        response = await handler(request)
+        return response
+    except web.HTTPException as ex:
+        text = ex.text
+        if isinstance(text, str):
+            if not text.endswith("\n"):
+                ex.text = text + "\n"
+        raise ex
+
+@web.middleware
+async def track_origin(request, handler):
+    """
+        Middleware noting the client and route of a request, recorded
+        with the relay state changes it makes.
+    """
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else ""
+    ORIGIN.set((request.remote or "", "%s %s" % (request.method, route)))
+    return await handler(request)
+
+def collect_metrics(metrics):
+    """
+        Middleware counting requests, in flight requests and handling
+        time per route.
+    """
+    in_flight = metrics.http_in_flight.labels()
+
+    @web.middleware
+    async def middleware(request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else ""
+        status = 500
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as ex:
+            status = ex.status
+            raise
+        finally:
+            in_flight.dec()
+            metrics.http_latency.labels(route, request.method).observe(time.perf_counter() - start)
+            metrics.http_requests.labels(route, request.method, status).inc()
+    return middleware
+
+class ConfigReloader:
+    """
+        Reload the relay configuration of a running server, on SIGHUP
+        or through the admin API. Only the relays and groups are
+        reloaded, other settings need a restart.
+    """
+    def __init__(self, config_file, config, manager):
+        self.config_file = config_file
+        self.config = config
+        self.manager = manager
+        # Set by setup_routes
+        self.controller = None
+        self.lock = None
+
+    async def startup(self, app):
+        self.lock = asyncio.Lock()
+        asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.on_sighup)
+
+    def on_sighup(self):
+        async def reload():
+            try:
+                report = await self.reload()
+                logger.info("Reloaded %s: %s", self.config_file, report)
+            except (ValueError, LookupError, OSError) as ex:
+                logger.error("Reloading %s failed: %s", self.config_file, ex)
+        asyncio.ensure_future(reload())
+
+    async def reload(self):
+        """
+            Reread the configuration file and update the relays. Returns
+            the ids of the added, changed and removed relays.
+        """
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            # Raises ConfigError, a ValueError
+            config = await loop.run_in_executor(None, read_config, self.config_file)
+            relays = config['relays']
+            groups = config['groups']
+            for valid, error in (validate_relays(relays), validate_groups(groups, relays),
+                                 validate_inputs(self.config['inputs'], relays)):
+                if not valid:
+                    raise ValueError(error)
+            for key in config:
+                if key not in ('relays', 'groups') and config[key] != self.config[key]:
+                    logger.warning("Changes to '%s' in %s need a restart", key, self.config_file)
+
+            # The lines are resolved and requested off the event loop,
+            # held requests are reconfigured through the controller
+            def reconfigure(request, changes):
+                asyncio.run_coroutine_threadsafe(
+                    self.controller.reconfigure_lines(request, changes, self.manager.reconfigure),
+                    loop).result()
+
+            old = self.manager.relays
+            lines, added = await loop.run_in_executor(None, self.manager.update, relays, None,
+                                                      reconfigure)
+            defaults = [(lines[ident], relays[ident]['default']) for ident in added]
+            try:
+                await self.controller.update_lines(lines, defaults, groups)
+            finally:
+                self.manager.release_unused()
+            self.config = dict(self.config, relays=relays, groups=groups)
+
+            return {
+                'added': [ident for ident in added if ident not in old],
+                'changed': [ident for ident in added if ident in old],
+                'removed': [ident for ident in old if ident not in relays],
+            }
+
+def make_app(config, lines, reloader=None, journal=None, switch_on=(), inputs=None):
+    """
+        Setup the application serving the given relay lines, and input
+        lines. The relays in switch_on are switched on through the
+        inrush scheduler once the application has started.
+    """
+    metrics = Metrics()
+    app = web.Application(middlewares=[collect_metrics(metrics),
+                                       terminate_exception_body_by_newline,
+                                       track_origin])
+    controller = routes.setup_routes(app, lines, metrics=metrics, reloader=reloader, journal=journal,
+                                     cache=config['cache']['enabled'],
+                                     reconcile=config['cache']['reconcile'],
+                                     executor=config['gpio']['executor'],
+                                     workers=config['gpio']['workers'],
+                                     inrush_spacing=config['inrush']['spacing'],
+                                     inrush_max=config['inrush']['max_simultaneous'],
+                                     switch_on=switch_on,
+                                     groups=config['groups'],
+                                     inputs=inputs,
+                                     lease_max_ttl=config['leases']['max_ttl'],
+                                     history_size=config['history']['size'])
+    if 'port' in config['control']:
+        from .control import ControlServer, CONTROL_SERVER
+
+        server = ControlServer(controller, config['control'].get('host', config['host']),
+                               config['control']['port'])
+        app[CONTROL_SERVER] = server
+        app.on_startup.append(server.startup)
+        app.on_shutdown.append(server.shutdown)
+    return app
+
+def make_proxy_app(config):
+    """
+        Setup the aggregating proxy application for the configured
+        upstreams.
+    """
+    from .proxy import Upstream
+
+    upstreams = [Upstream(name, cfg['url'], cfg['timeout'], cfg['prefix'])
+                 for name, cfg in config['upstreams'].items()]
+    metrics = Metrics()
+    app = web.Application(middlewares=[collect_metrics(metrics),
+                                       terminate_exception_body_by_newline])
+    routes.setup_proxy_routes(app, upstreams, metrics=metrics, events=config['events'],
+                              connections=config['connections'])
+    return app
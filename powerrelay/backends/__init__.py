@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Library package for GPIO backends.
+
+    A backend enumerates the named GPIO lines (line_names) and requests
+    lines on a chip (request_lines). Line requests provide the subset
+    of the libgpiod LineRequest API used by powerrelay: chip_name,
+    offsets, get_values(), set_values() and release().
+"""
+from .libgpiod import *
+from .simulator import *
+
+BACKENDS = {
+    'libgpiod': LibgpiodBackend,
+    'simulator': SimulatorBackend,
+}
+
+def get_backend(name, **options):
+    """
+        Instantiate the backend with the given name.
+    """
+    return BACKENDS[name](**options)
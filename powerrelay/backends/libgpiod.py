@@ -0,0 +1,37 @@
+import os
+
+import gpiod
+
+class LibgpiodBackend:
+    """
+        GPIO access through the libgpiod 2 character device API.
+    """
+    def __init__(self, devdir="/dev/"):
+        self.devdir = devdir
+
+    def line_names(self):
+        """
+            Yield (chip name, offset, line name) for every named line on
+            every gpiochip device.
+        """
+        seen = set()
+        for entry in sorted(os.scandir(self.devdir), key=lambda e: e.name):
+            if not gpiod.is_gpiochip_device(entry.path):
+                continue
+            with gpiod.Chip(entry.path) as chip:
+                info = chip.get_info()
+                # Skip aliases (e.g. symlinks) of chips already scanned
+                if info.name in seen:
+                    continue
+                seen.add(info.name)
+                for offset in range(info.num_lines):
+                    name = chip.get_line_info(offset).name
+                    if name:
+                        yield info.name, offset, name
+
+    def request_lines(self, chip, config, consumer):
+        """
+            Request lines on a chip. config maps offsets to
+            gpiod.LineSettings.
+        """
+        return gpiod.request_lines(os.path.join(self.devdir, chip), consumer=consumer, config=config)
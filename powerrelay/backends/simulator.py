@@ -0,0 +1,216 @@
+import errno
+import os
+import time
+from collections import deque
+
+from gpiod import EdgeEvent, LineSettings
+from gpiod.line import Direction, Edge, Value
+
+class SimulatedChip:
+    """
+        A simulated gpiochip. Line levels are kept as physical levels,
+        so active low lines behave as on real hardware. 'loopback' maps
+        output offsets to the input offsets they drive, e.g. to simulate
+        relay feedback contacts.
+    """
+    def __init__(self, name, num_lines=64, names=None, loopback=None):
+        self.name = name
+        self.num_lines = num_lines
+        self.names = dict(names or {})
+        self.loopback = dict(loopback or {})
+        self.levels = [0] * num_lines
+        self.requested = dict()
+        # offset -> request watching it for edges
+        self.watchers = dict()
+        self.seqno = 0
+
+    def drive(self, offset, level):
+        """
+            Set the physical level of a line from the outside, e.g. an
+            input, generating an edge event if it is watched.
+        """
+        if self.levels[offset] == level:
+            return
+        self.levels[offset] = level
+        watcher = self.watchers.get(offset)
+        if watcher is not None:
+            self.seqno += 1
+            watcher.edge(offset, self.seqno)
+
+class SimulatedLineRequest:
+    """
+        A request for lines on a simulated chip, sleeping for the
+        configured latency on every access like a slow GPIO expander.
+    """
+    def __init__(self, backend, chip, config, consumer):
+        self.backend = backend
+        self.chip = chip
+        self.consumer = consumer
+        self.settings = dict(config)
+        self.released = False
+        for offset, settings in self.settings.items():
+            if settings is not None and settings.direction == Direction.OUTPUT:
+                self.set_level(offset, settings.output_value)
+
+        # Edge events are queued, and signalled through a pipe for the
+        # request's fd to become readable like a real one
+        self.events = deque()
+        self.pipe = None
+        for offset, settings in self.settings.items():
+            if settings is not None and settings.edge_detection != Edge.NONE:
+                if self.pipe is None:
+                    self.pipe = os.pipe()
+                    os.set_blocking(self.pipe[0], False)
+                chip.watchers[offset] = self
+
+    @property
+    def fd(self):
+        if self.pipe is None:
+            raise OSError(errno.EINVAL, "No edge detection requested")
+        return self.pipe[0]
+
+    def fileno(self):
+        return self.fd
+
+    def edge(self, offset, seqno):
+        value = self.chip.levels[offset] ^ self.active_low(offset)
+        detect = self.settings[offset].edge_detection
+        if detect == Edge.BOTH or detect == (Edge.RISING if value else Edge.FALLING):
+            kind = EdgeEvent.Type.RISING_EDGE if value else EdgeEvent.Type.FALLING_EDGE
+            self.events.append(EdgeEvent(kind.value, time.monotonic_ns(), offset, seqno, seqno))
+            os.write(self.pipe[1], b"\0")
+
+    def read_edge_events(self, max_events=None):
+        self.check([])
+        try:
+            os.read(self.pipe[0], 4096)
+        except BlockingIOError:
+            pass
+        count = len(self.events) if max_events is None else min(max_events, len(self.events))
+        return [self.events.popleft() for _ in range(count)]
+
+    @property
+    def chip_name(self):
+        return self.chip.name
+
+    @property
+    def offsets(self):
+        return list(self.settings)
+
+    def active_low(self, offset):
+        settings = self.settings[offset]
+        return settings is not None and settings.active_low
+
+    def set_level(self, offset, value):
+        level = int(value == Value.ACTIVE) ^ self.active_low(offset)
+        self.chip.levels[offset] = level
+        if offset in self.chip.loopback:
+            self.chip.drive(self.chip.loopback[offset], level)
+
+    def check(self, offsets):
+        if self.released:
+            raise OSError(errno.EBADF, "Line request released")
+        for offset in offsets:
+            if offset not in self.settings:
+                raise OSError(errno.EINVAL, "Line %d not requested" % offset)
+
+    def get_values(self, offsets=None):
+        offsets = list(offsets or self.settings)
+        self.check(offsets)
+        self.backend.delay('read')
+        return [Value(self.chip.levels[offset] ^ self.active_low(offset)) for offset in offsets]
+
+    def get_value(self, offset):
+        return self.get_values([offset])[0]
+
+    def set_values(self, values):
+        self.check(values)
+        self.backend.delay('write')
+        for offset, value in values.items():
+            self.set_level(offset, value)
+
+    def set_value(self, offset, value):
+        self.set_values({offset: value})
+
+    def reconfigure_lines(self, config):
+        """
+            Like libgpiod, lines missing from config get default settings.
+        """
+        self.check([])
+        self.backend.delay('write')
+        for offset in self.settings:
+            settings = config.get(offset) or LineSettings()
+            self.settings[offset] = settings
+            if settings.direction == Direction.OUTPUT:
+                self.set_level(offset, settings.output_value)
+
+    def release(self):
+        if not self.released:
+            for offset in self.settings:
+                del self.chip.requested[offset]
+                if self.chip.watchers.get(offset) is self:
+                    del self.chip.watchers[offset]
+            if self.pipe is not None:
+                for fd in self.pipe:
+                    os.close(fd)
+            self.released = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class SimulatorBackend:
+    """
+        In-process GPIO simulator, for testing and benchmarking without
+        hardware.
+
+        'chips' maps chip names to {'lines': count, 'names': {offset:
+        name}, 'loopback': {output offset: input offset}}. Without it,
+        chips of 64 unnamed lines are created as they are requested.
+        'latency' maps 'read' and 'write' to the time in seconds each
+        access takes.
+    """
+    def __init__(self, chips=None, latency=None):
+        self.autocreate = chips is None
+        self.chips = dict()
+        for name, cfg in (chips or {}).items():
+            self.chips[name] = SimulatedChip(name, cfg.get('lines', 64), cfg.get('names'),
+                                             cfg.get('loopback'))
+        self.latency = dict(latency or {})
+
+    def delay(self, op):
+        latency = self.latency.get(op, 0)
+        if latency > 0:
+            time.sleep(latency)
+
+    def get_chip(self, name):
+        chip = self.chips.get(name)
+        if chip is None:
+            if not self.autocreate:
+                raise OSError(errno.ENOENT, "No such simulated gpiochip: '%s'" % name)
+            chip = self.chips[name] = SimulatedChip(name)
+        return chip
+
+    def drive(self, chip, offset, level):
+        """
+            Drive a line of a chip to the given physical level.
+        """
+        self.get_chip(chip).drive(offset, level)
+
+    def line_names(self):
+        for chip in self.chips.values():
+            for offset, name in sorted(chip.names.items()):
+                yield chip.name, offset, name
+
+    def request_lines(self, chip, config, consumer):
+        chip = self.get_chip(chip)
+        for offset in config:
+            if not 0 <= offset < chip.num_lines:
+                raise OSError(errno.EINVAL, "%s has no line %d" % (chip.name, offset))
+            if offset in chip.requested:
+                raise OSError(errno.EBUSY, "%s line %d is busy" % (chip.name, offset))
+        for offset in config:
+            chip.requested[offset] = consumer
+        return SimulatedLineRequest(self, chip, config, consumer)
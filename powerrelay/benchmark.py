@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+"""
+    HTTP load test and latency benchmark of the relay API, and of the
+    control protocol. HTTP is measured over keep-alive connections
+    ('http'), a new connection per request ('naive'), and through
+    powerrelay.client ('client').
+
+    The server under test is either a running powerrelay given by URL
+    (and control protocol address), or one started in a child process
+    on top of the GPIO simulator.
+"""
+
+import asyncio
+import multiprocessing
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Workloads, as lists of (weight, method, path) operations. '{relay}'
+# is replaced by a random relay id and PUTs send a random state.
+WORKLOADS = {
+    'list': [(1, 'GET', '/relays/')],
+    'status': [(1, 'GET', '/relays/{relay}')],
+    'get': [(1, 'GET', '/relays/{relay}/state/')],
+    'set': [(1, 'PUT', '/relays/{relay}/state/')],
+    # Pollers and toggling clients at the same time
+    'mixed': [(2, 'GET', '/relays/'),
+              (5, 'GET', '/relays/{relay}/state/'),
+              (3, 'PUT', '/relays/{relay}/state/')],
+}
+
+# The same workloads in control protocol commands
+CONTROL_WORKLOADS = {
+    'list': [(1, 'STATE')],
+    'status': [(1, 'GET {relay}')],
+    'get': [(1, 'GET {relay}')],
+    'set': [(1, 'SET {relay} {state}')],
+    'mixed': [(2, 'STATE'),
+              (5, 'GET {relay}'),
+              (3, 'SET {relay} {state}')],
+}
+
+TRANSPORTS = ('http', 'control', 'naive', 'client')
+
+def simulated_config(relays=32, lines_per_chip=16, read_latency=0, write_latency=0,
+                     executor='chip', cache=False):
+    """
+        Return a configuration of relays spread over simulated chips.
+    """
+    from .schema import CONFIG_TRAFARET
+
+    return CONFIG_TRAFARET.check({
+        'host': '127.0.0.1',
+        'port': 0,
+        'gpio': {
+            'backend': 'simulator',
+            'executor': executor,
+            'simulator': {'latency': {'read': read_latency, 'write': write_latency}},
+        },
+        'cache': {'enabled': cache},
+        'control': {'port': 0},
+        'relays': {str(i): {'chip': 'gpiochip%d' % (i // lines_per_chip),
+                            'line': i % lines_per_chip}
+                   for i in range(relays)},
+    })
+
+def serve(config, conn):
+    """
+        Child process main: serve the configuration on a free loopback
+        port, reporting the port number through conn.
+    """
+    from .main import request_relay_lines, set_relay_defaults, get_config_backend
+    from .app import make_app
+    from .control import CONTROL_SERVER
+
+    async def start():
+        lines = request_relay_lines(config['relays'], get_config_backend(config))
+        set_relay_defaults(lines, config['relays'])
+        app = make_app(config, lines)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, config['host'], config['port'])
+        await site.start()
+        conn.send((runner.addresses[0][1], app[CONTROL_SERVER].address[1]))
+        await asyncio.Event().wait()
+    asyncio.run(start())
+
+class ServerProcess:
+    """
+        Context manager running a simulated powerrelay server in a
+        child process. The base URL is available as 'url', the control
+        protocol address as 'control'.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.process = None
+        self.url = None
+        self.control = None
+
+    def __enter__(self):
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(self.config, child), daemon=True)
+        self.process.start()
+        if not parent.poll(30):
+            self.process.terminate()
+            raise RuntimeError("Benchmark server did not start")
+        port, control_port = parent.recv()
+        self.url = "http://%s:%d" % (self.config['host'], port)
+        self.control = (self.config['host'], control_port)
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.join()
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def summarize(latencies, errors, elapsed):
+    """
+        Throughput and latency percentiles (in milliseconds) of a run.
+    """
+    ordered = sorted(latencies)
+    count = len(ordered)
+    ms = lambda x: None if x is None else round(x * 1000, 3)
+    return {
+        'requests': count,
+        'errors': errors,
+        'duration': round(elapsed, 3),
+        'throughput': round(count / elapsed, 1) if elapsed > 0 else None,
+        'latency_ms': {
+            'mean': ms(sum(ordered) / count) if count else None,
+            'p50': ms(percentile(ordered, 50)),
+            'p90': ms(percentile(ordered, 90)),
+            'p99': ms(percentile(ordered, 99)),
+            'max': ms(ordered[-1]) if count else None,
+        },
+    }
+
+async def measure(operation, concurrency, requests=1000, duration=None, seed=0):
+    """
+        Await operation(rng) from 'concurrency' workers, either
+        'requests' times in total or for 'duration' seconds. operation
+        returns whether it succeeded.
+    """
+    latencies = []
+    errors = 0
+    remaining = requests
+    deadline = None if duration is None else time.perf_counter() + duration
+
+    async def worker(n):
+        nonlocal remaining, errors
+        rng = random.Random(seed + n)
+        while True:
+            if deadline is None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            elif time.perf_counter() >= deadline:
+                return
+            start = time.perf_counter()
+            try:
+                ok = await operation(rng)
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(n) for n in range(concurrency)])
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+def http_operation(session, url, workload, relays):
+    """
+        Return an operation doing a random request of the workload.
+    """
+    ops = WORKLOADS[workload]
+    weights = [op[0] for op in ops]
+
+    async def operation(rng):
+        _, method, path = rng.choices(ops, weights)[0]
+        path = path.replace('{relay}', rng.choice(relays))
+        data = str(rng.randint(0, 1)) if method == 'PUT' else None
+        async with session.request(method, url + path, data=data) as resp:
+            await resp.read()
+            return resp.status == 200
+    return operation
+
+async def benchmark_http(url, workloads, concurrencies, requests=1000, duration=None,
+                         transport='http'):
+    """
+        Run every workload at every concurrency against the server at
+        url. The 'naive' transport opens a connection per request.
+    """
+    results = []
+    connector = aiohttp.TCPConnector(limit=max(concurrencies), force_close=transport == 'naive')
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async with session.get(url + '/relays/?compact=1') as resp:
+            relays = [relay['id'] for relay in await resp.json()]
+        for workload in workloads:
+            operation = http_operation(session, url, workload, relays)
+            for concurrency in concurrencies:
+                result = {'workload': workload, 'transport': transport, 'concurrency': concurrency}
+                result.update(await measure(operation, concurrency, requests, duration))
+                results.append(result)
+    return results
+
+def client_operation(client, workload, relays):
+    """
+        Return an operation doing a random request of the workload
+        through the relay client.
+    """
+    from .client import RelayClientError
+
+    ops = WORKLOADS[workload]
+    weights = [op[0] for op in ops]
+
+    async def operation(rng):
+        _, method, path = rng.choices(ops, weights)[0]
+        try:
+            if path == '/relays/':
+                await client.relays()
+            elif method == 'GET':
+                await client.get(rng.choice(relays))
+            else:
+                await client.set(rng.choice(relays), rng.randint(0, 1))
+        except RelayClientError:
+            return False
+        return True
+    return operation
+
+async def benchmark_client(url, workloads, concurrencies, requests=1000, duration=None):
+    """
+        Run every workload at every concurrency against the server at
+        url through the relay client, which batches concurrent calls.
+    """
+    from .client import AsyncRelayPool
+
+    results = []
+    async with AsyncRelayPool(limit_per_host=max(concurrencies), retries=0) as pool:
+        client = pool.client(url)
+        relays = [relay.id for relay in await client.relays()]
+        for workload in workloads:
+            operation = client_operation(client, workload, relays)
+            for concurrency in concurrencies:
+                result = {'workload': workload, 'transport': 'client', 'concurrency': concurrency}
+                result.update(await measure(operation, concurrency, requests, duration))
+                results.append(result)
+    return results
+
+class ControlConnection:
+    """
+        A control protocol connection, doing one request at a time.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def request(self, command):
+        self.writer.write(command.encode() + b"\n")
+        response = await self.reader.readline()
+        if not response:
+            raise ConnectionResetError("Control connection closed")
+        return response.decode()
+
+    def close(self):
+        self.writer.close()
+
+def control_operation(connections, workload, relays):
+    """
+        Return an operation doing a random command of the workload on
+        one of the idle connections.
+    """
+    ops = CONTROL_WORKLOADS[workload]
+    weights = [op[0] for op in ops]
+
+    async def operation(rng):
+        _, command = rng.choices(ops, weights)[0]
+        command = command.format(relay=rng.choice(relays), state=rng.randint(0, 1))
+        connection = await connections.get()
+        try:
+            return (await connection.request(command)).startswith("OK")
+        finally:
+            connections.put_nowait(connection)
+    return operation
+
+async def benchmark_control(address, workloads, concurrencies, requests=1000, duration=None):
+    """
+        Run every workload at every concurrency against the control
+        protocol at address, with a connection per concurrent client.
+    """
+    results = []
+    opened = [await ControlConnection.open(*address) for _ in range(max(concurrencies))]
+    try:
+        state = await opened[0].request("STATE")
+        relays = [item.split("=")[0] for item in state.split()[1:]]
+        for workload in workloads:
+            for concurrency in concurrencies:
+                connections = asyncio.Queue()
+                for connection in opened[:concurrency]:
+                    connections.put_nowait(connection)
+                operation = control_operation(connections, workload, relays)
+                result = {'workload': workload, 'transport': 'control', 'concurrency': concurrency}
+                result.update(await measure(operation, concurrency, requests, duration))
+                results.append(result)
+    finally:
+        for connection in opened:
+            connection.close()
+    return results
+
+def run_benchmark(workloads, concurrencies, requests=1000, duration=None, url=None,
+                  control=None, transports=('http',), **simulation):
+    """
+        Benchmark a running server at url (and control protocol
+        address), or a simulated one set up by
+        simulated_config(**simulation), over the given transports.
+        Returns the machine readable report.
+    """
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise ValueError("Unknown workload '%s'" % workload)
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport '%s'" % transport)
+
+    async def run(url, control):
+        results = []
+        for transport in ('http', 'naive'):
+            if transport in transports:
+                results += await benchmark_http(url, workloads, concurrencies, requests, duration,
+                                                transport)
+        if 'client' in transports:
+            results += await benchmark_client(url, workloads, concurrencies, requests, duration)
+        if 'control' in transports:
+            if control is None:
+                raise ValueError("No control protocol address to benchmark")
+            results += await benchmark_control(control, workloads, concurrencies, requests, duration)
+        return results
+
+    report = {'url': url, 'simulation': None if url else simulation}
+    if url is not None:
+        report['results'] = asyncio.run(run(url, control))
+    else:
+        with ServerProcess(simulated_config(**simulation)) as server:
+            report['results'] = asyncio.run(run(server.url, server.control))
+    return report
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Client library of the relay API: AsyncRelayClient for asyncio and
+    the blocking RelayClient. Clients of several servers can share the
+    keep-alive connections of a pool (AsyncRelayPool, RelayPool).
+"""
+from .base import *
+from .aio import *
+from .sync import *
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+    asyncio client of the relay API.
+"""
+
+import asyncio
+import json
+from typing import Dict, Iterable, List, Mapping, Optional
+from urllib.parse import quote
+
+import aiohttp
+
+from .base import Relay, RelayClientError, backoff
+
+# Answers to a read worth retrying
+RETRY_STATUSES = (502, 503, 504)
+
+class Batcher:
+    """
+        Collect the calls made in the same event loop iteration, and
+        run them as one batch with run_batch({key: value}), which
+        returns {key: result or exception}. A call for a key already
+        in the batch with another value starts a new batch.
+    """
+    def __init__(self, run_batch):
+        self.run_batch = run_batch
+        # key -> (value, [futures])
+        self.pending = None
+
+    async def submit(self, key, value=None):
+        loop = asyncio.get_event_loop()
+        if self.pending is not None and key in self.pending and self.pending[key][0] != value:
+            self.flush(self.pending)
+        if self.pending is None:
+            self.pending = dict()
+            loop.call_soon(self.flush, self.pending)
+        future = loop.create_future()
+        self.pending.setdefault(key, (value, []))[1].append(future)
+        return await future
+
+    def flush(self, batch):
+        if self.pending is batch:
+            self.pending = None
+            asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch):
+        try:
+            results = await self.run_batch({key: value for key, (value, _) in batch.items()})
+        except Exception as ex:
+            results = {key: ex for key in batch}
+        for key, (_, futures) in batch.items():
+            result = results[key]
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+class AsyncRelayPool:
+    """
+        Keep-alive connections to any number of powerrelay servers,
+        shared by the clients of all of them. At most 'limit_per_host'
+        connections are opened to one server, 'limit' in total.
+        Requests time out after 'timeout' seconds; reads are retried
+        up to 'retries' times.
+    """
+    def __init__(self, limit=100, limit_per_host=8, timeout=5.0, retries=3):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.clients = dict()
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use, on the event loop of the requests
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def client(self, url):
+        """
+            The client of the server at url.
+        """
+        url = url.rstrip('/')
+        client = self.clients.get(url)
+        if client is None:
+            client = self.clients[url] = AsyncRelayClient(url, pool=self)
+        return client
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+class AsyncRelayClient:
+    """
+        Client of the powerrelay server at url, using the connections
+        of 'pool', or of its own pool created with 'options'.
+
+        get() and set() calls made concurrently are sent as one bulk
+        request. A bulk request the server refuses (e.g. an unknown
+        relay, or a server without bulk requests) is redone relay by
+        relay, so every call gets its own result.
+    """
+    def __init__(self, url, pool=None, **options):
+        self.url = url.rstrip('/')
+        self.own_pool = pool is None
+        self.pool = AsyncRelayPool(**options) if pool is None else pool
+        self.getter = Batcher(self.get_batch)
+        self.setter = Batcher(self.set_batch)
+
+    async def request(self, method, path, retry=False, **kwargs):
+        """
+            Request path, returning the decoded json answer. Reads
+            ('retry') are retried with backoff on connection failures,
+            timeouts and gateway errors.
+        """
+        error = None
+        for attempt in range(self.pool.retries + 1 if retry else 1):
+            if attempt:
+                await asyncio.sleep(backoff(attempt - 1))
+            try:
+                async with self.pool.session.request(method, self.url + path, **kwargs) as resp:
+                    body = await resp.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                error = RelayClientError("%s %s%s: %s" % (method, self.url, path, str(ex) or type(ex).__name__))
+                continue
+            if resp.status >= 400:
+                error = RelayClientError("%s %s%s: %s" % (method, self.url, path,
+                                                          body.decode(errors='replace').strip()),
+                                         resp.status)
+                if resp.status in RETRY_STATUSES:
+                    continue
+                raise error
+            return json.loads(body) if body else None
+        raise error
+
+    async def relays(self) -> List[Relay]:
+        return [Relay.from_json(entry)
+                for entry in await self.request('GET', '/relays/', True, params={'compact': '1'})]
+
+    async def get(self, relay: str) -> int:
+        """
+            The state of a relay, given by id, name or alias.
+        """
+        return await self.getter.submit(relay)
+
+    async def get_many(self, relays: Iterable[str]) -> Dict[str, int]:
+        relays = list(dict.fromkeys(relays))
+        return dict(zip(relays, await asyncio.gather(*[self.get(relay) for relay in relays])))
+
+    async def set(self, relay: str, state: int) -> Optional[bool]:
+        """
+            Switch a relay, returning whether it changed, or None if the
+            server doesn't tell (e.g. a queued switch-on).
+        """
+        return await self.setter.submit(relay, int(state))
+
+    async def set_many(self, states: Mapping[str, int]) -> Dict[str, Optional[bool]]:
+        return dict(zip(states, await asyncio.gather(*[self.set(relay, state)
+                                                       for relay, state in states.items()])))
+
+    async def get_one(self, relay):
+        return int(await self.request('GET', '/relays/%s/state/' % quote(relay, safe=''), True))
+
+    async def set_one(self, relay, state):
+        result = await self.request('PUT', '/relays/%s/state/' % quote(relay, safe=''), data=str(state))
+        return result.get('changed')
+
+    async def each(self, call, batch):
+        results = await asyncio.gather(*[call(*item) for item in batch.items()], return_exceptions=True)
+        return dict(zip(batch, results))
+
+    async def get_batch(self, batch):
+        if len(batch) == 1:
+            return await self.each(lambda relay, _: self.get_one(relay), batch)
+        params = [('relay', relay) for relay in batch] + [('compact', '1')]
+        try:
+            states = await self.request('GET', '/relays/state', True, params=params)
+        except RelayClientError as ex:
+            if ex.status is None or ex.status >= 500:
+                raise
+            return await self.each(lambda relay, _: self.get_one(relay), batch)
+        return {relay: int(states[relay]) for relay in batch}
+
+    async def set_batch(self, batch):
+        if len(batch) == 1:
+            return await self.each(self.set_one, batch)
+        try:
+            statuses = await self.request('PUT', '/relays/state', json=batch)
+        except RelayClientError as ex:
+            if ex.status is None or ex.status >= 500:
+                raise
+            return await self.each(self.set_one, batch)
+        results = dict()
+        for relay, status in statuses.items():
+            if status.get('status') == 'error':
+                results[relay] = RelayClientError("Relay '%s': %s" % (relay, status.get('error')))
+            else:
+                results[relay] = status.get('changed')
+        return results
+
+    async def close(self):
+        if self.own_pool:
+            await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
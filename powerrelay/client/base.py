@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Types shared by the asyncio and the blocking client.
+"""
+
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass
+class Relay:
+    """
+        A relay as listed by a server.
+    """
+    id: str
+    state: int
+    name: str = ""
+    # Value of the relay's feedback input, None if it has none or it
+    # is unknown
+    feedback: Optional[int] = None
+
+    @classmethod
+    def from_json(cls, entry):
+        feedback = entry.get('feedback')
+        return cls(entry['id'], int(entry['state']), entry.get('name', ""),
+                   None if feedback is None else int(feedback))
+
+class RelayClientError(Exception):
+    """
+        A request failed. 'status' is the HTTP status the server
+        answered with, None if there was no answer.
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def backoff(attempt, base=0.1, maximum=2.0):
+    """
+        Seconds to wait before retry number 'attempt' (from 0):
+        exponential, with jitter so clients don't retry in lockstep.
+    """
+    return min(maximum, base * 2 ** attempt) * random.uniform(0.5, 1)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Blocking client of the relay API.
+"""
+
+import asyncio
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from .aio import AsyncRelayPool
+from .base import Relay
+
+class RelayPool:
+    """
+        Blocking counterpart of AsyncRelayPool. The connections are
+        served by an event loop in a background thread, shared by all
+        threads using the pool's clients, so calls made concurrently
+        from several threads are batched like concurrent tasks.
+    """
+    def __init__(self, **options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="powerrelay-client",
+                                       daemon=True)
+        self.thread.start()
+        self.pool = AsyncRelayPool(**options)
+        self.clients = dict()
+        self.lock = threading.Lock()
+
+    def call(self, coro):
+        """
+            Run a coroutine on the pool's event loop and return its
+            result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def client(self, url):
+        """
+            The client of the server at url.
+        """
+        url = url.rstrip('/')
+        with self.lock:
+            client = self.clients.get(url)
+            if client is None:
+                client = self.clients[url] = RelayClient(url, pool=self)
+            return client
+
+    def close(self):
+        if self.thread.is_alive():
+            self.call(self.pool.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RelayClient:
+    """
+        Blocking client of the powerrelay server at url, with the API
+        of AsyncRelayClient, using the connections of 'pool' or of its
+        own pool created with 'options'.
+    """
+    def __init__(self, url, pool=None, **options):
+        self.own_pool = pool is None
+        self.pool = RelayPool(**options) if pool is None else pool
+        self.client = self.pool.pool.client(url)
+
+    @property
+    def url(self):
+        return self.client.url
+
+    def relays(self) -> List[Relay]:
+        return self.pool.call(self.client.relays())
+
+    def get(self, relay: str) -> int:
+        return self.pool.call(self.client.get(relay))
+
+    def get_many(self, relays: Iterable[str]) -> Dict[str, int]:
+        return self.pool.call(self.client.get_many(relays))
+
+    def set(self, relay: str, state: int) -> Optional[bool]:
+        return self.pool.call(self.client.set(relay, state))
+
+    def set_many(self, states: Mapping[str, int]) -> Dict[str, Optional[bool]]:
+        return self.pool.call(self.client.set_many(states))
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Serialization and coalescing of relay writes.
+"""
+
+import asyncio
+
+class PendingWrite:
+    """
+        The next write of a busy relay, shared by all writers waiting
+        for it.
+    """
+    def __init__(self, line, value, force, future, origin=None):
+        self.line = line
+        self.value = value
+        self.force = force
+        self.future = future
+        self.origin = origin
+
+class WriteQueue:
+    """
+        Serialize writes per relay, so concurrent writes to a relay
+        reach the hardware in order.
+
+        A relay with a write in flight is busy: further writes wait for
+        it, and while waiting, later writes replace the queued value, so
+        only the last one is done. Writes of the value a relay is known
+        to be in are skipped unless forced.
+    """
+    def __init__(self, apply, known, skipped=None, origin=None):
+        # Coroutine function applying a list of (line, value) updates,
+        # optionally with their precompiled plan, returning the errors
+        self.apply = apply
+        # Function returning the known value of a (request, offset)
+        self.known = known
+        # Called with the lines whose writes were skipped
+        self.skipped = skipped
+        # Optional ContextVar, e.g. the client a write comes from, set
+        # for queued writes as it was for their (last) writer
+        self.origin = origin
+        self.busy = set()
+        self.pending = dict()
+        # Futures of hold() calls waiting for relays to be idle
+        self.waiters = []
+
+    async def write(self, updates, plan=None, force=False, changed=None):
+        """
+            Write a list of (line, value) updates. Returns the errors
+            like apply(), and adds the (request, offset) of every relay
+            that was switched to changed.
+        """
+        now = []
+        waiting = []
+        for line, value in updates:
+            key = (line.request, line.offset)
+            if key not in self.busy:
+                now.append((line, value, force))
+                continue
+            origin = self.origin.get() if self.origin is not None else None
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = PendingWrite(line, value, force, asyncio.get_event_loop().create_future(), origin)
+                self.pending[key] = entry
+            else:
+                entry.value = value
+                entry.force = entry.force or force
+                entry.origin = origin
+            waiting.append((key, entry.future))
+
+        errors = dict()
+        if now:
+            done = set()
+            errors.update(await self.run(now, plan if len(now) == len(updates) else None, done))
+            if changed is not None:
+                changed.update(done)
+        for key, future in waiting:
+            # shield: the future is shared with other writers
+            ex, was_changed = await asyncio.shield(future)
+            if ex is not None:
+                errors[key] = ex
+            if was_changed and changed is not None:
+                changed.add(key)
+        return errors
+
+    async def run(self, updates, plan, changed):
+        """
+            Apply (line, value, force) updates to relays that are not
+            busy, then start the writes queued for them meanwhile.
+        """
+        keys = [(line.request, line.offset) for line, _, _ in updates]
+        self.busy.update(keys)
+        try:
+            todo = [(line, value) for line, value, force in updates
+                    if force or self.known((line.request, line.offset)) != value]
+            if len(todo) != len(updates):
+                plan = None
+                if self.skipped is not None:
+                    written = {id(line) for line, _ in todo}
+                    self.skipped([line for line, _, _ in updates if id(line) not in written])
+            errors = await self.apply(todo, plan) if todo else dict()
+        finally:
+            self.release(keys)
+        for line, _ in todo:
+            key = (line.request, line.offset)
+            if key not in errors and line.request not in errors:
+                changed.add(key)
+        return errors
+
+    async def hold(self, keys, fn):
+        """
+            Wait for the given relays to be idle, and await fn() with
+            them busy: writes to them meanwhile are queued.
+        """
+        keys = list(keys)
+        while any(key in self.busy for key in keys):
+            future = asyncio.get_event_loop().create_future()
+            self.waiters.append(future)
+            await future
+        self.busy.update(keys)
+        try:
+            return await fn()
+        finally:
+            self.release(keys)
+
+    def release(self, keys):
+        entries = []
+        idle = False
+        for key in keys:
+            entry = self.pending.pop(key, None)
+            if entry is None:
+                self.busy.discard(key)
+                idle = True
+            else:
+                entries.append(entry)
+        if idle and self.waiters:
+            for future in self.waiters:
+                if not future.done():
+                    future.set_result(None)
+            self.waiters = []
+        # One batch per origin
+        batches = dict()
+        for entry in entries:
+            batches.setdefault(entry.origin, []).append(entry)
+        for origin, batch in batches.items():
+            asyncio.ensure_future(self.run_pending(batch, origin))
+
+    async def run_pending(self, entries, origin=None):
+        if self.origin is not None:
+            self.origin.set(origin)
+        changed = set()
+        try:
+            errors = await self.run([(entry.line, entry.value, entry.force) for entry in entries],
+                                    None, changed)
+        except Exception as ex:
+            for entry in entries:
+                entry.future.set_exception(ex)
+            return
+        for entry in entries:
+            key = (entry.line.request, entry.line.offset)
+            entry.future.set_result((errors.get(key, errors.get(entry.line.request)), key in changed))
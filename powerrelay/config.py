@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Loading of configuration files, with a cache of validated ones.
+
+    Parsing the YAML and checking it against the rules in schema takes
+    a while on small targets, and has the server import yaml and
+    trafaret before any relay is set. The validated configuration is
+    cached in marshal format, keyed by a hash of the file and the
+    rules, so starting with an unchanged configuration needs neither.
+"""
+
+import hashlib
+import marshal
+import os
+import sys
+
+# Bumped when the cache file layout changes
+CACHE_VERSION = 1
+
+class ConfigError(ValueError):
+    """
+        The configuration is invalid, 'errors' lists the problems.
+    """
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+def cache_dir():
+    """
+        Directory of the configuration cache: $POWERRELAY_CACHE_DIR, or
+        powerrelay in the user's cache directory.
+    """
+    path = os.environ.get('POWERRELAY_CACHE_DIR')
+    if path:
+        return path
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                        'powerrelay')
+
+def read_config(path, schema='CONFIG_TRAFARET'):
+    """
+        Read a configuration file and check it against the named rules
+        of the schema module.
+    """
+    import trafaret_config as traf_cfg
+    from . import schema as schemas
+
+    try:
+        return traf_cfg.read_and_validate(path, getattr(schemas, schema))
+    except traf_cfg.ConfigError as ex:
+        raise ConfigError([str(err) for err in ex.errors]) from None
+
+def cache_key(data, schema):
+    digest = hashlib.sha256(data)
+    # The rules are identified by the schema module's mtime and size
+    try:
+        st = os.stat(os.path.join(os.path.dirname(__file__), 'schema.py'))
+        rules = "%d %d" % (st.st_mtime_ns, st.st_size)
+    except OSError:
+        rules = ""
+    digest.update(("%s %s %s %d" % (schema, rules, sys.version, CACHE_VERSION)).encode())
+    return digest.hexdigest()
+
+def cache_file(path, directory):
+    name = hashlib.sha256(os.path.realpath(path).encode()).hexdigest()[:16]
+    return os.path.join(directory, name + ".config")
+
+def load_config(path, schema='CONFIG_TRAFARET', cache=True):
+    """
+        Like read_config(), answered from the cache when the file and
+        rules didn't change. Returns the configuration and whether it
+        came from the cache. A cache that can't be read or written is
+        ignored.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    # ${VAR}s are substituted from the environment, which is not part
+    # of the key
+    if not cache or b'${' in data:
+        return read_config(path, schema), False
+
+    key = cache_key(data, schema)
+    directory = cache_dir()
+    cached = cache_file(path, directory)
+    try:
+        with open(cached, 'rb') as f:
+            entry = marshal.load(f)
+        if isinstance(entry, tuple) and len(entry) == 2 and entry[0] == key:
+            return entry[1], True
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    config = read_config(path, schema)
+    tmp = "%s.%d" % (cached, os.getpid())
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            marshal.dump((key, config), f)
+        os.replace(tmp, cached)
+    except (OSError, ValueError):
+        # Not cached, e.g. on a read-only filesystem
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    return config, False
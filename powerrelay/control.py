@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Line based TCP control protocol, served next to the HTTP API.
+
+    Every request is a line holding a command and its arguments,
+    optionally preceded by an '@tag' that is echoed in the response.
+    Requests may be pipelined, responses come in request order:
+
+      GET <relay>          -> OK <state>
+      SET <relay> <state>  -> OK
+      STATE                -> OK <relay>=<state> ...
+      PING                 -> OK
+
+    Failures are answered with 'ERR <message>'.
+"""
+
+import asyncio
+from collections import deque
+
+from aiohttp import web
+
+from powerrelay.history import ORIGIN
+
+class ControlError(Exception):
+    pass
+
+class ControlProtocol(asyncio.Protocol):
+    """
+        A control connection. Requests are handled one at a time, in
+        order; reading pauses while too many requests are queued.
+    """
+    # Longest request line, and most requests queued before reading
+    # from the client pauses
+    MAX_LINE = 1024
+    MAX_PIPELINE = 256
+
+    def __init__(self, controller, connections):
+        self.controller = controller
+        self.connections = connections
+        self.transport = None
+        self.buffer = b""
+        self.queue = deque()
+        self.task = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.connections.discard(self)
+        if self.task is not None:
+            self.task.cancel()
+
+    def data_received(self, data):
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        if len(self.buffer) > self.MAX_LINE:
+            self.transport.write(b"ERR Request too long\n")
+            self.transport.close()
+            return
+        self.queue.extend(lines)
+        if len(self.queue) > self.MAX_PIPELINE and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        if self.task is None and self.queue:
+            self.task = asyncio.ensure_future(self.process())
+
+    async def process(self):
+        peer = self.transport.get_extra_info('peername')
+        ORIGIN.set((peer[0] if isinstance(peer, tuple) else "", "control"))
+        try:
+            while self.queue:
+                response = await self.handle(self.queue.popleft())
+                if self.transport.is_closing():
+                    return
+                self.transport.write(response)
+                if self.paused and len(self.queue) <= self.MAX_PIPELINE // 2:
+                    self.paused = False
+                    self.transport.resume_reading()
+        finally:
+            self.task = None
+
+    async def handle(self, line):
+        tokens = line.decode(errors='replace').split()
+        tag = ""
+        if tokens and tokens[0].startswith('@'):
+            tag = tokens.pop(0) + " "
+        try:
+            if not tokens:
+                raise ControlError("Empty request")
+            command = tokens[0].upper()
+            if command not in self.COMMANDS:
+                raise ControlError("Unknown command '%s'" % tokens[0])
+            nargs, handler = self.COMMANDS[command]
+            if len(tokens) - 1 != nargs:
+                raise ControlError("%s takes %d argument(s)" % (command, nargs))
+            result = await handler(self, *tokens[1:])
+        except ControlError as ex:
+            return ("%sERR %s\n" % (tag, ex)).encode()
+        except web.HTTPException as ex:
+            # Lookup and parse errors of the relay API
+            return ("%sERR %s\n" % (tag, ex.text.strip())).encode()
+        except OSError as ex:
+            return ("%sERR %s\n" % (tag, ex)).encode()
+        if result:
+            return ("%sOK %s\n" % (tag, result)).encode()
+        return ("%sOK\n" % tag).encode()
+
+    async def get(self, ident):
+        value = await self.controller.read_value(self.controller.lookup_line(ident))
+        return str(value.value)
+
+    async def set(self, ident, state):
+        line = self.controller.lookup_line(ident)
+        self.controller.check_lease(None, [line])
+        self.controller.cancel_cycles([line])
+        await self.controller.write_value(line, self.controller.parse_value(state))
+
+    async def state(self):
+        snapshot = await self.controller.snapshot()
+        return " ".join("%s=%s" % item for item in snapshot.items())
+
+    async def ping(self):
+        pass
+
+    # command -> (number of arguments, handler)
+    COMMANDS = {
+        'GET': (1, get),
+        'SET': (2, set),
+        'STATE': (0, state),
+        'PING': (0, ping),
+    }
+
+class ControlServer:
+    """
+        Serve the control protocol for a RelayController on the event
+        loop of the web application. A 'port' of 0 picks a free port,
+        see 'address' once started.
+    """
+    def __init__(self, controller, host, port):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connections = set()
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def startup(self, app):
+        loop = asyncio.get_event_loop()
+        self.server = await loop.create_server(
+            lambda: ControlProtocol(self.controller, self.connections), self.host, self.port)
+
+    async def shutdown(self, app):
+        self.server.close()
+        for connection in list(self.connections):
+            connection.transport.close()
+        await self.server.wait_closed()
+
+CONTROL_SERVER = web.AppKey("control_server", ControlServer)
@@ -4,3 +4,6 @@
     Library package for controllers.
 """
 from .relay import *
+from .metrics import *
+from .admin import *
+from .proxy import *
@@ -0,0 +1,21 @@
+from aiohttp import web
+import json
+
+class AdminController:
+    """
+        Admin API Controller
+    """
+    def __init__(self, reloader):
+        self.reloader = reloader
+
+    async def reload(self,request):
+        """
+            Reload the relay configuration
+        """
+        try:
+            report = await self.reloader.reload()
+        except (ValueError, LookupError) as ex:
+            raise web.HTTPBadRequest(text="Reload failed: %s" % ex)
+        except OSError as ex:
+            raise web.HTTPInternalServerError(text="Reload failed: %s" % ex)
+        return web.json_response(report, dumps=lambda x: json.dumps(x, indent=2) + "\n")
@@ -0,0 +1,15 @@
+from aiohttp import web
+
+class MetricsController:
+    """
+        Metrics API Controller
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def get_metrics(self,request):
+        """
+            Return the metrics in Prometheus text format
+        """
+        return web.Response(body=self.metrics.render().encode(),
+                            headers={'Content-Type': self.metrics.CONTENT_TYPE})
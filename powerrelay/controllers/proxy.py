@@ -0,0 +1,281 @@
+from aiohttp import web
+import aiohttp
+import asyncio
+import logging
+
+from powerrelay.controllers.relay import RelayController
+from powerrelay.proxy import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+class ProxyController:
+    """
+        Aggregating proxy API Controller: serves the relays of several
+        upstream powerrelay servers as one /relays/ namespace.
+    """
+    def __init__(self, upstreams, events=True, connections=100):
+        self.upstreams = upstreams
+        self.events = events
+        self.connections = connections
+        self.session = None
+        self.tasks = []
+        # Proxy relay id -> (upstream, upstream relay id)
+        self.index = dict()
+        for upstream in upstreams:
+            upstream.on_relays = self.reindex
+
+    def reindex(self):
+        index = dict()
+        for upstream in self.upstreams:
+            for relay in upstream.relays:
+                ident = upstream.prefix + relay
+                if ident in index:
+                    logger.warning("Relay '%s' of upstream '%s' hidden by upstream '%s'",
+                                   ident, upstream.name, index[ident][0].name)
+                    continue
+                index[ident] = (upstream, relay)
+        self.index = index
+
+    async def startup(self, app):
+        # One pool of keep-alive connections shared by all upstreams
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        self.session = aiohttp.ClientSession(connector=connector)
+        for upstream in self.upstreams:
+            upstream.session = self.session
+        results = await asyncio.gather(*[upstream.fetch_relays() for upstream in self.upstreams],
+                                       return_exceptions=True)
+        # Failed upstreams are logged as such, and their relays show up
+        # once their event stream connects
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, UpstreamError):
+                raise result
+        if self.events:
+            self.tasks = [asyncio.ensure_future(upstream.follow_events())
+                          for upstream in self.upstreams]
+
+    async def shutdown(self, app):
+        for task in self.tasks:
+            task.cancel()
+
+    async def cleanup(self, app):
+        await self.session.close()
+
+    # Same encoding and parameters as the relay API
+    json_response = RelayController.json_response
+    dumps = RelayController.dumps
+    dumps_compact = staticmethod(RelayController.dumps_compact)
+    wants_compact = staticmethod(RelayController.wants_compact)
+    query_flag = staticmethod(RelayController.query_flag)
+    parse_value = staticmethod(RelayController.parse_value)
+
+    @staticmethod
+    def upstream_headers(request):
+        """
+            Headers of a write passed on to the upstream, the lease
+            token included.
+        """
+        headers = {'Accept': request.headers.get('Accept', '')}
+        if 'X-Lease' in request.headers:
+            headers['X-Lease'] = request.headers['X-Lease']
+        return headers
+
+    def lookup(self, ident):
+        try:
+            return self.index[ident]
+        except KeyError:
+            raise web.HTTPNotFound(text="Relay '%s' not found" % ident) from None
+
+    def by_upstream(self, idents):
+        """
+            Group proxy relay ids by upstream, as {upstream: {upstream
+            relay id: proxy relay id}}.
+        """
+        res = dict()
+        for ident in idents:
+            upstream, relay = self.lookup(ident)
+            res.setdefault(upstream, dict())[relay] = ident
+        return res
+
+    async def relays(self,request):
+        """
+            Return the relays of all upstreams. Relays of an upstream
+            that failed have no state but an error.
+        """
+        verify = self.query_flag(request, 'verify')
+
+        async def listing(upstream):
+            # The states of relays not yet seen in events are fetched
+            if upstream.live and not verify and all(relay in upstream.states
+                                                    for relay in upstream.relays):
+                return [{'id': relay, 'state': upstream.states[relay]} for relay in upstream.relays]
+            return await upstream.fetch_relays(verify)
+
+        results = await asyncio.gather(*[listing(upstream) for upstream in self.upstreams],
+                                       return_exceptions=True)
+        res = []
+        for upstream, result in zip(self.upstreams, results):
+            if isinstance(result, UpstreamError):
+                result = [{'id': relay, 'state': None, 'error': str(result)}
+                          for relay in upstream.relays]
+            elif isinstance(result, BaseException):
+                raise result
+            for entry in result:
+                relay = entry['id']
+                ident = upstream.prefix + relay
+                if self.index.get(ident, (None,))[0] is not upstream:
+                    continue
+                entry = dict(entry, id=ident, upstream=upstream.name)
+                if relay in upstream.names:
+                    entry.setdefault('name', upstream.names[relay])
+                res.append(entry)
+        return self.json_response(request, res)
+
+    async def num_relays(self,request):
+        """
+            Return the number of relays
+        """
+        return self.json_response(request, {"count": len(self.index)})
+
+    async def read_states(self, idents, verify=False):
+        """
+            Read the states of the given proxy relay ids, asking all
+            involved upstreams at once.
+        """
+        groups = self.by_upstream(idents)
+        results = await asyncio.gather(*[upstream.read_states(list(relays), verify)
+                                         for upstream, relays in groups.items()])
+        states = dict()
+        for (upstream, relays), result in zip(groups.items(), results):
+            for relay, ident in relays.items():
+                states[ident] = result[relay]
+        return states
+
+    async def status(self,request):
+        """
+            Relay status
+        """
+        ident = request.match_info['relay']
+        try:
+            states = await self.read_states([ident], self.query_flag(request, 'verify'))
+        except UpstreamError as ex:
+            return ex.response()
+        return self.json_response(request, {"relay_id": ident, "status": states[ident]})
+
+    async def get_state_old(self,request):
+        """
+            Relay get value
+        """
+        ident = request.match_info['relay']
+        try:
+            states = await self.read_states([ident], self.query_flag(request, 'verify'))
+        except UpstreamError as ex:
+            return ex.response()
+        return self.json_response(request, {"state": states[ident]})
+
+    async def get_state(self,request):
+        """
+            Relay get value
+        """
+        ident = request.match_info['relay']
+        try:
+            states = await self.read_states([ident], self.query_flag(request, 'verify'))
+        except UpstreamError as ex:
+            return ex.response()
+        return self.json_response(request, states[ident])
+
+    async def get_states(self,request):
+        """
+            Relay get values of several relays, given by repeated
+            'relay' query parameters, or all relays if none are given.
+        """
+        idents = request.query.getall('relay', None)
+        if idents is None:
+            idents = list(self.index)
+        try:
+            states = await self.read_states(idents, self.query_flag(request, 'verify'))
+        except UpstreamError as ex:
+            return ex.response()
+        return self.json_response(request, {ident: states[ident] for ident in idents})
+
+    async def forward(self, request, path, value=None):
+        """
+            Forward a request for a single relay to its upstream,
+            answering with the upstream's response. path is the part of
+            the upstream path following the relay id. A successful write
+            of value is noted in the upstream's cache.
+        """
+        upstream, relay = self.lookup(request.match_info['relay'])
+        try:
+            status, body = await upstream.request(request.method, '/relays/' + relay + path,
+                                                  params=request.query,
+                                                  data=await request.read(),
+                                                  headers=self.upstream_headers(request))
+        except UpstreamError as ex:
+            return ex.response()
+        if status == 200 and value is not None:
+            upstream.written({relay: str(value)})
+        content_type = 'application/json' if status < 400 else 'text/plain'
+        return web.Response(status=status, body=body, content_type=content_type)
+
+    async def set_state_old(self,request):
+        """
+            Relay set value
+        """
+        state = request.match_info['state']
+        return await self.forward(request, '/state/' + state, self.parse_value(state))
+
+    async def set_state(self,request):
+        """
+            Relay set value
+        """
+        return await self.forward(request, '/state/', self.parse_value(await request.read()))
+
+    async def cycle(self,request):
+        """
+            Relay power cycle
+        """
+        wait = self.query_flag(request, 'wait')
+        return await self.forward(request, '/cycle', 1 if wait else 0)
+
+    async def set_states(self,request):
+        """
+            Relay set values of several relays, split by upstream and
+            sent to all of them at once.
+        """
+        try:
+            body = await request.json()
+            assert(isinstance(body, dict) and body)
+        except:
+            raise web.HTTPBadRequest(text="Invalid body, must be a JSON object mapping relays to 0 or 1")
+        states = {ident: self.parse_value(value) for ident, value in body.items()}
+        groups = self.by_upstream(states)
+
+        async def write(upstream, relays):
+            return await upstream.request_json('PUT', '/relays/state', params=request.query,
+                                               headers=self.upstream_headers(request),
+                                               json={relay: states[ident] for relay, ident in relays.items()})
+
+        results = await asyncio.gather(*[write(upstream, relays) for upstream, relays in groups.items()],
+                                       return_exceptions=True)
+        res = dict()
+        for (upstream, relays), result in zip(groups.items(), results):
+            if isinstance(result, UpstreamError):
+                # Unreachable, or rejected as a whole, e.g. for a leased
+                # relay: an error for each of its relays
+                result = {relay: {"status": "error", "error": str(result)} for relay in relays}
+            elif isinstance(result, BaseException):
+                raise result
+            written = dict()
+            for relay, ident in relays.items():
+                res[ident] = result[relay]
+                if result[relay].get("status") == "ok":
+                    written[relay] = str(states[ident])
+            upstream.written(written)
+        return self.json_response(request, {ident: res[ident] for ident in body})
+
+    async def get_upstreams(self,request):
+        """
+            Return the health of every upstream
+        """
+        return self.json_response(request, {upstream.name: upstream.health()
+                                            for upstream in self.upstreams})
@@ -1,56 +1,711 @@
 from aiohttp import web
+import asyncio
+import errno
 import json
+import logging
+import secrets
+import time
 
 from gpiod.line import Value
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from powerrelay.events import EventBroadcaster, encode_event, RESYNC, CLOSE
+from powerrelay.coalesce import WriteQueue
+from powerrelay.executor import GpioExecutor
+from powerrelay.groups import RelayGroup, compile_groups
+from powerrelay.history import History, ORIGIN
+from powerrelay.inputs import InputMonitor
+from powerrelay.leases import LeaseManager, LeaseError
+from powerrelay.metrics import Metrics
+from powerrelay.scheduler import SwitchScheduler, SUPERSEDED
+
+logger = logging.getLogger(__name__)
+
 class RelayController:
     """
         RelayAPI Controller
     """
-    def __init__(self, lines):
+    # Default and maximum off time of a power cycle, in milliseconds
+    CYCLE_OFF_MS = 1000
+    CYCLE_MAX_OFF_MS = 3600 * 1000
+
+    # Seconds between keep-alive comments on idle event streams
+    EVENTS_KEEPALIVE = 15
+
+    # Default and maximum time a '?since=' read waits for a change
+    LONGPOLL_TIMEOUT = 30
+    LONGPOLL_MAX_TIMEOUT = 300
+
+    def __init__(self, lines, cache=False, reconcile=0, executor='chip', workers=4,
+                 metrics=None, journal=None, inrush_spacing=0, inrush_max=0, switch_on=(),
+                 groups=None, inputs=None, lease_max_ttl=3600, history_size=10000):
+        self.set_lines(lines, groups or {})
+        # Pending power cycles, (request, offset) -> (timer, future),
+        # the timer None while switching off, and the tasks switching
+        # the relays back on
+        self.cycles = dict()
+        self.cycle_tasks = set()
+
+        self.events = EventBroadcaster()
+        self.executor = GpioExecutor(executor, workers)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # The lines are outputs owned by us, so with the cache enabled
+        # reads are answered from the last written values. 'reconcile'
+        # is the interval in seconds at which the cache is checked
+        # against the hardware, 0 to only do so on request. The cache
+        # is filled at startup.
+        self.cache = dict() if cache else None
+        self.reconcile = reconcile
+        self.reconcile_task = None
+
+        # Last written or read value of every line, (request, offset) ->
+        # int, to skip writes that would not change anything
+        self.known = dict()
+        # Count of applied writes, and the count at the last write of
+        # every line, to tell reads that raced with a write
+        self.write_count = 0
+        self.written_at = dict()
+        self.write_queue = WriteQueue(self.write_lines, self.known_value, self.writes_skipped, ORIGIN)
+
+        # The last state changes, with the clients that made them
+        self.history = History(history_size)
+
+        # State generation, advanced by every change, and the one of
+        # the last change of every relay, (request, offset) -> int.
+        # ETags carry a per-process epoch, so they don't match after a
+        # restart.
+        self.generation = 0
+        self.generations = dict()
+        self.epoch = secrets.token_hex(4)
+        self.generation_future = None
+
+        # Optional journal of written states, see StateJournal
+        self.journal = journal
+        self.journal_task = None
+
+        # Optional staggering of on-transitions, see SwitchScheduler.
+        # 'switch_on' lists relays to switch on through it at startup.
+        self.scheduler = None
+        if inrush_spacing > 0 or inrush_max > 0:
+            self.scheduler = SwitchScheduler(self.apply_values, inrush_spacing, inrush_max, ORIGIN)
+        self.switch_on = list(switch_on)
+
+        # Relays leased by clients, switched to their safe state when
+        # a lease expires
+        self.leases = LeaseManager(self.lease_expired, lease_max_ttl)
+
+        # Optional input lines, e.g. relay feedback, see InputMonitor
+        self.inputs = None
+        if inputs:
+            self.inputs = InputMonitor(inputs, self.inputs_changed)
+
+    def set_lines(self, lines, groups):
+        """
+            Build the relay indexes for the given lines and compile the
+            groups configuration. They are all built before being
+            swapped in, so a request being served sees either the old or
+            the new relays, never a mix.
+        """
+        # Relay ids, then names and aliases -> (ident, line)
+        relay_index = dict()
+        for ident,line in lines.items():
+            relay_index[ident] = (ident, line)
+        for ident,line in lines.items():
+            for key in (line.name,) + line.aliases:
+                if key:
+                    relay_index.setdefault(key, (ident, line))
+        compiled = compile_groups(groups, relay_index)
+
+        # Any relay or group key -> RelayLine or RelayGroup
+        index = {key: line for key, (ident, line) in relay_index.items()}
+        for name, group in compiled.items():
+            for key in (name,) + group.aliases:
+                index.setdefault(key, group)
+
+        # (request, offset) -> relay id, to report changes by relay id
+        idents = dict()
+        for ident,line in lines.items():
+            idents[(line.request, line.offset)] = ident
+
+        # Constant responses and the /relays/ entries (which only
+        # differ by state) are rendered once, in both encodings.
+        rendered = {
+            'ok': self.render({"status": "ok"}),
+            'changed': self.render({"status": "ok", "changed": True}),
+            'unchanged': self.render({"status": "ok", "changed": False}),
+            'queued': self.render({"status": "queued"}),
+            'superseded': self.render({"status": "superseded"}),
+            'count': self.render({"count": len(lines)}),
+        }
+        listing = []
+        for ident,line in lines.items():
+            # Rendered per (state, feedback value or None if unknown)
+            entries = dict()
+            for state in (0, 1):
+                for feedback in ((None, 0, 1) if line.feedback else (None,)):
+                    d = {'id': ident, 'state': str(state)}
+                    if line.name:
+                        d['name'] = line.name
+                    if feedback is not None:
+                        d['feedback'] = str(feedback)
+                    # Strip the list brackets, keeping the entry indented
+                    pretty = json.dumps([d], indent=2)[2:-2]
+                    entries[(state, feedback)] = (pretty, self.dumps_compact(d).decode())
+            listing.append(((line.request, line.offset), line.feedback, entries))
+
         self.lines = lines
         self.line_count = len(lines)
-        self.by_name = dict()
-        for line in lines.values():
-            name = line.name
-            if name:
-                self.by_name[name] = line
+        self.groups = compiled
+        self.group_config = groups
+        self.index = index
+        self.idents = idents
+        self.rendered = rendered
+        self.listing = listing
+
+    async def update_lines(self, lines, defaults, groups=None):
+        """
+            Switch to a new set of relay lines, and groups if given, e.g.
+            after reloading the configuration, and apply the (line,
+            value) defaults of the added relays.
+        """
+        if self.cache is not None:
+            values = await self.read_hardware(lines.values())
+
+        self.set_lines(lines, self.group_config if groups is None else groups)
+        if self.cache is not None:
+            self.cache = {key: self.cache.get(key, values[key]) for key in self.idents}
+        # Relays getting their default may have a new polarity
+        for line, value in defaults:
+            self.known.pop((line.request, line.offset), None)
+        for key in list(self.known):
+            if key not in self.idents:
+                del self.known[key]
+        for key in list(self.written_at):
+            if key not in self.idents:
+                del self.written_at[key]
+        if self.journal is not None:
+            self.journal.retain(lines)
+        self.events.resync()
+        self.advance()
+
+        errors = await self.write_values(defaults)
+        for ex in errors.values():
+            raise ex
+
+    async def reconfigure_lines(self, request, changes, reconfigure):
+        """
+            Call reconfigure(request, changes) to change the settings of
+            some lines of a request, in turn with the other calls on the
+            request, and with writes to the changed relays held.
+        """
+        keys = [(request, offset) for offset in changes]
+        return await self.write_queue.hold(keys, lambda: self.executor.run(request, reconfigure,
+                                                                           request, changes))
+
+    async def startup(self, app):
+        if self.inputs is not None:
+            await self.inputs.start(lambda request: self.gpio_call('read', request, request.get_values))
+        if self.cache is not None:
+            await self.read_values(self.lines.values(), verify=True)
+            if self.reconcile > 0:
+                self.reconcile_task = asyncio.ensure_future(self.reconcile_periodically())
+        if self.journal is not None:
+            self.journal_task = asyncio.ensure_future(self.journal.run())
+        if self.switch_on:
+            asyncio.ensure_future(self.startup_switch_on([self.lines[ident] for ident in self.switch_on]))
+
+    def lease_expired(self, lease):
+        logger.warning("Lease of %s on relays %s expired", lease.holder or "a client",
+                       ", ".join(lease.lines))
+        asyncio.ensure_future(self.switch_safe(lease, ("", "lease expiry")))
+
+    async def switch_safe(self, lease, origin=None):
+        """
+            Switch the relays of a lease to their safe state.
+        """
+        if origin is not None:
+            ORIGIN.set(origin)
+        # A power cycle of the holder must not switch a relay back on
+        self.cancel_cycles(lease.lines.values(),
+                           "Power cycle of relay '%s' cancelled, its lease ended")
+        # Skip relays removed meanwhile
+        updates = [(line, line.safe) for line in lease.lines.values()
+                   if (line.request, line.offset) in self.idents]
+        errors = await self.write_values(updates)
+        for ex in errors.values():
+            logger.error("Switching leased relays to their safe state failed: %s", ex)
+
+    def check_lease(self, token, lines):
+        """
+            Refuse writing relays leased to someone not holding the
+            given lease token.
+        """
+        for line in lines:
+            holder = self.leases.holder_of(line)
+            if holder is not None and holder != token:
+                raise web.HTTPConflict(text="Relay '%s' is leased" %
+                                       self.idents[(line.request, line.offset)])
+
+    @staticmethod
+    def lease_token(request):
+        return request.headers.get('X-Lease', request.query.get('lease'))
+
+    def inputs_changed(self, changes):
+        self.events.publish({ident: str(value) for ident, value in changes.items()}, "input")
+        self.advance([(line.request, line.offset) for line in self.lines.values()
+                      if line.feedback in changes])
+
+    def feedback(self, line):
+        """
+            The value of a relay's feedback input, None if it has none
+            or it is unknown.
+        """
+        if self.inputs is None or not line.feedback:
+            return None
+        return self.inputs.values.get(line.feedback)
+
+    async def startup_switch_on(self, lines):
+        ORIGIN.set(("", "startup"))
+        errors = await self.write_values([(line, 1) for line in lines])
+        for ex in errors.values():
+            logger.error("Switching relays on at startup failed: %s", ex)
+
+    async def shutdown(self, app):
+        if self.reconcile_task is not None:
+            self.reconcile_task.cancel()
+        if self.journal_task is not None:
+            self.journal_task.cancel()
+        if self.scheduler is not None:
+            self.scheduler.close()
+        if self.inputs is not None:
+            self.inputs.stop()
+        for timer, done in self.cycles.values():
+            if timer is not None:
+                timer.cancel()
+            done.cancel()
+        self.cycles.clear()
+        for task in self.cycle_tasks:
+            task.cancel()
+        self.leases.close()
+        self.events.close()
+
+    async def cleanup(self, app):
+        self.executor.shutdown()
+        if self.journal is not None:
+            self.journal.close()
 
     @classmethod
     def dumps(self, x):
         return json.dumps(x, indent=2) + "\n"
 
+    @staticmethod
+    def dumps_compact(x):
+        if orjson is not None:
+            return orjson.dumps(x)
+        return json.dumps(x, separators=(',', ':')).encode()
+
+    @classmethod
+    def render(self, x):
+        """
+            Return x encoded as (pretty, compact) bytes.
+        """
+        return (self.dumps(x).encode(), self.dumps_compact(x))
+
+    @staticmethod
+    def wants_compact(request):
+        """
+            Pretty printed json is the default, for humans using curl.
+            Clients get compact json by explicitly accepting
+            application/json, or with the 'compact' query parameter.
+        """
+        if 'compact' in request.query:
+            return request.query['compact'] not in ('0', 'false', 'no')
+        return 'application/json' in request.headers.get('Accept', '')
+
     @classmethod
-    def json_response(self, data):
-        return web.json_response(data, dumps=self.dumps)
+    def json_body(self, request, rendered, status=200):
+        """
+            Respond with one of the (pretty, compact) renderings.
+        """
+        body = rendered[1] if self.wants_compact(request) else rendered[0]
+        return web.Response(body=body, status=status, content_type='application/json', charset='utf-8')
+
+    def json_response(self, request, data, headers=None):
+        if self.wants_compact(request):
+            body = self.dumps_compact(data)
+        else:
+            body = self.dumps(data).encode()
+        return web.Response(body=body, content_type='application/json', charset='utf-8',
+                            headers=headers)
+
+    def advance(self, keys=()):
+        """
+            Advance the state generation, for a change of the given
+            relays, (request, offset)s, and wake up waiting readers.
+        """
+        self.generation += 1
+        for key in keys:
+            self.generations[key] = self.generation
+        if self.generation_future is not None:
+            self.generation_future.set_result(None)
+            self.generation_future = None
+
+    def generation_of(self, lines=None):
+        """
+            The generation of the state of the given lines, of all
+            relays if None.
+        """
+        if lines is None:
+            return self.generation
+        return max((self.generations.get((line.request, line.offset), 0) for line in lines), default=0)
+
+    async def wait_generation(self, lines, since, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self.generation_of(lines) == since:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            if self.generation_future is None:
+                self.generation_future = loop.create_future()
+            try:
+                # shield: the future is shared with other readers
+                await asyncio.wait_for(asyncio.shield(self.generation_future), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def versioned(self, request, lines=None):
+        """
+            Handle '?since=<generation>' long-polls and conditional
+            requests for a read of the given lines (all relays if None).
+            Waits for the generation to differ from 'since', for at most
+            'timeout' seconds. Raises 304 Not Modified if the state
+            matches If-None-Match, else returns the ETag and generation
+            headers to respond with.
+        """
+        since = request.query.get('since')
+        if since is not None:
+            try:
+                since = int(since)
+                timeout = float(request.query.get('timeout', self.LONGPOLL_TIMEOUT))
+                assert(timeout >= 0)
+            except (ValueError, AssertionError):
+                raise web.HTTPBadRequest(text="Invalid long-poll, 'since' must be a generation, 'timeout' seconds")
+            await self.wait_generation(lines, since, min(timeout, self.LONGPOLL_MAX_TIMEOUT))
+
+        generation = self.generation_of(lines)
+        etag = "%s-%d" % (self.epoch, generation)
+        headers = {'ETag': '"%s"' % etag, 'X-Generation': str(generation)}
+        if not self.query_flag(request, 'verify'):
+            for match in request.if_none_match or ():
+                if match.value in (etag, '*'):
+                    raise web.HTTPNotModified(headers=headers)
+        return headers
 
     def lookup_line(self, s):
-        # First try if it matches an id given in the config file
-        if s in self.lines:
-            return self.lines[s]
-        if s in self.by_name:
-            return self.by_name[s]
-        raise web.HTTPNotFound(text="Relay '%s' not found" % s)
+        # Relay ids from the config file take precedence over names
+        # and aliases
+        line = self.index.get(s)
+        if line is None or isinstance(line, RelayGroup):
+            raise web.HTTPNotFound(text="Relay '%s' not found" % s)
+        return line
+
+    def lookup_group(self, s):
+        group = self.index.get(s)
+        if not isinstance(group, RelayGroup):
+            raise web.HTTPNotFound(text="Group '%s' not found" % s)
+        return group
+
+    def lookup_lines(self, s):
+        """
+            Return the lines of a relay or group.
+        """
+        target = self.index.get(s)
+        if target is None:
+            raise web.HTTPNotFound(text="Relay '%s' not found" % s)
+        if isinstance(target, RelayGroup):
+            return target.lines
+        return [target]
+
+    @staticmethod
+    def query_flag(request, name, default=False):
+        if name not in request.query:
+            return default
+        return request.query[name] not in ('0', 'false', 'no')
+
+    async def gpio_call(self, op, request, fn, *args):
+        """
+            Run a GPIO call through the executor, timing it.
+        """
+        start = time.perf_counter()
+        try:
+            return await self.executor.run(request, fn, *args)
+        finally:
+            self.metrics.gpio_latency.labels(request.chip_name, op).observe(time.perf_counter() - start)
+
+    async def read_values(self, lines, verify=False):
+        """
+            Read the values of the given lines, doing a single
+            get_values() call per line request, with the requests read
+            in parallel. Returns a dict mapping (request, offset) to the
+            line value. When caching, the cache is returned unless
+            'verify' asks for a hardware read.
+        """
+        if self.cache is not None and not verify:
+            return self.cache
+        values = await self.read_hardware(lines)
+        if self.cache is not None:
+            self.reconcile_values(values)
+        return values
+
+    async def read_hardware(self, lines):
+        """
+            Read the lines from the hardware. A line written while the
+            read was pending may have been read before the write, so it
+            is reported with the written value instead.
+        """
+        requests = list(dict.fromkeys(line.request for line in lines))
+        start = self.write_count
+        results = await asyncio.gather(*[self.gpio_call('read', request, request.get_values)
+                                         for request in requests])
+        values = dict()
+        for request, request_values in zip(requests, results):
+            for offset, value in zip(request.offsets, request_values):
+                key = (request, offset)
+                if self.written_at.get(key, 0) > start and key in self.known:
+                    value = Value(self.known[key])
+                else:
+                    self.known[key] = value.value
+                values[key] = value
+        return values
+
+    async def read_value(self, line, verify=False):
+        values = await self.read_values([line], verify)
+        return values[(line.request, line.offset)]
+
+    def reconcile_values(self, values):
+        """
+            Update the cache from values read from the hardware,
+            publishing any differences.
+        """
+        changes = dict()
+        for key, value in values.items():
+            if key not in self.idents:
+                # Held line of a removed relay
+                continue
+            if self.cache.get(key, value) != value:
+                ident = self.idents[key]
+                logger.warning("Relay %s: cached state %d differs from hardware state %d",
+                               ident, self.cache[key].value, value.value)
+                changes[ident] = str(value.value)
+                self.advance([key])
+            self.cache[key] = value
+        self.events.publish(changes)
+
+    async def reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(self.reconcile)
+            try:
+                await self.read_values(self.lines.values(), verify=True)
+            except OSError as ex:
+                logger.error("Reconciling relay states failed: %s", ex)
+
+    def known_value(self, key):
+        return self.known.get(key)
+
+    def writes_skipped(self, lines):
+        for line in lines:
+            self.metrics.relay_writes_skipped.labels(self.idents[(line.request, line.offset)]).inc()
+
+    async def write_values(self, updates, wait=True, force=False, changed=None, superseded=None):
+        """
+            Apply a list of (line, value) updates. With the switch
+            scheduler enabled, on-transitions are queued and, unless
+            'wait' is false, waited for. Returns a dict mapping each line
+            request that failed, or (request, offset) of a line that
+            failed on its own, to the OSError. The (request, offset) of
+            every line that was switched is added to 'changed', that of
+            every queued on-transition cancelled by a later write to
+            'superseded'.
+        """
+        if self.scheduler is None:
+            return await self.apply_values(updates, force=force, changed=changed)
+
+        immediate = []
+        scheduled = []
+        for line, value in updates:
+            key = (line.request, line.offset)
+            if value and self.known.get(key) != 1:
+                scheduled.append((line, self.scheduler.submit(line)))
+            else:
+                # Already on, or switching off: no inrush
+                self.scheduler.cancel(line)
+                immediate.append((line, value))
+        errors = await self.apply_values(immediate, force=force, changed=changed)
+        if wait:
+            for line, future in scheduled:
+                ex = await future
+                key = (line.request, line.offset)
+                if ex is SUPERSEDED:
+                    if superseded is not None:
+                        superseded.add(key)
+                elif ex is not None:
+                    errors[key] = ex
+                elif changed is not None:
+                    changed.add(key)
+        return errors
+
+    async def apply_values(self, updates, plan=None, force=False, changed=None):
+        """
+            Apply a list of (line, value) updates right away, through
+            the write queue: writes to one relay are serialized, queued
+            ones coalesced, and writes of the known state skipped unless
+            'force' is given. plan is the precompiled write plan of the
+            updates, if any. Returns the errors like write_values().
+        """
+        return await self.write_queue.write(updates, plan, force, changed)
+
+    async def write_lines(self, updates, plan=None):
+        """
+            Write a list of (line, value) updates, doing a single
+            set_values() call per line request, with the requests
+            written in parallel, and publish the changes.
+        """
+        if plan is None:
+            per_request = dict()
+            for line, value in updates:
+                per_request.setdefault(line.request, dict())[line.offset] = Value(value)
+            plan = list(per_request.items())
+        return await self.apply_plan(plan)
+
+    async def apply_plan(self, plan):
+        """
+            Apply a list of (request, {offset: value}) writes, e.g. the
+            precompiled plan of a group. Returns the errors like
+            apply_values().
+        """
+        results = await asyncio.gather(*[self.gpio_call('write', request, request.set_values, offset_values)
+                                         for request, offset_values in plan],
+                                       return_exceptions=True)
+        errors = dict()
+        changes = dict()
+        changed = []
+        self.write_count += 1
+        for (request, offset_values), result in zip(plan, results):
+            if isinstance(result, OSError):
+                errors[request] = result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                for offset, value in offset_values.items():
+                    ident = self.idents[(request, offset)]
+                    changes[ident] = str(value.value)
+                    old = self.known.get((request, offset))
+                    if old != value.value:
+                        self.history.record(ident, old, value.value)
+                        changed.append((request, offset))
+                    self.known[(request, offset)] = value.value
+                    self.written_at[(request, offset)] = self.write_count
+                    self.metrics.relay_writes.labels(ident).inc()
+                    if self.cache is not None:
+                        self.cache[(request, offset)] = value
+        if self.journal is not None and changes:
+            self.journal.record(changes)
+        if changed:
+            self.advance(changed)
+        self.events.publish(changes)
+        if self.inputs is not None:
+            await self.confirm([(self.lines[ident], int(value)) for ident, value in changes.items()],
+                               errors)
+        return errors
+
+    async def confirm(self, written, errors):
+        """
+            Wait for the feedback inputs of the written (line, value)s
+            that ask for confirmation, adding an error for every line
+            whose input did not follow in time.
+        """
+        written = [(line, value) for line, value in written if line.feedback and line.confirm > 0]
+        results = await asyncio.gather(*[self.inputs.wait_for(line.feedback, value, line.confirm)
+                                         for line, value in written])
+        for (line, value), confirmed in zip(written, results):
+            if not confirmed:
+                key = (line.request, line.offset)
+                errors[key] = OSError(errno.ETIMEDOUT, "Relay %s: input %s did not confirm state %d within %gs" %
+                                      (self.idents[key], line.feedback, value, line.confirm))
+
+    @staticmethod
+    def unconfirmed(ex):
+        """
+            Whether a write failed because the relay's feedback input
+            did not confirm it, see confirm().
+        """
+        return isinstance(ex, OSError) and ex.errno == errno.ETIMEDOUT
+
+    async def write_value(self, line, value, wait=True, force=False):
+        """
+            Set a single line, raising the OSError if it fails. Returns
+            whether the line was switched, or None if its queued
+            on-transition was cancelled by a later write.
+        """
+        changed = set()
+        superseded = set()
+        errors = await self.write_values([(line, value)], wait, force, changed, superseded)
+        for ex in errors.values():
+            raise ex
+        if superseded:
+            return None
+        return bool(changed)
+
+    @staticmethod
+    def parse_value(value):
+        # Given as a number or text (a request body), never as a json
+        # float or boolean
+        try:
+            assert(isinstance(value, (int, str, bytes)) and not isinstance(value, bool))
+            value = int(value)
+            assert(0 <= value <= 1)
+        except:
+            raise web.HTTPBadRequest(text="Invalid state, must be 0 or 1")
+        return value
+
+    async def snapshot(self, verify=False):
+        """
+            Return a dict mapping every relay id to its state.
+        """
+        values = await self.read_values(self.lines.values(), verify)
+        return {ident: str(values[(line.request, line.offset)].value)
+                for ident,line in self.lines.items()}
 
     async def relays(self,request):
         """
             Return the lines resources
         """
-        relays = []
-        for ident,line in self.lines.items():
-            d = {'id': ident, 'state': str(line.request.get_values()[0].value)}
-            name = line.name
-            if name:
-                d['name'] =  name
-            relays.append(d)
+        headers = await self.versioned(request)
+        values = await self.read_values(self.lines.values(), self.query_flag(request, 'verify'))
+        compact = self.wants_compact(request)
+        feedback = self.inputs.values if self.inputs is not None else {}
+        entries = [rendered[(values[key].value, feedback.get(feedback_ident))][compact]
+                   for key, feedback_ident, rendered in self.listing]
 
-        return self.json_response(relays)
+        if compact:
+            body = "[" + ",".join(entries) + "]"
+        elif entries:
+            body = "[\n" + ",\n".join(entries) + "\n]\n"
+        else:
+            body = "[]\n"
+        return web.Response(text=body, content_type='application/json', headers=headers)
 
     async def num_relays(self,request):
         """
             Return the number of relays
         """
-        return self.json_response({"count": self.line_count})
+        return self.json_body(request, self.rendered['count'])
 
     async def status(self,request):
         """
@@ -58,11 +713,56 @@ class RelayController:
         """
         ident = request.match_info['relay']
         line = self.lookup_line(ident)
+        headers = await self.versioned(request, [line])
 
-        value = line.request.get_values()[0].value
+        value = await self.read_value(line, self.query_flag(request, 'verify'))
         res = {"relay_id": ident,
-               "status": str(value)}
-        return self.json_response(res)
+               "status": str(value.value)}
+        feedback = self.feedback(line)
+        if feedback is not None:
+            res["feedback"] = str(feedback)
+        return self.json_response(request, res, headers)
+
+    @staticmethod
+    def history_query(request):
+        try:
+            since = request.query.get('since')
+            until = request.query.get('until')
+            limit = request.query.get('limit')
+            limit = None if limit is None else int(limit)
+            if limit is not None and limit < 0:
+                raise ValueError(limit)
+            return dict(since=None if since is None else float(since),
+                        until=None if until is None else float(until),
+                        limit=limit)
+        except ValueError:
+            raise web.HTTPBadRequest(text="Invalid history query, 'since' and 'until' must be unix times, 'limit' a number of at least 0")
+
+    async def relay_history(self,request):
+        """
+            State changes of a relay, oldest first, optionally in a
+            time range given by 'since' and 'until' or the last 'limit'
+            ones.
+        """
+        line = self.lookup_line(request.match_info['relay'])
+        return self.json_response(request, self.history.query(self.idents[(line.request, line.offset)],
+                                                              **self.history_query(request)))
+
+    async def get_history(self,request):
+        """
+            State changes of all relays, or of the 'relay' ones
+        """
+        options = self.history_query(request)
+        idents = request.query.getall('relay', [])
+        if not idents:
+            return self.json_response(request, self.history.query(**options))
+        keys = {self.idents[(line.request, line.offset)]
+                for ident in idents for line in self.lookup_lines(ident)}
+        entries = [entry for entry in self.history.query(since=options['since'], until=options['until'])
+                   if entry['relay'] in keys]
+        if options['limit'] is not None:
+            entries = entries[-options['limit']:] if options['limit'] > 0 else []
+        return self.json_response(request, entries)
 
     async def get_state_old(self,request):
         """
@@ -71,8 +771,10 @@ class RelayController:
         import sys
         ident = request.match_info['relay']
         line = self.lookup_line(ident)
+        headers = await self.versioned(request, [line])
 
-        return self.json_response({"state": str(line.request.get_values()[0].value)})
+        value = await self.read_value(line, self.query_flag(request, 'verify'))
+        return self.json_response(request, {"state": str(value.value)}, headers)
 
     async def get_state(self,request):
         """
@@ -81,8 +783,10 @@ class RelayController:
         import sys
         ident = request.match_info['relay']
         line = self.lookup_line(ident)
+        headers = await self.versioned(request, [line])
 
-        return self.json_response(str(line.request.get_values()[0].value))
+        value = await self.read_value(line, self.query_flag(request, 'verify'))
+        return self.json_response(request, str(value.value), headers)
 
 
     async def set_state_old(self,request):
@@ -92,14 +796,9 @@ class RelayController:
         ident = request.match_info['relay']
         line = self.lookup_line(ident)
 
-        try:
-            value = int(request.match_info['state'])
-            assert(0 <= value <= 1)
-        except:
-            raise web.HTTPBadRequest(text="Invalid state, must be 0 or 1")
+        value = self.parse_value(request.match_info['state'])
 
-        line.request.set_values({line.offset: Value(value)})
-        return self.json_response({"status": "ok"})
+        return await self.set_line(request, line, value)
 
     async def set_state(self,request):
         """
@@ -108,11 +807,385 @@ class RelayController:
         ident = request.match_info['relay']
         line = self.lookup_line(ident)
 
+        value = self.parse_value(await request.content.read())
+
+        return await self.set_line(request, line, value)
+
+    async def set_line(self, request, line, value):
+        """
+            Set a line for a request, which may ask not to wait for a
+            staggered on-transition ('wait=0').
+        """
+        self.check_lease(self.lease_token(request), [line])
+        self.cancel_cycles([line])
         try:
-            value = int(await request.content.read())
-            assert(0 <= value <= 1)
+            changed = await self.write_value(line, value, self.query_flag(request, 'wait', True),
+                                             self.query_flag(request, 'force'))
+        except OSError as ex:
+            if self.unconfirmed(ex):
+                raise web.HTTPGatewayTimeout(text=str(ex))
+            raise
+        if self.scheduler is not None and self.scheduler.is_pending(line):
+            return self.json_body(request, self.rendered['queued'], status=202)
+        if changed is None:
+            return self.json_body(request, self.rendered['superseded'])
+        return self.json_body(request, self.rendered['changed' if changed else 'unchanged'])
+
+    async def get_states(self,request):
+        """
+            Relay get values of several relays, given by repeated
+            'relay' query parameters, or all relays if none are given.
+        """
+        idents = request.query.getall('relay', None)
+        if idents is None:
+            idents = list(self.lines)
+            headers = await self.versioned(request)
+            lines = list(self.lines.values())
+        else:
+            lines = [self.lookup_line(ident) for ident in idents]
+            headers = await self.versioned(request, lines)
+
+        values = await self.read_values(lines, self.query_flag(request, 'verify'))
+        return self.json_response(request, {ident: str(values[(line.request, line.offset)].value)
+                                   for ident, line in zip(idents, lines)}, headers)
+
+    async def set_states(self,request):
+        """
+            Relay set values of several relays, given as a JSON object
+            mapping relay id or name to 0 or 1. Relays on the same chip
+            are switched together.
+        """
+        try:
+            body = await request.json()
+            assert(isinstance(body, dict) and body)
         except:
-            raise web.HTTPBadRequest(text="Invalid state, must be 0 or 1")
+            raise web.HTTPBadRequest(text="Invalid body, must be a JSON object mapping relays to 0 or 1")
+
+        # Validate everything before touching any line
+        updates = []
+        targets = []
+        seen = dict()
+        for ident, value in body.items():
+            lines = self.lookup_lines(ident)
+            value = self.parse_value(value)
+            for line in lines:
+                key = (line.request, line.offset)
+                if seen.setdefault(key, value) != value:
+                    raise web.HTTPBadRequest(text="Conflicting states given for relay '%s'" % ident)
+                updates.append((line, value))
+            targets.append((ident, lines))
+        self.check_lease(self.lease_token(request), [line for line, _ in updates])
+        self.cancel_cycles([line for line, _ in updates])
+
+        changed = set()
+        superseded = set()
+        errors = await self.write_values(updates, self.query_flag(request, 'wait', True),
+                                         self.query_flag(request, 'force'), changed, superseded)
+
+        return self.json_response(request, {ident: self.write_status(lines, errors, changed, superseded)
+                                            for ident, lines in targets})
+
+    def write_status(self, lines, errors, changed, superseded=()):
+        """
+            Status entry of a relay or group after a write.
+        """
+        for line in lines:
+            ex = errors.get((line.request, line.offset), errors.get(line.request))
+            if ex is not None:
+                return {"status": "error", "error": str(ex)}
+        if any((line.request, line.offset) in superseded for line in lines):
+            return {"status": "superseded"}
+        if self.scheduler is not None and any(self.scheduler.is_pending(line) for line in lines):
+            return {"status": "queued"}
+        return {"status": "ok",
+                "changed": any((line.request, line.offset) in changed for line in lines)}
+
+    def lease_info(self, lease, token=False):
+        info = {'holder': lease.holder,
+                'relays': list(lease.lines),
+                'ttl': lease.ttl,
+                'expires_in': round(lease.expires - self.leases.now(), 3)}
+        # The lease id is the token allowing writes, only told its holder
+        if token:
+            info['lease'] = lease.ident
+        return info
+
+    @staticmethod
+    async def lease_body(request):
+        if not await request.read():
+            return dict()
+        try:
+            body = await request.json()
+            assert(isinstance(body, dict))
+        except:
+            raise web.HTTPBadRequest(text="Invalid body, must be a JSON object")
+        return body
+
+    def lease_ttl(self, body, default=None):
+        ttl = body.get('ttl', default)
+        if ttl is None:
+            return None
+        try:
+            assert(isinstance(ttl, (int, float)) and not isinstance(ttl, bool))
+            self.leases.check_ttl(ttl)
+        except (AssertionError, LeaseError):
+            raise web.HTTPBadRequest(text="Invalid ttl, must be more than 0 and at most %g seconds" %
+                                     self.leases.max_ttl)
+        return ttl
+
+    async def acquire_lease(self,request):
+        """
+            Lease relays (or groups), given as {"relays": [...], "ttl":
+            seconds, "holder": "..."}. Writes to them need the returned
+            lease id, in the X-Lease header or 'lease' parameter.
+        """
+        body = await self.lease_body(request)
+        relays = body.get('relays')
+        holder = body.get('holder', "")
+        if not isinstance(relays, list) or not relays or not isinstance(holder, str):
+            raise web.HTTPBadRequest(text="Invalid body, must give a list of relays")
+        ttl = self.lease_ttl(body)
+        if ttl is None:
+            raise web.HTTPBadRequest(text="Invalid body, must give a ttl")
+        lines = dict()
+        for ident in relays:
+            for line in self.lookup_lines(str(ident)):
+                lines[self.idents[(line.request, line.offset)]] = line
+        try:
+            lease = self.leases.acquire(lines, ttl, holder)
+        except LeaseError as ex:
+            raise web.HTTPConflict(text=str(ex))
+        return self.json_response(request, self.lease_info(lease, token=True))
+
+    def lookup_lease(self, request):
+        try:
+            return self.leases.get(request.match_info['lease'])
+        except KeyError:
+            raise web.HTTPNotFound(text="Lease not found, it may have expired")
+
+    async def renew_lease(self,request):
+        """
+            Lease heartbeat: restart the ttl, optionally with a new one.
+        """
+        lease = self.lookup_lease(request)
+        ttl = self.lease_ttl(await self.lease_body(request))
+        self.leases.renew(lease.ident, ttl)
+        return self.json_response(request, self.lease_info(lease, token=True))
+
+    async def release_lease(self,request):
+        """
+            End a lease, switching its relays to their safe state if
+            'safe' is given.
+        """
+        lease = self.lookup_lease(request)
+        self.leases.release(lease.ident)
+        if self.query_flag(request, 'safe'):
+            await self.switch_safe(lease)
+        return self.json_body(request, self.rendered['ok'])
+
+    async def list_leases(self,request):
+        """
+            Return the current leases, without their ids
+        """
+        return self.json_response(request, [self.lease_info(lease)
+                                            for lease in self.leases.leases.values()])
+
+    async def list_inputs(self,request):
+        """
+            Return the input lines and their values
+        """
+        res = []
+        if self.inputs is not None:
+            for ident, line in self.inputs.inputs.items():
+                d = {'id': ident, 'state': str(self.inputs.values.get(ident))}
+                if line.name:
+                    d['name'] = line.name
+                res.append(d)
+        return self.json_response(request, res)
+
+    async def input_status(self,request):
+        """
+            Input value
+        """
+        ident = request.match_info['input']
+        if self.inputs is None or ident not in self.inputs.inputs:
+            raise web.HTTPNotFound(text="Input '%s' not found" % ident)
+        return self.json_response(request, {"input_id": ident,
+                                            "state": str(self.inputs.values.get(ident))})
+
+    async def list_groups(self,request):
+        """
+            Return the groups and their member relays
+        """
+        res = []
+        for name, group in self.groups.items():
+            d = {'id': name, 'relays': group.idents}
+            if group.aliases:
+                d['aliases'] = list(group.aliases)
+            res.append(d)
+        return self.json_response(request, res)
+
+    async def group_status(self,request):
+        """
+            Group status: the state of every member relay, and the
+            group's state if they all agree ("mixed" otherwise)
+        """
+        ident = request.match_info['group']
+        group = self.lookup_group(ident)
+
+        values = await self.read_values(group.lines, self.query_flag(request, 'verify'))
+        states = {member: str(values[(line.request, line.offset)].value)
+                  for member, line in zip(group.idents, group.lines)}
+        status = set(states.values())
+        return self.json_response(request, {"group_id": ident,
+                                            "status": status.pop() if len(status) == 1 else "mixed",
+                                            "relays": states})
+
+    async def set_group_state_old(self,request):
+        """
+            Group set value
+        """
+        group = self.lookup_group(request.match_info['group'])
+        value = self.parse_value(request.match_info['state'])
+        return await self.set_group(request, group, value)
 
-        line.request.set_values({line.offset: Value(value)})
-        return self.json_response({"status": "ok"})
+    async def set_group_state(self,request):
+        """
+            Group set value
+        """
+        group = self.lookup_group(request.match_info['group'])
+        value = self.parse_value(await request.content.read())
+        return await self.set_group(request, group, value)
+
+    async def set_group(self, request, group, value):
+        """
+            Switch all relays of a group, with one set_values() call per
+            chip. Returns the status of every member relay.
+        """
+        self.check_lease(self.lease_token(request), group.lines)
+        self.cancel_cycles(group.lines)
+        updates = [(line, value) for line in group.lines]
+        force = self.query_flag(request, 'force')
+        changed = set()
+        superseded = set()
+        if self.scheduler is None:
+            errors = await self.apply_values(updates, group.plans[value], force, changed)
+        else:
+            errors = await self.write_values(updates, self.query_flag(request, 'wait', True),
+                                             force, changed, superseded)
+        return self.json_response(request, {member: self.write_status([line], errors, changed,
+                                                                      superseded)
+                                            for member, line in zip(group.idents, group.lines)})
+
+    def cancel_cycles(self, lines, reason="Power cycle of relay '%s' cancelled by another write"):
+        """
+            Cancel the pending power cycles of lines, e.g. because they
+            are being written. Their futures are resolved with a
+            conflict error giving reason, formatted with the relay id.
+        """
+        for line in lines:
+            key = (line.request, line.offset)
+            entry = self.cycles.pop(key, None)
+            if entry is not None:
+                timer, done = entry
+                if timer is not None:
+                    timer.cancel()
+                done.set_result(web.HTTPConflict(text=reason % self.idents.get(key, "")))
+
+    def cycle_timer(self, line, done):
+        task = asyncio.ensure_future(self.finish_cycle(line, done))
+        self.cycle_tasks.add(task)
+        task.add_done_callback(self.cycle_tasks.discard)
+
+    async def finish_cycle(self, line, done):
+        """
+            Switch a power cycled relay back on. The future is resolved
+            with the OSError raised by the write, or None on success.
+        """
+        key = (line.request, line.offset)
+        # Cancelled after the timer fired
+        if self.cycles.get(key, (None, None))[1] is not done:
+            return
+        del self.cycles[key]
+        try:
+            await self.write_value(line, 1)
+        except OSError as ex:
+            done.set_result(ex)
+        else:
+            done.set_result(None)
+
+    async def cycle(self,request):
+        """
+            Relay power cycle: switch off now, and back on after
+            'off_ms' milliseconds. Returns once the relay is off,
+            unless 'wait' is given to wait until it is on again.
+        """
+        ident = request.match_info['relay']
+        line = self.lookup_line(ident)
+
+        try:
+            off_ms = int(request.query.get('off_ms', self.CYCLE_OFF_MS))
+            assert(0 <= off_ms <= self.CYCLE_MAX_OFF_MS)
+        except:
+            raise web.HTTPBadRequest(text="Invalid off_ms, must be 0 to %d" % self.CYCLE_MAX_OFF_MS)
+        wait = self.query_flag(request, 'wait')
+
+        self.check_lease(self.lease_token(request), [line])
+
+        # Overlapping cycles are rejected, the first one keeps its timing
+        key = (line.request, line.offset)
+        if key in self.cycles:
+            raise web.HTTPConflict(text="Relay '%s' is already being power cycled" % ident)
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        entry = self.cycles[key] = (None, done)
+
+        try:
+            await self.write_value(line, 0)
+        except OSError as ex:
+            if self.cycles.get(key) is entry:
+                del self.cycles[key]
+            if self.unconfirmed(ex):
+                raise web.HTTPGatewayTimeout(text=str(ex))
+            raise
+
+        # Unless cancelled while switching off
+        if self.cycles.get(key) is entry:
+            self.cycles[key] = (loop.call_later(off_ms / 1000, self.cycle_timer, line, done), done)
+
+        if wait:
+            ex = await asyncio.shield(done)
+            if isinstance(ex, web.HTTPException):
+                raise ex
+            if self.unconfirmed(ex):
+                raise web.HTTPGatewayTimeout(text=str(ex))
+            if ex is not None:
+                raise web.HTTPInternalServerError(text="Relay '%s' failed to switch on: %s" % (ident, ex))
+        return self.json_body(request, self.rendered['ok'])
+
+    async def events_stream(self,request):
+        """
+            Relay state event stream (Server-Sent Events). Sends a
+            'snapshot' event with all states, then a 'change' event for
+            every write.
+        """
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream',
+                                               'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+
+        subscriber = self.events.subscribe()
+        try:
+            data = RESYNC
+            while data is not CLOSE:
+                if data is RESYNC:
+                    data = encode_event("snapshot", await self.snapshot())
+                await response.write(data)
+                try:
+                    data = await asyncio.wait_for(subscriber.get(), self.EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    data = b": keep-alive\n\n"
+        except ConnectionResetError:
+            pass
+        finally:
+            self.events.unsubscribe(subscriber)
+        return response
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Fan out of relay state changes to event stream subscribers.
+"""
+
+import asyncio
+import json
+
+# Markers queued to a subscriber instead of an encoded event
+RESYNC = object()
+CLOSE = object()
+
+def encode_event(event, data):
+    """
+        Encode a Server-Sent Event with a compact single line json payload.
+    """
+    return ("event: %s\ndata: %s\n\n" % (event, json.dumps(data, separators=(',', ':')))).encode()
+
+class Subscriber:
+    """
+        A single event stream client, with a bounded queue of encoded
+        events waiting to be sent.
+    """
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # The client can't keep up. Throw away what it hasn't seen
+            # yet and let it catch up from a fresh snapshot instead.
+            self.replace(RESYNC)
+
+    def replace(self, item):
+        """
+            Drop all queued events and queue the given item instead.
+        """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(item)
+
+    async def get(self):
+        return await self.queue.get()
+
+class EventBroadcaster:
+    """
+        Publish relay state changes to any number of subscribers.
+
+        Each change is encoded once and the same bytes are queued to
+        every subscriber, so publishing never waits for a client.
+    """
+    def __init__(self, queue_size=64):
+        self.queue_size = queue_size
+        self.subscribers = set()
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, changes, event="change"):
+        """
+            Publish a dict mapping relay (or for 'input' events, input)
+            id to its new state.
+        """
+        if not self.subscribers or not changes:
+            return
+        data = encode_event(event, changes)
+        for subscriber in self.subscribers:
+            subscriber.put(data)
+
+    def resync(self):
+        """
+            Have all subscribers start over from a fresh snapshot, e.g.
+            when the set of relays has changed.
+        """
+        for subscriber in self.subscribers:
+            subscriber.replace(RESYNC)
+
+    def close(self):
+        """
+            Ask all subscribers to end their streams.
+        """
+        for subscriber in self.subscribers:
+            subscriber.replace(CLOSE)
+        self.subscribers.clear()
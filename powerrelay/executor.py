@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Running GPIO calls off the event loop.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+EXECUTOR_MODES = ('chip', 'pool', 'inline')
+
+class GpioExecutor:
+    """
+        Run blocking GPIO calls, serialized per chip: calls on the line
+        requests of one chip (relays and inputs) never overlap.
+
+        Modes:
+          chip   - a dedicated thread per chip
+          pool   - a shared pool of 'workers' threads, with a lock per
+                   chip
+          inline - directly on the event loop, for fast memory mapped
+                   GPIO where a thread hand-off costs more than the call
+    """
+    def __init__(self, mode='chip', workers=4):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError("Unknown GPIO executor mode '%s'" % mode)
+        self.mode = mode
+        self.workers = workers
+        self.executors = dict()
+        self.locks = dict()
+        self.pool = None
+
+    async def run(self, request, fn, *args):
+        """
+            Call fn(*args) on behalf of the given line request.
+        """
+        if self.mode == 'inline':
+            return fn(*args)
+
+        loop = asyncio.get_event_loop()
+        chip = request.chip_name
+        if self.mode == 'chip':
+            executor = self.executors.get(chip)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gpio-" + chip)
+                self.executors[chip] = executor
+            return await loop.run_in_executor(executor, fn, *args)
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="gpio")
+        lock = self.locks.get(chip)
+        if lock is None:
+            lock = self.locks[chip] = asyncio.Lock()
+        async with lock:
+            return await loop.run_in_executor(self.pool, fn, *args)
+
+    def shutdown(self):
+        """
+            Wait for pending calls and stop all threads.
+        """
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors.clear()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
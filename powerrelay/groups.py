@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Relay groups, switched as a unit.
+"""
+
+from gpiod.line import Value
+
+class RelayGroup:
+    """
+        A named set of relays, compiled into a write plan per state:
+        the (request, {offset: value}) pairs to pass to set_values(),
+        one per line request. 'idents' and 'lines' list the member
+        relays in configuration order.
+    """
+    def __init__(self, name, idents, lines, aliases=()):
+        self.name = name
+        self.idents = idents
+        self.lines = lines
+        self.aliases = tuple(aliases)
+
+        offsets = dict()
+        for line in lines:
+            offsets.setdefault(line.request, []).append(line.offset)
+        self.plans = {state: [(request, {offset: Value(state) for offset in request_offsets})
+                              for request, request_offsets in offsets.items()]
+                      for state in (0, 1)}
+
+def compile_groups(groups, index):
+    """
+        Compile the groups configuration, resolving members through
+        index (relay id, name or alias -> (ident, line)). Returns a dict
+        mapping group names to RelayGroups.
+    """
+    compiled = dict()
+    for name, cfg in groups.items():
+        # A relay listed twice, e.g. by id and name, is switched once
+        members = dict(index[member] for member in cfg['relays'])
+        compiled[name] = RelayGroup(name, list(members), list(members.values()),
+                                    cfg.get('aliases', ()))
+    return compiled
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+    In-memory history of relay state changes.
+"""
+
+import contextvars
+import time
+
+# Client address and route a relay write comes from, set per request
+ORIGIN = contextvars.ContextVar('origin', default=("", "internal"))
+
+# Old value of a relay whose state was not known
+UNKNOWN = 2
+
+class History:
+    """
+        Ring buffer of the last 'size' relay state changes. The columns
+        are allocated up front and overwritten in place, so memory use
+        stays constant and recording a change allocates next to
+        nothing: relay ids, client addresses and routes are references
+        to existing strings.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.times = [0.0] * size
+        self.relays = [None] * size
+        self.old = bytearray(size)
+        self.new = bytearray(size)
+        self.clients = [None] * size
+        self.routes = [None] * size
+        # Next slot to write, and number of slots in use
+        self.next = 0
+        self.count = 0
+
+    def record(self, relay, old, new, origin=None):
+        """
+            Record relay changing from old (None if unknown) to new.
+        """
+        if self.size == 0:
+            return
+        client, route = ORIGIN.get() if origin is None else origin
+        i = self.next
+        self.times[i] = time.time()
+        self.relays[i] = relay
+        self.old[i] = UNKNOWN if old is None else old
+        self.new[i] = new
+        self.clients[i] = client
+        self.routes[i] = route
+        self.next = (i + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def query(self, relay=None, since=None, until=None, limit=None):
+        """
+            Return the recorded changes, oldest first, optionally only
+            of one relay, in a time range or the last 'limit' ones.
+        """
+        entries = []
+        for n in range(1, self.count + 1):
+            if limit is not None and len(entries) >= limit:
+                break
+            i = (self.next - n) % self.size
+            stamp = self.times[i]
+            if since is not None and stamp < since:
+                break
+            if until is not None and stamp > until:
+                continue
+            if relay is not None and self.relays[i] != relay:
+                continue
+            old = self.old[i]
+            entries.append({'time': stamp,
+                            'relay': self.relays[i],
+                            'old': None if old == UNKNOWN else str(old),
+                            'new': str(self.new[i]),
+                            'client': self.clients[i],
+                            'route': self.routes[i]})
+        entries.reverse()
+        return entries
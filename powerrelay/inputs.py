@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Monitoring of input lines, e.g. relay feedback contacts.
+"""
+
+import asyncio
+import logging
+from dataclasses import dataclass
+
+from gpiod import EdgeEvent
+from gpiod.line_request import LineRequest
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class InputLine:
+    request: LineRequest
+    offset: int
+    name: str
+    # Seconds a new value must be stable for to be taken
+    debounce: float = 0
+
+class InputMonitor:
+    """
+        Track the values of input lines requested with edge detection.
+
+        The fds of the line requests are watched by the event loop, so
+        edges are read as they arrive without a thread per request. A
+        line with a 'debounce' time only takes a new value once no
+        further edge arrived for that long. on_change is called with a
+        dict mapping input ids to their new values.
+    """
+    def __init__(self, inputs, on_change=None):
+        self.inputs = inputs
+        self.on_change = on_change
+        # (request, offset) -> input id
+        self.idents = {(line.request, line.offset): ident for ident, line in inputs.items()}
+        self.requests = list(dict.fromkeys(line.request for line in inputs.values()))
+        self.values = dict()
+        # Last value seen while debouncing, and its timer
+        self.raw = dict()
+        self.timers = dict()
+        # input id -> [(value, future)]
+        self.waiters = dict()
+
+    async def start(self, read):
+        """
+            Read the current values with read(request), a coroutine
+            function returning request.get_values(), and start watching
+            for edges.
+        """
+        loop = asyncio.get_event_loop()
+        for request in self.requests:
+            loop.add_reader(request.fd, self.on_readable, request)
+        for request in self.requests:
+            for offset, value in zip(request.offsets, await read(request)):
+                ident = self.idents[(request, offset)]
+                self.values[ident] = self.raw[ident] = value.value
+
+    def stop(self):
+        loop = asyncio.get_event_loop()
+        for request in self.requests:
+            loop.remove_reader(request.fd)
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for waiters in self.waiters.values():
+            for _, future in waiters:
+                future.cancel()
+        self.waiters.clear()
+
+    def on_readable(self, request):
+        try:
+            events = request.read_edge_events()
+        except OSError as ex:
+            logger.error("Reading edge events of %s failed: %s", request.chip_name, ex)
+            return
+        for event in events:
+            ident = self.idents.get((request, event.line_offset))
+            if ident is not None:
+                self.edge(ident, int(event.event_type == EdgeEvent.Type.RISING_EDGE))
+
+    def edge(self, ident, value):
+        self.raw[ident] = value
+        debounce = self.inputs[ident].debounce
+        if debounce <= 0:
+            self.settle(ident)
+            return
+        timer = self.timers.pop(ident, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[ident] = asyncio.get_event_loop().call_later(debounce, self.settle, ident)
+
+    def settle(self, ident):
+        self.timers.pop(ident, None)
+        value = self.raw[ident]
+        if self.values.get(ident) == value:
+            return
+        self.values[ident] = value
+        waiters = self.waiters.get(ident, [])
+        for waiter in [waiter for waiter in waiters if waiter[0] == value]:
+            waiters.remove(waiter)
+            if not waiter[1].done():
+                waiter[1].set_result(True)
+        if self.on_change is not None:
+            self.on_change({ident: value})
+
+    async def wait_for(self, ident, value, timeout):
+        """
+            Wait for an input to (settle at) the given value. Returns
+            whether it did within timeout seconds.
+        """
+        if self.values.get(ident) == value:
+            return True
+        future = asyncio.get_event_loop().create_future()
+        waiter = (value, future)
+        self.waiters.setdefault(ident, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self.waiters.get(ident, []):
+                self.waiters[ident].remove(waiter)
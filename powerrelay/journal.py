@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Journal of relay states, for restoring them after a restart.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+class StateJournal:
+    """
+        Append-only journal of relay state changes.
+
+        Every write appends a json line mapping relay ids to their new
+        state. Writes only cost a write() syscall; fsync() is batched
+        and done every 'sync_interval' seconds off the event loop. After
+        'compact_after' records the journal is rewritten as a single
+        snapshot of all states.
+    """
+    def __init__(self, path, sync_interval=1.0, compact_after=1000):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self.state = dict()
+        self.fd = None
+        self.records = 0
+        self.dirty = False
+        # Records written while the journal is being compacted
+        self.compacting = False
+        self.pending = []
+
+    def load(self):
+        """
+            Return the last recorded state of every relay. A truncated
+            last record, from a crash while writing it, is ignored, as
+            are records that are not json objects.
+        """
+        state = dict()
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("%s: ignoring truncated record", self.path)
+                        break
+                    if not isinstance(record, dict):
+                        logger.warning("%s: ignoring invalid record", self.path)
+                        continue
+                    state.update(record)
+        except FileNotFoundError:
+            pass
+        return state
+
+    def open(self, state):
+        """
+            Start a new journal holding the given state.
+        """
+        self.state = dict(state)
+        self.fd = self.compact(self.state)
+        self.records = 0
+
+    def compact(self, state):
+        """
+            Atomically replace the journal by a snapshot of the given
+            state. Returns a new file descriptor to append to.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(self.encode(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        dirfd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    @staticmethod
+    def encode(changes):
+        return (json.dumps(changes, separators=(',', ':')) + "\n").encode()
+
+    def record(self, changes):
+        """
+            Record a dict mapping relay ids to their new state. A failed
+            write is logged, not raised: the relays did switch.
+        """
+        self.state.update(changes)
+        data = self.encode(changes)
+        if self.compacting:
+            self.pending.append(data)
+            return
+        self.append(data)
+
+    def append(self, data):
+        try:
+            os.write(self.fd, data)
+        except OSError as ex:
+            logger.error("%s: %s", self.path, ex)
+            # The record may be partly written, rewrite the journal from
+            # the states at the next sync
+            self.records = self.compact_after
+            return
+        self.records += 1
+        self.dirty = True
+
+    def retain(self, idents):
+        """
+            Forget the states of relays not among idents.
+        """
+        for ident in list(self.state):
+            if ident not in idents:
+                del self.state[ident]
+
+    async def run(self):
+        """
+            Sync and compact the journal periodically.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if self.records >= self.compact_after:
+                    await self.compact_journal(loop)
+                if self.dirty:
+                    self.dirty = False
+                    await loop.run_in_executor(None, os.fsync, self.fd)
+            except OSError as ex:
+                logger.error("%s: %s", self.path, ex)
+
+    async def compact_journal(self, loop):
+        self.compacting = True
+        try:
+            fd = await loop.run_in_executor(None, self.compact, dict(self.state))
+            os.close(self.fd)
+            self.fd = fd
+            self.records = 0
+            self.dirty = False
+        finally:
+            self.compacting = False
+            for data in self.pending:
+                self.append(data)
+            self.pending.clear()
+
+    def close(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
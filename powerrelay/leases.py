@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Relay leases, expiring unless renewed.
+"""
+
+import asyncio
+import heapq
+import secrets
+
+class LeaseError(Exception):
+    pass
+
+class Lease:
+    def __init__(self, ident, holder, lines, ttl, expires):
+        self.ident = ident
+        self.holder = holder
+        # relay id -> line
+        self.lines = lines
+        self.ttl = ttl
+        self.expires = expires
+
+class LeaseManager:
+    """
+        Leases of relays held by clients for 'ttl' seconds, renewed by
+        heartbeats. on_expire is called with every lease that expired.
+
+        Expiry times are kept in a heap with a single timer for the
+        earliest one, so any number of leases costs one timer. Renewing
+        pushes a new heap entry; stale entries are skipped when they
+        come up.
+    """
+    def __init__(self, on_expire, max_ttl=3600):
+        self.on_expire = on_expire
+        self.max_ttl = max_ttl
+        self.leases = dict()
+        # (request, offset) -> lease
+        self.owners = dict()
+        self.heap = []
+        self.timer = None
+        self.timer_at = None
+
+    @staticmethod
+    def now():
+        return asyncio.get_event_loop().time()
+
+    def check_ttl(self, ttl):
+        if not 0 < ttl <= self.max_ttl:
+            raise LeaseError("Invalid ttl, must be more than 0 and at most %g seconds" % self.max_ttl)
+
+    def acquire(self, lines, ttl, holder=""):
+        """
+            Lease the given relays (relay id -> line) as a whole, or
+            raise LeaseError if any of them is leased already.
+        """
+        self.check_ttl(ttl)
+        for ident, line in lines.items():
+            owner = self.owners.get((line.request, line.offset))
+            if owner is not None:
+                raise LeaseError("Relay '%s' is leased by %s" % (ident, owner.holder or "another client"))
+        lease = Lease(secrets.token_hex(16), holder, dict(lines), ttl, self.now() + ttl)
+        self.leases[lease.ident] = lease
+        for line in lines.values():
+            self.owners[(line.request, line.offset)] = lease
+        self.schedule(lease)
+        return lease
+
+    def renew(self, ident, ttl=None):
+        lease = self.get(ident)
+        if ttl is not None:
+            self.check_ttl(ttl)
+            lease.ttl = ttl
+        lease.expires = self.now() + lease.ttl
+        self.schedule(lease)
+        return lease
+
+    def get(self, ident):
+        lease = self.leases.get(ident)
+        if lease is None:
+            raise KeyError(ident)
+        return lease
+
+    def release(self, ident):
+        lease = self.leases.pop(ident)
+        for line in lease.lines.values():
+            key = (line.request, line.offset)
+            if self.owners.get(key) is lease:
+                del self.owners[key]
+        return lease
+
+    def holder_of(self, line):
+        lease = self.owners.get((line.request, line.offset))
+        return None if lease is None else lease.ident
+
+    def schedule(self, lease):
+        heapq.heappush(self.heap, (lease.expires, lease.ident))
+        if self.timer_at is None or lease.expires < self.timer_at:
+            self.arm(lease.expires)
+
+    def arm(self, when):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer_at = when
+        self.timer = asyncio.get_event_loop().call_at(when, self.expire)
+
+    def expire(self):
+        self.timer = self.timer_at = None
+        now = self.now()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expires, ident = heapq.heappop(self.heap)
+            lease = self.leases.get(ident)
+            # Skip entries of released or since renewed leases
+            if lease is not None and lease.expires == expires:
+                expired.append(self.release(ident))
+        # Drop stale entries at the top, then wait for the next expiry
+        while self.heap and self.heap[0][1] not in self.leases:
+            heapq.heappop(self.heap)
+        if self.heap:
+            self.arm(self.heap[0][0])
+        for lease in expired:
+            self.on_expire(lease)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = self.timer_at = None
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Listening sockets for the HTTP server: TCP 'host:port' addresses
+    and 'unix:/path' sockets.
+"""
+
+import errno
+import grp
+import os
+import socket
+import stat
+
+def parse_address(address):
+    """
+        Return ('unix', path) or ('tcp', (host, port)) for a listen
+        address. IPv6 hosts are given in brackets, '[::1]:80'.
+    """
+    if address.startswith('unix:'):
+        path = address[5:]
+        if not path:
+            raise ValueError("Missing socket path in listen address '%s'" % address)
+        return 'unix', path
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid listen address '%s', must be host:port or unix:path" % address)
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    return 'tcp', (host or '0.0.0.0', int(port))
+
+def remove_stale_socket(path):
+    """
+        Remove a unix socket left behind by a server that is gone,
+        refusing to take over one that is still served.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError(errno.EEXIST, "%s exists and is not a socket" % path)
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, "%s is in use by another server" % path)
+
+def unix_socket(path, mode=None, group=None):
+    """
+        Bind a unix socket, only accessible to us until its 'mode' and
+        'group' are applied.
+    """
+    remove_stale_socket(path)
+    gid = -1
+    if group is not None:
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            raise OSError(errno.EINVAL, "%s: unknown group '%s'" % (path, group)) from None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        umask = os.umask(0o177)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(umask)
+        if group is not None:
+            os.chown(path, -1, gid)
+        if mode is not None:
+            os.chmod(path, mode)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def listen_sockets(listen):
+    """
+        Bind the sockets of a list of listen settings ({'address', and
+        for unix sockets optionally 'mode' and 'group'}). Returns the
+        sockets and the paths of the unix sockets, to remove on exit.
+    """
+    sockets = []
+    paths = []
+    try:
+        for entry in listen:
+            kind, address = parse_address(entry['address'])
+            if kind == 'unix':
+                sockets.append(unix_socket(address, entry.get('mode'), entry.get('group')))
+                paths.append(address)
+            else:
+                family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+                sockets.append(socket.create_server(address, family=family))
+    except (OSError, ValueError):
+        for sock in sockets:
+            sock.close()
+        for path in paths:
+            os.unlink(path)
+        raise
+    return sockets, paths
@@ -11,185 +11,696 @@
 #
 #   python3 -m powerrelay.main run ./config.yaml
 
+import time
+
+# Start of the --timing startup report
+STARTED = time.perf_counter()
+
+# Only what is needed to set the relays is imported here: aiohttp, the
+# configuration rules (trafaret, yaml) and asyncio are imported once
+# the relays are set, see run().
 import sys
-import asyncio
 import logging
 import click
 import errno
 import os
+import dataclasses
 from dataclasses import dataclass
 
-import trafaret_config as traf_cfg
-import trafaret as t
-
-from aiohttp import web
-
 import gpiod
 
-from gpiod.line import Direction, Value
+from gpiod.line import Bias, Direction, Edge, Value
 from gpiod.line_request import LineRequest
-from gpiod.chip import Chip
-
-from . import routes
-
-CONFIG_TRAFARET = t.Dict(
-    {
-        t.Key("host"): t.String(),
-        t.Key("port"): t.Int(),
-        t.Key("relays"): t.Mapping(
-            t.String(),
-            t.Dict(
-                {
-                    t.Key("chip", optional=True): t.String(),
-                    t.Key("line", optional=True): t.Int(),
-                    t.Key("name", optional=True): t.String(),
-                    t.Key("active", optional=True, default='high'): t.Enum('high', 'low'),
-                    t.Key("default", optional=True, default=0): t.Int(),
-                }
-            )
-        ),
-    }
-)
+
+from .backends import get_backend
+from .config import ConfigError, load_config, read_config
+from .listen import parse_address, listen_sockets
+
+logger = logging.getLogger(__name__)
+
+BIASES = {
+    'as-is': Bias.AS_IS,
+    'disabled': Bias.DISABLED,
+    'pull-up': Bias.PULL_UP,
+    'pull-down': Bias.PULL_DOWN,
+}
 
 class TrafaretYaml(click.Path):
     """
-        Configuration read from YAML file checked against trafaret rules.
+        Configuration read from YAML file checked against the named
+        trafaret rules of the schema module.
     """
     name = "trafaret yaml file"
 
-    def __init__(self, trafaret):
-        self.trafaret = trafaret
+    def __init__(self, schema):
+        self.schema = schema
         super().__init__(
             exists=True, file_okay=True, dir_okay=False, readable=True)
 
     def convert(self, value, param, ctx):
         cfg_file = super().convert(value, param, ctx)
+        if ctx is not None:
+            # Remember where the configuration came from, for reloading
+            ctx.meta['powerrelay.config_file'] = cfg_file
         try:
-            return traf_cfg.read_and_validate(cfg_file, self.trafaret)
-        except traf_cfg.ConfigError as e:
-            msg = "\n".join(str(err) for err in e.errors)
-            self.fail("\n" + msg)
+            return read_config(cfg_file, self.schema)
+        except ConfigError as e:
+            self.fail("\n" + "\n".join(e.errors))
+
+class StartupTimer:
+    """
+        Report the time every phase of starting the server took on
+        stderr, for 'run --timing'. The first phase starts when this
+        module starts loading.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.last = STARTED
+
+    def phase(self, name, detail=""):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        print("startup: %-14s %8.1f ms  (%7.1f ms total)%s" %
+              (name, (now - self.last) * 1000, (now - STARTED) * 1000, "  " + detail if detail else ""),
+              file=sys.stderr)
+        self.last = now
 
 @dataclass
 class RelayLine:
     request: LineRequest
     offset: int
     name: str
+    # Inrush group, see SwitchScheduler
+    group: str = ""
+    aliases: tuple = ()
+    # Input confirming the state, and seconds to wait for it
+    feedback: str = ""
+    confirm: float = 0
+    # State on lease expiry
+    safe: int = 0
 
-def validate_relays(relays):
+def validate_relays(relays, kind="Relay"):
     """
-        Validate that each relay specifies either chip,line or name
+        Validate that each relay (or input) specifies either chip,line
+        or name
     """
     for ident,cfg in relays.items():
         has_chip_line = "chip" in cfg and "line" in cfg
         has_name = "name" in cfg
         if has_chip_line and has_name:
-            return (False, "Relay %s: cannot specify both GPIO name and chip name+line number" % ident)
+            return (False, "%s %s: cannot specify both GPIO name and chip name+line number" % (kind, ident))
         if not has_chip_line and not has_name:
-            return (False, "Relay %s: must specify either GPIO name or chip name+line number" % ident)
+            return (False, "%s %s: must specify either GPIO name or chip name+line number" % (kind, ident))
+    return (True, None)
+
+def validate_inputs(inputs, relays):
+    """
+        Validate the inputs, and that relay feedback refers to them
+    """
+    valid, error = validate_relays(inputs, "Input")
+    if not valid:
+        return (valid, error)
+    for ident,cfg in relays.items():
+        if 'feedback' in cfg and cfg['feedback'] not in inputs:
+            return (False, "Relay %s: no such feedback input '%s'" % (ident, cfg['feedback']))
+        if cfg.get('confirm') and 'feedback' not in cfg:
+            return (False, "Relay %s: confirm needs a feedback input" % ident)
+    return (True, None)
+
+def validate_groups(groups, relays):
+    """
+        Validate that group members are known relays and that relay
+        ids, names and aliases and group names and aliases are unique
+    """
+    known = dict()
+    def claim(key, owner):
+        if key in known and known[key] != owner:
+            return "'%s' of %s is already used by %s" % (key, owner, known[key])
+        known[key] = owner
+
+    for ident,cfg in relays.items():
+        owner = "relay %s" % ident
+        for key in [ident, cfg.get('name')] + list(cfg.get('aliases', [])):
+            if key is not None:
+                error = claim(key, owner)
+                if error:
+                    return (False, error)
+    members = dict(known)
+    for name,cfg in groups.items():
+        owner = "group %s" % name
+        for key in [name] + list(cfg.get('aliases', [])):
+            error = claim(key, owner)
+            if error:
+                return (False, error)
+        for member in cfg['relays']:
+            if member not in members:
+                return (False, "Group %s: no such relay '%s'" % (name, member))
     return (True, None)
 
-# If the gpio name is set, we need to browse through all
-# gpiochip devices and (hopefully) find the device. For
-# unknown reasons, the ability "find_line" ability has been
-# removed in libgpiod 2.0.
-# If the chipname is set, it becomes quite easy, since we can
-# just use the chipname and offset directly
-def cfg_to_gpiochip_and_offset(cfg):
+class GpioLookupError(LookupError):
+    """
+        A relay GPIO name could not be resolved to a single line.
+    """
+
+class GpioNameIndex:
+    """
+        Index of GPIO line names across all gpiochips of a backend.
+
+        The ability to look up a line by name has been removed from
+        libgpiod 2.0, so we browse through all gpiochip devices once and
+        record every named line. Names found on more than one line are
+        kept, so lookups can report them as ambiguous.
+    """
+    def __init__(self, backend):
+        self.names = dict()
+        for chip, offset, name in backend.line_names():
+            self.names.setdefault(name, []).append((chip, offset))
+
+    def lookup(self, name):
+        """
+            Return the (chip name, offset) carrying the given line name.
+        """
+        locations = self.names.get(name)
+        if not locations:
+            raise GpioLookupError("No such GPIO: '%s'" % name)
+        if len(locations) > 1:
+            where = ", ".join("%s line %d" % loc for loc in locations)
+            raise GpioLookupError("Ambiguous GPIO name '%s': found on %s" % (name, where))
+        return locations[0]
+
+# If the chipname is set, it becomes quite easy, since we can just use
+# the chipname and offset directly. Otherwise the gpio name is looked
+# up in the index.
+def cfg_to_gpiochip_and_offset(cfg, index):
     if 'name' in cfg:
-        name = cfg['name']
-        for entry in os.scandir("/dev/"):
-            if gpiod.is_gpiochip_device(entry.path):
-                with gpiod.Chip(entry.path) as chip:
-                    try:
-                        offset = chip.line_offset_from_id(name)
-                    except:
-                        continue
-                    if offset is not None:
-                        return chip.get_info().name, offset
-        raise Exception("No such GPIO")
+        return index.lookup(cfg['name'])
     else:
         return cfg['chip'], cfg['line']
 
-# I'm tired of my terminal getting messed up when testing using 'curl -v -X GET ...'
-@web.middleware
-async def terminate_exception_body_by_newline(request, handler):
+def resolve_relays(relays, backend, kind="Relay"):
+    """
+        Resolve every relay (or input) to its (chip name, offset),
+        scanning the gpiochips at most once.
+    """
+    index = None
+    if any('name' in cfg for cfg in relays.values()):
+        index = GpioNameIndex(backend)
+    resolved = dict()
+    for ident,cfg in relays.items():
+        try:
+            resolved[ident] = cfg_to_gpiochip_and_offset(cfg, index)
+        except GpioLookupError as ex:
+            raise GpioLookupError("%s %s: %s" % (kind, ident, ex)) from None
+    return resolved
+
+class ChipRequest:
+    """
+        The line request of the relays of a chip. Adding lines replaces
+        the underlying line request by one holding all of them, as a
+        request can't grow, while the relays' lines keep referring to
+        this one.
+    """
+    def __init__(self, backend, chip, config):
+        self.backend = backend
+        self.request = backend.request_lines(chip, config, consumer="PowerRelay")
+
+    @property
+    def chip_name(self):
+        return self.request.chip_name
+
+    @property
+    def offsets(self):
+        return self.request.offsets
+
+    def get_values(self, *args):
+        return self.request.get_values(*args)
+
+    def set_values(self, values):
+        self.request.set_values(values)
+
+    def reconfigure_lines(self, config):
+        self.request.reconfigure_lines(config)
+
+    def rerequest(self, config, old):
+        """
+            Request the lines of config in place of the current ones,
+            requesting the old config again if that fails.
+        """
+        chip = self.request.chip_name
+        self.request.release()
+        try:
+            self.request = self.backend.request_lines(chip, config, consumer="PowerRelay")
+        except OSError:
+            self.request = self.backend.request_lines(chip, old, consumer="PowerRelay")
+            raise
+
+    def release(self):
+        self.request.release()
+
+class RelayLineManager:
+    """
+        Owner of the line requests of all relays.
+
+        Lines are requested with a single line request per gpiochip
+        shared by all relays on that chip. When the relay configuration
+        changes, only the lines of added, removed or changed relays are
+        touched; the lines of all other relays keep their state.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.relays = dict()
+        self.resolved = dict()
+        self.lines = dict()
+        # ChipRequest -> {offset: LineSettings} of every line it holds,
+        # one per chip. A line of a removed relay stays held (at its last
+        # state) for as long as its request is shared with other relays.
+        self.requests = dict()
+
+    @staticmethod
+    def line_settings(cfg, state=0):
+        # Requested at the state they start in, so they don't glitch
+        # until it is set
+        return gpiod.LineSettings(direction=Direction.OUTPUT, active_low=cfg['active'] == 'low',
+                                  output_value=Value(state))
+
+    @staticmethod
+    def relay_line(request, offset, cfg):
+        return RelayLine(request, offset, cfg.get('name', ""), cfg.get('inrush_group', ""),
+                         tuple(cfg.get('aliases', ())), cfg.get('feedback', ""),
+                         cfg.get('confirm', 0), cfg.get('safe', 0))
+
+    def update(self, relays, states=None, reconfigure=None):
+        """
+            Request, reconfigure and release lines to match the given
+            relay configuration. Returns the new lines and the ids of the
+            relays that were added or changed, which still need to be
+            set to their default. New lines are requested at the given
+            state of their relay, else its default. Lines are added to
+            or changed on the request held for their chip by
+            reconfigure(request, changes), defaulting to the
+            reconfigure() method.
+        """
+        if reconfigure is None:
+            reconfigure = self.reconfigure
+        if states is None:
+            states = dict()
+        # Resolve every relay first, keeping the order of the
+        # configuration file.
+        resolved = resolve_relays(relays, self.backend)
+        used = dict()
+        for ident,key in resolved.items():
+            if key in used:
+                raise OSError(errno.EBUSY, "Relay %s: %s line %d already used by relay %s" %
+                              (ident, key[0], key[1], used[key]))
+            used[key] = ident
+
+        held = {(request.chip_name, offset): request
+                for request, settings in self.requests.items() for offset in settings}
+        chips = {request.chip_name: request for request in self.requests}
+
+        lines = dict()
+        added = []
+        new_requests = dict()
+        changed = dict()
+        for ident,cfg in relays.items():
+            gpiochip, offset = key = resolved[ident]
+            settings = self.line_settings(cfg, states.get(ident, cfg['default']))
+            old = self.relays.get(ident)
+            if old is not None and self.resolved[ident] == key and old['active'] == cfg['active']:
+                lines[ident] = self.relay_line(self.lines[ident].request, offset, cfg)
+                continue
+            added.append(ident)
+            request = held.get(key)
+            if request is None and gpiochip in chips:
+                # Added to the chip's request
+                request = chips[gpiochip]
+                changed.setdefault(request, dict())[offset] = settings
+                lines[ident] = self.relay_line(request, offset, cfg)
+            elif request is None:
+                # Group new lines by chip, to be requested together
+                new_requests.setdefault(gpiochip, dict())[offset] = settings
+            else:
+                if self.requests[request][offset].active_low != settings.active_low:
+                    changed.setdefault(request, dict())[offset] = settings
+                lines[ident] = self.relay_line(request, offset, cfg)
+
+        requested = dict()
+        try:
+            for gpiochip, config in new_requests.items():
+                requested[gpiochip] = ChipRequest(self.backend, gpiochip, config)
+        except OSError:
+            for request in requested.values():
+                request.release()
+            raise
+        for gpiochip, request in requested.items():
+            self.requests[request] = new_requests[gpiochip]
+        for ident in added:
+            if ident not in lines:
+                gpiochip, offset = resolved[ident]
+                lines[ident] = self.relay_line(requested[gpiochip], offset, relays[ident])
+
+        for request, changes in changed.items():
+            reconfigure(request, changes)
+
+        self.relays = relays
+        self.resolved = resolved
+        self.lines = lines
+        return lines, added
+
+    def release_unused(self):
+        """
+            Release the requests no longer holding any relay's line.
+            Done separately from update(), once the new lines are in
+            use, so requests being served never hit a released line.
+        """
+        used = set(self.resolved.values())
+        for request, settings in list(self.requests.items()):
+            if not any((request.chip_name, offset) in used for offset in settings):
+                request.release()
+                del self.requests[request]
+
+    def reconfigure(self, request, changes):
+        """
+            Change the settings of some lines of a request, or add lines
+            to it. All lines of a request are reconfigured at once, so
+            the other lines are given their current value to keep them
+            from changing. Added lines start at their output value.
+        """
+        current = dict(zip(request.offsets, request.get_values()))
+        old = {offset: dataclasses.replace(settings, output_value=current[offset])
+               for offset, settings in self.requests[request].items()}
+        config = dict(old)
+        for offset, settings in changes.items():
+            if offset in current:
+                settings = dataclasses.replace(settings, output_value=current[offset])
+            config[offset] = settings
+        if len(config) == len(old):
+            request.reconfigure_lines(config)
+        else:
+            request.rerequest(config, old)
+        self.requests[request] = config
+
+def request_relay_lines(relays, backend):
+    """
+        Request the GPIO lines of all relays, using a single line
+        request per gpiochip shared by all relays on that chip.
+    """
+    lines, _ = RelayLineManager(backend).update(relays)
+    return lines
+
+def request_input_lines(inputs, backend):
+    """
+        Request the input lines with edge detection, one line request
+        per gpiochip. Returns a dict mapping input ids to InputLines.
+    """
+    resolved = resolve_relays(inputs, backend, "Input")
+    configs = dict()
+    for ident,(gpiochip, offset) in resolved.items():
+        cfg = inputs[ident]
+        configs.setdefault(gpiochip, dict())[offset] = gpiod.LineSettings(
+            direction=Direction.INPUT, edge_detection=Edge.BOTH,
+            active_low=cfg['active'] == 'low', bias=BIASES[cfg['bias']])
+
+    requested = dict()
     try:
-        response = await handler(request)
-        return response
-    except web.HTTPException as ex:
-        text = ex.text
-        if isinstance(text, str):
-            if not text.endswith("\n"):
-                ex.text = text + "\n"
-        raise ex
+        for gpiochip, config in configs.items():
+            requested[gpiochip] = backend.request_lines(gpiochip, config, consumer="PowerRelay")
+    except OSError:
+        for request in requested.values():
+            request.release()
+        raise
+    from .inputs import InputLine
+
+    return {ident: InputLine(requested[gpiochip], offset, inputs[ident].get('name', ""),
+                             inputs[ident]['debounce'])
+            for ident,(gpiochip, offset) in resolved.items()}
+
+def get_config_backend(config):
+    """
+        Instantiate the GPIO backend selected in the configuration.
+    """
+    gpio = config['gpio']
+    if gpio['backend'] == 'simulator':
+        return get_backend('simulator', **gpio['simulator'])
+    return get_backend(gpio['backend'])
+
+def startup_states(relays, saved):
+    """
+        Return the state each relay starts in: its saved state if it is
+        configured to be restored and one was saved, else its default.
+    """
+    states = dict()
+    for ident,cfg in relays.items():
+        states[ident] = cfg['default']
+        if cfg.get('startup') == 'restore' and ident in saved:
+            if saved[ident] in ("0", "1"):
+                states[ident] = int(saved[ident])
+            else:
+                logger.warning("Relay %s: invalid saved state %r, starting in state %d",
+                               ident, saved[ident], cfg['default'])
+    return states
+
+def inrush_states(relays, saved, states):
+    """
+        Split the startup states for inrush limiting: return the states
+        to request the lines at, and the relays to switch on staggered.
+        Relays restored on were on before the restart and stay on, the
+        others start off.
+    """
+    initial = dict()
+    switch_on = []
+    for ident,state in states.items():
+        restored = relays[ident].get('startup') == 'restore' and saved.get(ident) == str(state)
+        initial[ident] = state if restored else 0
+        if state and not restored:
+            switch_on.append(ident)
+    return initial, switch_on
+
+def set_relay_defaults(lines, relays, states=None):
+    """
+        Drive every relay to its configured default, or the given
+        state, with one set_values() call per line request.
+    """
+    if states is None:
+        states = {ident: cfg['default'] for ident,cfg in relays.items()}
+    values = dict()
+    for ident,line in lines.items():
+        values.setdefault(line.request, dict())[line.offset] = Value(states[ident])
+    for request, offset_values in values.items():
+        request.set_values(offset_values)
+
+# Names that moved out of this module, still reachable through it
+MOVED = {
+    'CONFIG_TRAFARET': 'schema',
+    'terminate_exception_body_by_newline': 'app',
+}
+
+def __getattr__(name):
+    if name in MOVED:
+        import importlib
+
+        return getattr(importlib.import_module('.' + MOVED[name], __package__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 @click.group()
 def powerrelay():
     pass
 
 @powerrelay.command()
-@click.argument("config", type=TrafaretYaml(CONFIG_TRAFARET))
-def validate(config):
+@click.option("--check-names", is_flag=True,
+              help="Also check that GPIO names resolve on this system.")
+@click.argument("config", type=TrafaretYaml('CONFIG_TRAFARET'))
+def validate(config, check_names):
     """
         Validate configuration file structure.
     """
-    valid, error = validate_relays(config['relays'])
-    if not valid:
-        click.echo("Error: Configuration invalid: {}".format(error))
-    else:
-        click.echo("OK: Configuration is valid.")
+    relays = config['relays']
+    for valid, error in (validate_relays(relays), validate_groups(config['groups'], relays),
+                         validate_inputs(config['inputs'], relays)):
+        if not valid:
+            click.echo("Error: Configuration invalid: {}".format(error))
+            return
+
+    if check_names:
+        # Only looks at the line info, no lines are requested
+        index = GpioNameIndex(get_config_backend(config))
+        errors = []
+        for ident,cfg in relays.items():
+            if 'name' in cfg:
+                try:
+                    index.lookup(cfg['name'])
+                except GpioLookupError as ex:
+                    errors.append("Relay %s: %s" % (ident, ex.args[0]))
+        if errors:
+            for error in errors:
+                click.echo("Error: Configuration invalid: {}".format(error))
+            return
+
+    click.echo("OK: Configuration is valid.")
+
+def check_listen(ctx, param, value):
+    for address in value:
+        try:
+            parse_address(address)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex))
+    return [{'address': address} for address in value]
 
 @powerrelay.command()
-@click.argument("config", type=TrafaretYaml(CONFIG_TRAFARET))
-def run(config):
+@click.option("--listen", multiple=True, callback=check_listen, metavar="ADDRESS",
+              help="Listen on host:port or unix:path instead of the configured addresses, "
+                   "may be repeated.")
+@click.option("--config-cache/--no-config-cache", default=True, show_default=True,
+              help="Reuse the validated configuration of an earlier start, see POWERRELAY_CACHE_DIR.")
+@click.option("--timing", is_flag=True, help="Report the time of every startup phase on stderr.")
+@click.argument("config_file", metavar="CONFIG", type=click.Path(exists=True, dir_okay=False))
+def run(config_file, listen, config_cache, timing):
     """
         PowerRelay
     """
+    timer = StartupTimer(timing)
+    timer.phase("imports")
     try:
+        try:
+            config, cached = load_config(config_file, cache=config_cache)
+        except ConfigError as ex:
+            print("\n".join(ex.errors), file=sys.stderr)
+            sys.exit(1)
+        timer.phase("config", "cached" if cached else "validated")
+
         host = config["host"]
         port = config["port"]
         relays = config["relays"]
 
         # validate relay mapping
-        validate_relays(relays)
+        for valid, error in (validate_relays(relays), validate_groups(config['groups'], relays),
+                             validate_inputs(config['inputs'], relays)):
+            if not valid:
+                print(error, file=sys.stderr)
+                sys.exit(1)
 
         logging.basicConfig(level=logging.ERROR)
 
-        # setup application and extensions
-        app = web.Application(middlewares=[terminate_exception_body_by_newline])
+        # Restore the journaled states of the relays configured so
+        journal = None
+        saved = dict()
+        if 'journal' in config['state']:
+            from .journal import StateJournal
+
+            journal = StateJournal(config['state']['journal'], config['state']['sync_interval'])
+            saved = journal.load()
+        states = startup_states(relays, saved)
+
+        # With inrush limiting, relays start off and are switched on
+        # staggered once we're up
+        initial, switch_on = states, []
+        if config['inrush']['spacing'] > 0 or config['inrush']['max_simultaneous'] > 0:
+            initial, switch_on = inrush_states(relays, saved, states)
 
         # setup gpio line instances
-        lines = dict()
-        for ident,cfg in relays.items():
-            gpiochip, offset = cfg_to_gpiochip_and_offset(cfg)
-            if cfg['active'] == 'low':
-                active_low=True
-            else:
-                active_low=False
-            gpiochip_path = "/dev/" + gpiochip
-            request = gpiod.request_lines(gpiochip_path, consumer="PowerRelay", config={tuple([offset]): gpiod.LineSettings(direction=Direction.OUTPUT, active_low=active_low)})
-            chip = gpiod.Chip(gpiochip_path)
-            linename=""
-            if 'name' in cfg:
-                linename=cfg['name']
-            lines[ident] = RelayLine(request, offset, linename)
+        manager = RelayLineManager(get_config_backend(config))
+        lines, _ = manager.update(relays, initial)
+        timer.phase("gpio request")
 
         # Only set the defaults when we've succesfully requested all lines.
-        for ident in lines:
-            lines[ident].request.set_values({lines[ident].offset: Value(relays[ident]['default'])})
+        set_relay_defaults(lines, relays, initial)
+        timer.phase("defaults")
+        if journal is not None:
+            journal.open({ident: str(state) for ident,state in states.items()})
+        inputs = request_input_lines(config['inputs'], manager.backend)
 
-        # setup routes
-        routes.setup_routes(app, lines)
+        # setup application, extensions and routes
+        from aiohttp import web
+        from .app import ConfigReloader, make_app
 
-        web.run_app(app, host=host, port=port)
+        timer.phase("app import")
+        reloader = ConfigReloader(config_file, config, manager)
+        app = make_app(config, lines, reloader, journal, switch_on, inputs)
+        timer.phase("app setup")
 
-    except OSError as ex:
+        async def started(app):
+            timer.phase("app startup")
+        app.on_startup.append(started)
+
+        listen = listen or config.get('listen')
+        if listen:
+            sockets, paths = listen_sockets(listen)
+            try:
+                web.run_app(app, sock=sockets)
+            finally:
+                for path in paths:
+                    os.unlink(path)
+        else:
+            web.run_app(app, host=host, port=port)
+
+    except (OSError, GpioLookupError) as ex:
         print(str(ex), file=sys.stderr)
         sys.exit(1)
-    except traf_cfg.ConfigError as ex:
-        ex.output()
-        sys.exit(1)
+
+@powerrelay.command()
+@click.argument("config", type=TrafaretYaml('PROXY_TRAFARET'))
+def proxy(config):
+    """
+        Serve the relays of several powerrelay servers as one.
+    """
+    from aiohttp import web
+    from .app import make_proxy_app
+
+    logging.basicConfig(level=logging.ERROR)
+    web.run_app(make_proxy_app(config), host=config['host'], port=config['port'])
+
+@powerrelay.command()
+@click.option("--url", help="Benchmark a running server instead of a simulated one.")
+@click.option("--control", metavar="HOST:PORT", help="Control protocol address of the running server.")
+@click.option("--transport", "transports", multiple=True,
+              type=click.Choice(['http', 'control', 'naive', 'client']),
+              help="Transport to benchmark, may be repeated: keep-alive HTTP, the control protocol, "
+                   "HTTP with a connection per request, or powerrelay.client. Default: http and, "
+                   "if available, control.")
+@click.option("--workload", "workloads", multiple=True,
+              help="Workload to run (list, status, get, set, mixed), may be repeated. Default: all.")
+@click.option("-c", "--concurrency", "concurrencies", multiple=True, type=int, default=[1, 16],
+              show_default=True, help="Number of concurrent clients, may be repeated.")
+@click.option("-n", "--requests", default=2000, show_default=True, help="Requests per run.")
+@click.option("--duration", type=float, help="Run for this many seconds instead of a number of requests.")
+@click.option("--relays", default=32, show_default=True, help="Simulated relays.")
+@click.option("--read-latency", default=0.0, show_default=True, help="Simulated GPIO read time (s).")
+@click.option("--write-latency", default=0.0, show_default=True, help="Simulated GPIO write time (s).")
+@click.option("--executor", default='chip', show_default=True,
+              help="GPIO executor of the simulated server (chip, pool, inline).")
+@click.option("--cache", is_flag=True, help="Enable the relay state cache.")
+@click.option("-o", "--output", type=click.File("w"), default="-", help="Write the json report here.")
+def benchmark(url, control, transports, workloads, concurrencies, requests, duration, relays,
+              read_latency, write_latency, executor, cache, output):
+    """
+        Measure throughput and latency of the relay API.
+    """
+    import json
+    from .benchmark import WORKLOADS, run_benchmark
+    from .executor import EXECUTOR_MODES
+
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise click.BadParameter("unknown workload '%s'" % workload, param_hint="--workload")
+    if executor not in EXECUTOR_MODES:
+        raise click.BadParameter("unknown executor '%s'" % executor, param_hint="--executor")
+
+    if control is not None:
+        host, _, port = control.rpartition(':')
+        if not host or not port.isdigit():
+            raise click.BadParameter("must be HOST:PORT", param_hint="--control")
+        control = (host, int(port))
+    if not transports:
+        transports = ['http', 'control'] if url is None or control else ['http']
+
+    simulation = dict()
+    if url is None:
+        simulation = dict(relays=relays, read_latency=read_latency, write_latency=write_latency,
+                          executor=executor, cache=cache)
+    report = run_benchmark(list(workloads or WORKLOADS), list(concurrencies),
+                           requests, duration, url, control, list(transports), **simulation)
+    output.write(json.dumps(report, indent=2) + "\n")
 
 if __name__ == "__main__":
     powerrelay()
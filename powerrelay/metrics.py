@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Prometheus style metrics.
+
+    All metrics are updated from the event loop thread only, so plain
+    integer and float updates are enough; no locking is done.
+"""
+
+from bisect import bisect_left
+
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, plus one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield name + "_bucket", labels + (("le", str(bound)),), total
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, total
+
+class MetricFamily:
+    """
+        A named metric with one child metric per combination of label
+        values.
+    """
+    def __init__(self, name, kind, help, labelnames=(), factory=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labelnames = labelnames
+        self.factory = factory or {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}[kind]
+        self.children = dict()
+        if not labelnames:
+            self.children[()] = self.factory()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def render(self):
+        out = ["# HELP %s %s" % (self.name, self.help),
+               "# TYPE %s %s" % (self.name, self.kind)]
+        for values, child in self.children.items():
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                if labels:
+                    labels = ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+                    out.append("%s{%s} %s" % (name, labels, value))
+                else:
+                    out.append("%s %s" % (name, value))
+        return out
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metrics:
+    """
+        The metrics collected by powerrelay.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self.http_requests = MetricFamily(
+            "powerrelay_http_requests_total", "counter",
+            "HTTP requests handled.", ("route", "method", "status"))
+        self.http_latency = MetricFamily(
+            "powerrelay_http_request_duration_seconds", "histogram",
+            "HTTP request handling time.", ("route", "method"))
+        self.http_in_flight = MetricFamily(
+            "powerrelay_http_requests_in_flight", "gauge",
+            "HTTP requests currently being handled.")
+        self.gpio_latency = MetricFamily(
+            "powerrelay_gpio_duration_seconds", "histogram",
+            "GPIO read and write time per chip, including waiting for the chip.",
+            ("chip", "op"))
+        self.relay_writes = MetricFamily(
+            "powerrelay_relay_writes_total", "counter",
+            "Successful state writes per relay.", ("relay",))
+        self.relay_writes_skipped = MetricFamily(
+            "powerrelay_relay_writes_skipped_total", "counter",
+            "Writes of the state a relay already was in, not sent to the hardware.", ("relay",))
+
+    def families(self):
+        return [self.http_requests, self.http_latency, self.http_in_flight,
+                self.gpio_latency, self.relay_writes, self.relay_writes_skipped]
+
+    def render(self):
+        out = []
+        for family in self.families():
+            out.extend(family.render())
+        return "\n".join(out) + "\n"
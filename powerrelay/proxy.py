@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Upstream powerrelay servers of the aggregating proxy.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    """
+        A request to an upstream failed. 'status' is the HTTP status to
+        answer the proxied request with.
+    """
+    def __init__(self, upstream, status, message):
+        super().__init__("Upstream '%s': %s" % (upstream.name, message))
+        self.status = status
+
+    def response(self):
+        return web.Response(status=self.status, text=str(self) + "\n")
+
+async def read_events(content):
+    """
+        Yield the (event, data) pairs of a Server-Sent Events stream,
+        with the data decoded from json.
+    """
+    event = None
+    data = []
+    async for line in content:
+        line = line.rstrip(b"\r\n")
+        if not line:
+            if event is not None:
+                yield event, json.loads(b"\n".join(data))
+            event = None
+            data = []
+        elif line.startswith(b"event:"):
+            event = line[6:].strip().decode()
+        elif line.startswith(b"data:"):
+            data.append(line[5:].strip())
+
+class Upstream:
+    """
+        A powerrelay server whose relays the proxy serves as its own,
+        with ids prefixed by 'prefix'.
+
+        While following the upstream's event stream, 'live' is set and
+        'states' holds the states of all its relays, so reads need no
+        upstream request. A failed request or lost stream marks the
+        upstream unhealthy until a request to it succeeds again.
+    """
+    # Event stream reconnect delay in seconds, doubled on every failed
+    # attempt up to the maximum
+    RECONNECT_MIN = 0.5
+    RECONNECT_MAX = 30
+
+    # Upstreams send a keep-alive at least this often (seconds)
+    EVENTS_KEEPALIVE = 15
+
+    def __init__(self, name, url, timeout=5.0, prefix=""):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.prefix = prefix
+        # Shared keep-alive session, set by the proxy at startup
+        self.session = None
+        # Upstream relay ids, and their names
+        self.relays = []
+        self.names = dict()
+        self.states = dict()
+        self.live = False
+        # Called when the relays of the upstream changed
+        self.on_relays = None
+
+        self.healthy = None
+        self.failures = 0
+        self.last_error = None
+        self.last_ok = None
+
+    def succeeded(self):
+        if self.healthy is False:
+            logger.warning("Upstream '%s' is back", self.name)
+        self.healthy = True
+        self.failures = 0
+        self.last_ok = time.time()
+
+    def failed(self, error):
+        if self.healthy is not False:
+            logger.error("Upstream '%s' failed: %s", self.name, error)
+        self.healthy = False
+        self.failures += 1
+        self.last_error = error
+
+    def health(self):
+        return {'url': self.url,
+                'healthy': self.healthy,
+                'live': self.live,
+                'relays': len(self.relays),
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'last_ok': self.last_ok}
+
+    async def request(self, method, path, **kwargs):
+        """
+            Send a request to the upstream. Returns the status and body
+            of the response, raising UpstreamError if there is none.
+        """
+        try:
+            async with self.session.request(method, self.url + path, timeout=self.timeout,
+                                            **kwargs) as resp:
+                body = await resp.read()
+        except asyncio.TimeoutError:
+            self.failed("timed out")
+            raise UpstreamError(self, 504, "timed out") from None
+        except aiohttp.ClientError as ex:
+            self.failed(str(ex))
+            raise UpstreamError(self, 502, str(ex)) from None
+        self.succeeded()
+        return resp.status, body
+
+    async def request_json(self, method, path, **kwargs):
+        """
+            Send a request expecting a 200 json response, raising
+            UpstreamError with the upstream's status otherwise.
+        """
+        status, body = await self.request(method, path, **kwargs)
+        if status != 200:
+            raise UpstreamError(self, status, body.decode(errors='replace').strip())
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise UpstreamError(self, 502, "invalid response") from None
+
+    def set_relays(self, relays):
+        if relays != self.relays:
+            self.relays = relays
+            if self.on_relays is not None:
+                self.on_relays()
+
+    async def fetch_relays(self, verify=False):
+        """
+            Fetch the /relays/ listing, updating the known relays.
+        """
+        params = {'compact': '1'}
+        if verify:
+            params['verify'] = '1'
+        entries = await self.request_json('GET', '/relays/', params=params)
+        self.names = {entry['id']: entry['name'] for entry in entries if 'name' in entry}
+        self.set_relays([entry['id'] for entry in entries])
+        if self.live and not verify:
+            self.states.update((entry['id'], entry['state']) for entry in entries)
+        return entries
+
+    async def read_states(self, relays, verify=False):
+        """
+            Return a dict mapping the given upstream relay ids to their
+            states, from the event stream's cache while it is live.
+        """
+        if self.live and not verify and all(relay in self.states for relay in relays):
+            return {relay: self.states[relay] for relay in relays}
+        params = [('relay', relay) for relay in relays] + [('compact', '1')]
+        if verify:
+            params.append(('verify', '1'))
+        return await self.request_json('GET', '/relays/state', params=params)
+
+    def written(self, states):
+        """
+            Note the states of a successful write, so reads from the
+            cache see them before the change event arrives.
+        """
+        if self.live:
+            self.states.update(states)
+
+    async def follow_events(self):
+        """
+            Keep the states up to date from the upstream's event stream,
+            reconnecting with backoff when it is lost.
+        """
+        delay = self.RECONNECT_MIN
+        timeout = aiohttp.ClientTimeout(sock_connect=self.timeout.total,
+                                        sock_read=2 * self.EVENTS_KEEPALIVE + self.timeout.total)
+        while True:
+            try:
+                async with self.session.get(self.url + '/relays/events', timeout=timeout) as resp:
+                    if resp.status != 200:
+                        raise aiohttp.ClientError("event stream status %d" % resp.status)
+                    async for event, data in read_events(resp.content):
+                        if event == 'snapshot':
+                            self.states = {relay: str(state) for relay, state in data.items()}
+                            self.live = True
+                            self.succeeded()
+                            delay = self.RECONNECT_MIN
+                            self.set_relays(list(data))
+                        elif event == 'change':
+                            self.states.update(data)
+                raise aiohttp.ClientError("event stream closed")
+            except asyncio.TimeoutError:
+                self.failed("event stream timed out")
+            except (aiohttp.ClientError, ValueError) as ex:
+                self.failed(str(ex))
+            self.live = False
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self.RECONNECT_MAX)
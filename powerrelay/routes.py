@@ -1,17 +1,78 @@
 import pathlib
-from powerrelay.controllers import RelayController
+from powerrelay.controllers import RelayController, MetricsController, AdminController, ProxyController
+from powerrelay.metrics import Metrics
 
 PROJECT_ROOT = pathlib.Path(__file__).parent
 
 #
 # Global routes setup
 #
-def setup_routes(app, lines):
-    relaycontroller = RelayController(lines)
+def setup_routes(app, lines, metrics=None, reloader=None, **options):
+    if metrics is None:
+        metrics = Metrics()
+    relaycontroller = RelayController(lines, metrics=metrics, **options)
+    metricscontroller = MetricsController(metrics)
+    app.router.add_get('/metrics', metricscontroller.get_metrics, name='metrics')
     app.router.add_get('/relays/', relaycontroller.relays)
     app.router.add_get('/relays/count', relaycontroller.num_relays)
+    app.router.add_get('/relays/state', relaycontroller.get_states, name='get_states')
+    app.router.add_get('/relays/events', relaycontroller.events_stream, name='events')
+    app.router.add_put('/relays/state', relaycontroller.set_states, name='set_states')
     app.router.add_get('/relays/{relay}', relaycontroller.status)
     app.router.add_get('/relays/{relay}/state', relaycontroller.get_state_old, name='get_state_old')
     app.router.add_get('/relays/{relay}/state/', relaycontroller.get_state, name='get_state')
     app.router.add_put('/relays/{relay}/state/{state}', relaycontroller.set_state_old, name='set_state_old')
     app.router.add_put('/relays/{relay}/state/', relaycontroller.set_state, name='set_state')
+    app.router.add_post('/relays/{relay}/cycle', relaycontroller.cycle, name='cycle')
+    app.router.add_get('/relays/{relay}/history', relaycontroller.relay_history, name='relay_history')
+    app.router.add_get('/history', relaycontroller.get_history, name='history')
+    app.router.add_get('/leases/', relaycontroller.list_leases, name='leases')
+    app.router.add_post('/leases/', relaycontroller.acquire_lease, name='acquire_lease')
+    app.router.add_post('/leases/{lease}/renew', relaycontroller.renew_lease, name='renew_lease')
+    app.router.add_delete('/leases/{lease}', relaycontroller.release_lease, name='release_lease')
+    app.router.add_get('/inputs/', relaycontroller.list_inputs, name='inputs')
+    app.router.add_get('/inputs/{input}', relaycontroller.input_status, name='input_status')
+    app.router.add_get('/groups/', relaycontroller.list_groups, name='groups')
+    app.router.add_get('/groups/{group}', relaycontroller.group_status, name='group_status')
+    app.router.add_put('/groups/{group}/state/{state}', relaycontroller.set_group_state_old,
+                       name='set_group_state_old')
+    app.router.add_put('/groups/{group}/state/', relaycontroller.set_group_state, name='set_group_state')
+
+    app.on_startup.append(relaycontroller.startup)
+    app.on_shutdown.append(relaycontroller.shutdown)
+    app.on_cleanup.append(relaycontroller.cleanup)
+
+    if reloader is not None:
+        reloader.controller = relaycontroller
+        admincontroller = AdminController(reloader)
+        app.router.add_post('/admin/reload', admincontroller.reload, name='reload')
+        app.on_startup.append(reloader.startup)
+
+    return relaycontroller
+
+#
+# Aggregating proxy routes setup
+#
+def setup_proxy_routes(app, upstreams, metrics=None, **options):
+    if metrics is None:
+        metrics = Metrics()
+    proxycontroller = ProxyController(upstreams, **options)
+    metricscontroller = MetricsController(metrics)
+    app.router.add_get('/metrics', metricscontroller.get_metrics, name='metrics')
+    app.router.add_get('/upstreams', proxycontroller.get_upstreams, name='upstreams')
+    app.router.add_get('/relays/', proxycontroller.relays)
+    app.router.add_get('/relays/count', proxycontroller.num_relays)
+    app.router.add_get('/relays/state', proxycontroller.get_states, name='get_states')
+    app.router.add_put('/relays/state', proxycontroller.set_states, name='set_states')
+    app.router.add_get('/relays/{relay}', proxycontroller.status)
+    app.router.add_get('/relays/{relay}/state', proxycontroller.get_state_old, name='get_state_old')
+    app.router.add_get('/relays/{relay}/state/', proxycontroller.get_state, name='get_state')
+    app.router.add_put('/relays/{relay}/state/{state}', proxycontroller.set_state_old, name='set_state_old')
+    app.router.add_put('/relays/{relay}/state/', proxycontroller.set_state, name='set_state')
+    app.router.add_post('/relays/{relay}/cycle', proxycontroller.cycle, name='cycle')
+
+    app.on_startup.append(proxycontroller.startup)
+    app.on_shutdown.append(proxycontroller.shutdown)
+    app.on_cleanup.append(proxycontroller.cleanup)
+
+    return proxycontroller
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Staggering of relay on-transitions, to limit inrush current.
+"""
+
+import asyncio
+from collections import OrderedDict
+
+# Result of an on-transition cancelled before it was done
+SUPERSEDED = object()
+
+class SwitchGroup:
+    """
+        Relays sharing a supply, switched on one batch at a time.
+    """
+    def __init__(self):
+        # (request, offset) -> (line, future, origin), in submission order
+        self.pending = OrderedDict()
+        self.next_on = 0
+        self.task = None
+
+class SwitchScheduler:
+    """
+        Queue on-transitions per group and release them at most
+        'max_simultaneous' relays at a time (0: no limit), with at least
+        'spacing' seconds between batches. A relay's group is its
+        'group' if set, else its chip.
+
+        Off-transitions are not scheduled, but cancel a pending
+        on-transition of the same relay. Submitting an on-transition
+        for a relay already queued shares the queued one.
+    """
+    def __init__(self, write, spacing=0, max_simultaneous=0, origin=None):
+        # Coroutine function applying a list of (line, value) updates,
+        # returning a dict of the OSErrors of the failed line requests
+        self.write = write
+        # Optional ContextVar, e.g. the client a write comes from, set
+        # for every write as it was on submission
+        self.origin = origin
+        self.spacing = spacing
+        self.max_simultaneous = max_simultaneous
+        self.groups = dict()
+
+    @staticmethod
+    def group_name(line):
+        return line.group or line.request.chip_name
+
+    def is_pending(self, line):
+        group = self.groups.get(self.group_name(line))
+        return group is not None and (line.request, line.offset) in group.pending
+
+    def submit(self, line):
+        """
+            Queue switching the line on. Returns a future resolved with
+            the OSError the write failed with, None, or SUPERSEDED if it
+            was cancelled.
+        """
+        name = self.group_name(line)
+        group = self.groups.get(name)
+        if group is None:
+            group = self.groups[name] = SwitchGroup()
+        key = (line.request, line.offset)
+        if key in group.pending:
+            return group.pending[key][1]
+
+        future = asyncio.get_event_loop().create_future()
+        origin = self.origin.get() if self.origin is not None else None
+        group.pending[key] = (line, future, origin)
+        if group.task is None:
+            group.task = asyncio.ensure_future(self.run_group(group))
+        return future
+
+    def cancel(self, line):
+        """
+            Drop a pending on-transition of the line, e.g. because it is
+            being switched off.
+        """
+        group = self.groups.get(self.group_name(line))
+        if group is not None:
+            entry = group.pending.pop((line.request, line.offset), None)
+            if entry is not None and not entry[1].done():
+                entry[1].set_result(SUPERSEDED)
+
+    async def run_group(self, group):
+        loop = asyncio.get_event_loop()
+        try:
+            while group.pending:
+                delay = group.next_on - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    if not group.pending:
+                        break
+
+                count = self.max_simultaneous or len(group.pending)
+                batch = [group.pending.popitem(last=False)[1]
+                         for _ in range(min(count, len(group.pending)))]
+                try:
+                    errors = await self.write_batch(batch)
+                except Exception as ex:
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(ex)
+                    raise
+                for line, future, _ in batch:
+                    if not future.done():
+                        future.set_result(errors.get((line.request, line.offset),
+                                                     errors.get(line.request)))
+                group.next_on = loop.time() + self.spacing
+        finally:
+            group.task = None
+
+    async def write_batch(self, batch):
+        if self.origin is None:
+            return await self.write([(line, 1) for line, _, _ in batch])
+        # One write per origin, run concurrently
+        updates = dict()
+        for line, _, origin in batch:
+            updates.setdefault(origin, []).append((line, 1))
+        errors = dict()
+        for result in await asyncio.gather(*[self.write_from(origin, lines)
+                                             for origin, lines in updates.items()]):
+            errors.update(result)
+        return errors
+
+    async def write_from(self, origin, updates):
+        self.origin.set(origin)
+        return await self.write(updates)
+
+    def close(self):
+        for group in self.groups.values():
+            if group.task is not None:
+                group.task.cancel()
+            for _, future, _ in group.pending.values():
+                future.cancel()
+            group.pending.clear()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Configuration file rules.
+"""
+
+import trafaret as t
+
+from .backends import BACKENDS
+from .executor import EXECUTOR_MODES
+from .listen import parse_address
+from .main import BIASES
+
+def listen_address(address):
+    try:
+        parse_address(address)
+    except ValueError as ex:
+        return t.DataError(str(ex))
+    return address
+
+LISTEN_TRAFARET = t.Or(
+    (t.String() & listen_address) & (lambda address: {'address': address}),
+    t.Dict(
+        {
+            t.Key("address"): t.String() & listen_address,
+            # Unix socket permissions, as an octal string
+            t.Key("mode", optional=True): t.Regexp(r'^0?[0-7]{3}$') & (lambda mode: int(mode, 8)),
+            t.Key("group", optional=True): t.String(),
+        }
+    ),
+)
+
+CONFIG_TRAFARET = t.Dict(
+    {
+        t.Key("host"): t.String(),
+        t.Key("port"): t.Int(),
+        # Served instead of host and port when given
+        t.Key("listen", optional=True): t.List(LISTEN_TRAFARET, min_length=1),
+        t.Key("control", optional=True, default={}): t.Dict(
+            {
+                t.Key("host", optional=True): t.String(),
+                t.Key("port", optional=True): t.Int(gte=0),
+            }
+        ),
+        t.Key("gpio", optional=True, default={}): t.Dict(
+            {
+                t.Key("backend", optional=True, default='libgpiod'): t.Enum(*BACKENDS),
+                t.Key("simulator", optional=True, default={}): t.Dict(
+                    {
+                        t.Key("chips", optional=True): t.Mapping(
+                            t.String(),
+                            t.Dict(
+                                {
+                                    t.Key("lines", optional=True, default=64): t.Int(gte=1),
+                                    t.Key("names", optional=True, default={}): t.Mapping(t.Int(gte=0), t.String()),
+                                    # Output offset -> input offset it drives
+                                    t.Key("loopback", optional=True, default={}): t.Mapping(t.Int(gte=0), t.Int(gte=0)),
+                                }
+                            )
+                        ),
+                        t.Key("latency", optional=True, default={}): t.Dict(
+                            {
+                                t.Key("read", optional=True, default=0): t.Float(gte=0),
+                                t.Key("write", optional=True, default=0): t.Float(gte=0),
+                            }
+                        ),
+                    }
+                ),
+                t.Key("executor", optional=True, default='chip'): t.Enum(*EXECUTOR_MODES),
+                t.Key("workers", optional=True, default=4): t.Int(gte=1),
+            }
+        ),
+        t.Key("cache", optional=True, default={}): t.Dict(
+            {
+                t.Key("enabled", optional=True, default=False): t.Bool(),
+                t.Key("reconcile", optional=True, default=0): t.Float(gte=0),
+            }
+        ),
+        t.Key("inrush", optional=True, default={}): t.Dict(
+            {
+                t.Key("spacing", optional=True, default=0): t.Float(gte=0),
+                t.Key("max_simultaneous", optional=True, default=0): t.Int(gte=0),
+            }
+        ),
+        t.Key("history", optional=True, default={}): t.Dict(
+            {
+                t.Key("size", optional=True, default=10000): t.Int(gte=0),
+            }
+        ),
+        t.Key("leases", optional=True, default={}): t.Dict(
+            {
+                t.Key("max_ttl", optional=True, default=3600): t.Float(gt=0),
+            }
+        ),
+        t.Key("state", optional=True, default={}): t.Dict(
+            {
+                t.Key("journal", optional=True): t.String(),
+                t.Key("sync_interval", optional=True, default=1.0): t.Float(gt=0),
+            }
+        ),
+        t.Key("relays"): t.Mapping(
+            t.String(),
+            t.Dict(
+                {
+                    t.Key("chip", optional=True): t.String(),
+                    t.Key("line", optional=True): t.Int(),
+                    t.Key("name", optional=True): t.String(),
+                    t.Key("active", optional=True, default='high'): t.Enum('high', 'low'),
+                    t.Key("default", optional=True, default=0): t.Int(),
+                    t.Key("startup", optional=True, default='restore'): t.Enum('restore', 'default'),
+                    t.Key("inrush_group", optional=True): t.String(),
+                    t.Key("aliases", optional=True, default=[]): t.List(t.String()),
+                    # Input confirming the relay's state, and how long
+                    # to wait for it after a write (0: don't wait)
+                    t.Key("feedback", optional=True): t.String(),
+                    t.Key("confirm", optional=True, default=0): t.Float(gte=0),
+                    # State to switch to when a lease on the relay expires
+                    t.Key("safe", optional=True, default=0): t.Int(gte=0, lte=1),
+                }
+            )
+        ),
+        t.Key("inputs", optional=True, default={}): t.Mapping(
+            t.String(),
+            t.Dict(
+                {
+                    t.Key("chip", optional=True): t.String(),
+                    t.Key("line", optional=True): t.Int(),
+                    t.Key("name", optional=True): t.String(),
+                    t.Key("active", optional=True, default='high'): t.Enum('high', 'low'),
+                    t.Key("bias", optional=True, default='as-is'): t.Enum(*BIASES),
+                    t.Key("debounce", optional=True, default=0): t.Float(gte=0),
+                }
+            )
+        ),
+        t.Key("groups", optional=True, default={}): t.Mapping(
+            t.String(),
+            t.Dict(
+                {
+                    t.Key("relays"): t.List(t.String(), min_length=1),
+                    t.Key("aliases", optional=True, default=[]): t.List(t.String()),
+                }
+            )
+        ),
+    }
+)
+
+PROXY_TRAFARET = t.Dict(
+    {
+        t.Key("host"): t.String(),
+        t.Key("port"): t.Int(),
+        # Follow the upstream event streams to serve reads from a cache
+        t.Key("events", optional=True, default=True): t.Bool(),
+        # Maximum number of connections to all upstreams
+        t.Key("connections", optional=True, default=100): t.Int(gte=1),
+        t.Key("upstreams"): t.Mapping(
+            t.String(),
+            t.Dict(
+                {
+                    t.Key("url"): t.URL,
+                    t.Key("timeout", optional=True, default=5.0): t.Float(gt=0),
+                    t.Key("prefix", optional=True, default=""): t.String(allow_blank=True),
+                }
+            )
+        ),
+    }
+)
@@ -13,10 +13,15 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'Click>=6.0',
-    'aiohttp>=2.3.6',
+    'aiohttp>=3.9',
     'trafaret>=0.12.0',
 ]
 
+extra_requirements = {
+    # Faster encoding of compact json responses
+    'fast': ['orjson'],
+}
+
 setup_requirements = [
     'pytest-runner>=3.0',
 ]
@@ -39,9 +44,10 @@ setup(
             'powerrelay=powerrelay.main:powerrelay'
         ]
     },
-    python_requires='>=3.5.0',
+    python_requires='>=3.8',
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     zip_safe=False,
     keywords='powerrelay',
@@ -50,7 +56,7 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.8',
     ],
     test_suite='tests',
     tests_require=test_requirements,
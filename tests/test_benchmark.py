@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for the `powerrelay` benchmark."""
+
+from powerrelay.benchmark import run_benchmark, summarize
+
+def test_summarize():
+    result = summarize([0.001 * i for i in range(1, 101)], 2, 2.0)
+    assert result['requests'] == 100
+    assert result['errors'] == 2
+    assert result['throughput'] == 50.0
+    assert result['latency_ms']['p50'] == 51.0
+    assert result['latency_ms']['max'] == 100.0
+
+def test_simulated_benchmark():
+    report = run_benchmark(['mixed'], [1, 4], requests=40, relays=4)
+    assert [r['concurrency'] for r in report['results']] == [1, 4]
+    for result in report['results']:
+        assert result['requests'] == 40
+        assert result['errors'] == 0
+
+def test_control_benchmark():
+    report = run_benchmark(['get', 'set'], [2], requests=40, relays=4, transports=['control'])
+    assert [r['transport'] for r in report['results']] == ['control', 'control']
+    for result in report['results']:
+        assert result['requests'] == 40
+        assert result['errors'] == 0
+
+def test_client_benchmark():
+    report = run_benchmark(['mixed'], [4], requests=40, relays=4, transports=['naive', 'client'])
+    assert [r['transport'] for r in report['results']] == ['naive', 'client']
+    for result in report['results']:
+        assert result['requests'] == 40
+        assert result['errors'] == 0
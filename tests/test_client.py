@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for the `powerrelay` client."""
+
+import asyncio
+
+import pytest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from powerrelay import main, routes
+from powerrelay.backends import SimulatorBackend
+from powerrelay.benchmark import ServerProcess, simulated_config
+from powerrelay.client import AsyncRelayClient, RelayClient, RelayClientError, Relay
+
+RELAYS = {
+    '0': {'chip': 'gpiochip0', 'line': 0, 'active': 'high', 'default': 0},
+    '1': {'name': 'FAN', 'active': 'high', 'default': 1},
+    '2': {'chip': 'gpiochip1', 'line': 2, 'active': 'high', 'default': 0},
+}
+
+def test_async_client():
+    backend = SimulatorBackend(chips={'gpiochip0': {'lines': 8, 'names': {1: 'FAN'}},
+                                      'gpiochip1': {'lines': 8}})
+    lines = main.request_relay_lines(RELAYS, backend)
+    main.set_relay_defaults(lines, RELAYS)
+    paths = []
+
+    @web.middleware
+    async def record(request, handler):
+        paths.append((request.method, request.path))
+        return await handler(request)
+
+    async def run():
+        app = web.Application(middlewares=[record])
+        routes.setup_routes(app, lines)
+        async with TestServer(app) as server:
+            async with AsyncRelayClient(str(server.make_url(''))) as client:
+                assert await client.relays() == [Relay('0', 0), Relay('1', 1, 'FAN'), Relay('2', 0)]
+                assert await client.get('FAN') == 1
+
+                # Concurrent calls are sent as one request
+                del paths[:]
+                assert await client.set_many({'0': 1, '2': 1, 'FAN': 1}) == \
+                    {'0': True, '2': True, 'FAN': False}
+                assert await client.get_many(['0', '2']) == {'0': 1, '2': 1}
+                assert paths == [('PUT', '/relays/state'), ('GET', '/relays/state')]
+
+                # A refused batch is redone relay by relay
+                results = await asyncio.gather(client.set('0', 0), client.set('nope', 1),
+                                               return_exceptions=True)
+                assert results[0] is True
+                assert isinstance(results[1], RelayClientError) and results[1].status == 404
+                with pytest.raises(RelayClientError):
+                    await client.set('2', 2)
+    asyncio.run(run())
+
+def test_blocking_client():
+    with ServerProcess(simulated_config(relays=4)) as server:
+        with RelayClient(server.url) as client:
+            assert [relay.id for relay in client.relays()] == ['0', '1', '2', '3']
+            assert client.set('3', 1) is True
+            assert client.get('3') == 1
+            assert client.set_many({'0': 1, '1': 1}) == {'0': True, '1': True}
+            assert client.get_many(['0', '1', '2']) == {'0': 1, '1': 1, '2': 0}
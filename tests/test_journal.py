@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for the `powerrelay` state journal."""
+
+import asyncio
+import os
+
+from powerrelay import main
+from powerrelay.journal import StateJournal
+
+def test_record_and_load(tmp_path):
+    path = str(tmp_path / "state.journal")
+    journal = StateJournal(path)
+    assert journal.load() == {}
+    journal.open({'0': '1', '1': '0'})
+    journal.record({'1': '1'})
+    journal.record({'0': '0', '1': '0'})
+    journal.close()
+    assert StateJournal(path).load() == {'0': '0', '1': '0'}
+
+def test_truncated_record(tmp_path):
+    path = tmp_path / "state.journal"
+    path.write_bytes(b'{"0":"1","1":"1"}\n{"1":"0"}\n{"0":')
+    assert StateJournal(str(path)).load() == {'0': '1', '1': '0'}
+
+def test_invalid_records(tmp_path):
+    path = tmp_path / "state.journal"
+    path.write_bytes(b'{"0":"1","1":"1"}\n[1]\n"0"\n{"1":"0","2":"x"}\n')
+    assert StateJournal(str(path)).load() == {'0': '1', '1': '0', '2': 'x'}
+
+def test_compact(tmp_path):
+    path = str(tmp_path / "state.journal")
+    journal = StateJournal(path, compact_after=2)
+    journal.open({'0': '0'})
+    for state in '1010':
+        journal.record({'0': state})
+
+    async def compact():
+        await journal.compact_journal(asyncio.get_event_loop())
+    asyncio.run(compact())
+    journal.record({'1': '1'})
+    journal.close()
+
+    with open(path) as f:
+        assert f.read() == '{"0":"0"}\n{"1":"1"}\n'
+
+def test_failed_record(tmp_path):
+    path = str(tmp_path / "state.journal")
+    journal = StateJournal(path, compact_after=100)
+    journal.open({'0': '0'})
+    fd = journal.fd
+    journal.fd = os.open(path, os.O_RDONLY)
+    journal.record({'0': '1'})
+    os.close(journal.fd)
+    journal.fd = fd
+
+    # Rewritten with the state it missed at the next sync
+    assert journal.records == journal.compact_after
+    async def compact():
+        await journal.compact_journal(asyncio.get_event_loop())
+    asyncio.run(compact())
+    journal.close()
+    assert StateJournal(path).load() == {'0': '1'}
+
+def test_startup_states():
+    relays = {'0': {'default': 0, 'startup': 'restore'},
+              '1': {'default': 0, 'startup': 'default'},
+              '2': {'default': 1, 'startup': 'restore'}}
+    saved = {'0': '1', '1': '1'}
+    assert main.startup_states(relays, saved) == {'0': 1, '1': 0, '2': 1}
+    # Invalid saved states fall back to the default
+    saved = {'0': 'x', '2': '2'}
+    assert main.startup_states(relays, saved) == {'0': 0, '1': 0, '2': 1}
+
+def test_inrush_states():
+    relays = {'0': {'default': 0, 'startup': 'restore'},
+              '1': {'default': 1, 'startup': 'default'},
+              '2': {'default': 1, 'startup': 'restore'}}
+    saved = {'0': '1', '1': '1'}
+    states = main.startup_states(relays, saved)
+    # Relay 0 was on and stays on, the others are switched on staggered
+    assert main.inrush_states(relays, saved, states) == ({'0': 1, '1': 0, '2': 0}, ['1', '2'])
@@ -3,20 +3,615 @@
 
 """Tests for `powerrelay` package."""
 
+import asyncio
+import os
+import time
+
 import pytest
 
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 from click.testing import CliRunner
 
-from powerrelay import main
+from powerrelay import main, routes
+from powerrelay.app import ConfigReloader, make_app, terminate_exception_body_by_newline, track_origin
+from powerrelay.backends import SimulatorBackend
+
+CHIPS = {
+    'gpiochip0': {'lines': 8, 'names': {3: 'RELAY1'}},
+    'gpiochip1': {'lines': 8, 'names': {0: 'DUP'}},
+    'gpiochip2': {'lines': 8, 'names': {5: 'DUP'}},
+}
+
+RELAYS = {
+    '0': {'chip': 'gpiochip0', 'line': 0, 'active': 'high', 'default': 1},
+    '1': {'name': 'RELAY1', 'active': 'low', 'default': 0},
+    '2': {'chip': 'gpiochip1', 'line': 2, 'active': 'high', 'default': 0},
+}
+
+@pytest.fixture
+def backend():
+    """
+        Simulated GPIO chips.
+    """
+    return SimulatorBackend(chips=CHIPS)
 
 @pytest.fixture
-def response():
+def lines(backend):
+    """
+        Relay lines requested from the simulator, set to their defaults.
     """
-        Sample pytest fixture.
+    lines = main.request_relay_lines(RELAYS, backend)
+    main.set_relay_defaults(lines, RELAYS)
+    return lines
+
+def with_client(lines, test, **options):
+    """
+        Run the coroutine function test with a client for an
+        application serving the given lines.
     """
+    async def run():
+        app = web.Application(middlewares=[terminate_exception_body_by_newline])
+        routes.setup_routes(app, lines, **options)
+        async with TestClient(TestServer(app)) as client:
+            await test(client)
+    asyncio.run(run())
 
 def test_command_line_interface():
     """Test the CLI."""
     runner = CliRunner()
-    result = runner.invoke(main.main)
+    result = runner.invoke(main.powerrelay)
     assert result.exit_code == 2
+
+def test_invalid_relay(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("""
+host: 127.0.0.1
+port: 0
+gpio:
+  backend: simulator
+relays:
+  "0": {chip: gpiochip0, line: 0, name: RELAY0}
+""")
+    result = CliRunner().invoke(main.powerrelay, ['run', '--no-config-cache', str(config_file)])
+    assert result.exit_code == 1
+    assert "cannot specify both" in result.output
+
+def test_one_request_per_chip(backend, lines):
+    assert lines['0'].request is lines['1'].request
+    assert lines['0'].request is not lines['2'].request
+    assert lines['1'].offset == 3
+
+def test_defaults_and_active_low(backend, lines):
+    levels = backend.chips['gpiochip0'].levels
+    assert levels[0] == 1
+    # Relay 1 is active low, so its inactive default is a high level
+    assert levels[3] == 1
+
+def test_requested_at_startup_state(backend):
+    # Lines start in their state as soon as they are requested
+    main.RelayLineManager(backend).update(RELAYS, {'2': 1})
+    assert backend.chips['gpiochip0'].levels[0] == 1
+    assert backend.chips['gpiochip0'].levels[3] == 1
+    assert backend.chips['gpiochip1'].levels[2] == 1
+
+def test_same_line_twice_is_busy(backend):
+    relays = {'a': {'chip': 'gpiochip0', 'line': 3, 'active': 'high'},
+              'b': {'name': 'RELAY1', 'active': 'high'}}
+    with pytest.raises(OSError, match="already used by relay a"):
+        main.request_relay_lines(relays, backend)
+
+def test_ambiguous_name(backend):
+    with pytest.raises(main.GpioLookupError, match="Ambiguous"):
+        main.resolve_relays({'a': {'name': 'DUP'}}, backend)
+    with pytest.raises(main.GpioLookupError, match="No such GPIO"):
+        main.resolve_relays({'a': {'name': 'NOPE'}}, backend)
+
+def test_get_and_set_state(lines):
+    async def test(client):
+        resp = await client.get('/relays/RELAY1/state/')
+        assert await resp.json() == "0"
+        resp = await client.put('/relays/RELAY1/state/', data="1")
+        assert resp.status == 200
+        resp = await client.get('/relays/1')
+        assert await resp.json() == {"relay_id": "1", "status": "1"}
+        resp = await client.put('/relays/1/state/2')
+        assert resp.status == 400
+        assert (await resp.text()).endswith("\n")
+        for value in (1.7, True, [1], None):
+            resp = await client.put('/relays/state', json={'1': value})
+            assert resp.status == 400
+    with_client(lines, test)
+
+def test_relays_listing(lines):
+    async def test(client):
+        resp = await client.get('/relays/')
+        assert await resp.json() == [
+            {'id': '0', 'state': '1'},
+            {'id': '1', 'state': '0', 'name': 'RELAY1'},
+            {'id': '2', 'state': '0'},
+        ]
+        resp = await client.get('/relays/count?compact=1')
+        assert await resp.text() == '{"count":3}'
+    with_client(lines, test)
+
+def test_batch_state(lines):
+    async def test(client):
+        resp = await client.put('/relays/state', json={'0': 0, 'RELAY1': 1, '2': 1})
+        assert await resp.json() == {'0': {'status': 'ok', 'changed': True},
+                                     'RELAY1': {'status': 'ok', 'changed': True},
+                                     '2': {'status': 'ok', 'changed': True}}
+        resp = await client.get('/relays/state?relay=0&relay=RELAY1')
+        assert await resp.json() == {'0': '0', 'RELAY1': '1'}
+        resp = await client.put('/relays/state', json={'1': 0, 'RELAY1': 1})
+        assert resp.status == 400
+    with_client(lines, test)
+
+def test_cycle(lines):
+    async def test(client):
+        resp = await client.post('/relays/0/cycle?off_ms=100')
+        assert resp.status == 200
+        resp = await client.post('/relays/0/cycle?off_ms=100')
+        assert resp.status == 409
+        resp = await client.get('/relays/0/state/')
+        assert await resp.json() == "0"
+        resp = await client.post('/relays/2/cycle?off_ms=10&wait=1')
+        assert resp.status == 200
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "1"
+
+        # Concurrent cycles: the second one is rejected
+        results = await asyncio.gather(client.post('/relays/2/cycle?off_ms=50&wait=1'),
+                                       client.post('/relays/2/cycle?off_ms=50&wait=1'))
+        assert sorted(resp.status for resp in results) == [200, 409]
+
+        # A write cancels a pending cycle
+        resp = await client.post('/relays/2/cycle?off_ms=50')
+        resp = await client.put('/relays/2/state/0')
+        assert resp.status == 200
+        await asyncio.sleep(0.1)
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "0"
+    with_client(lines, test)
+
+def test_cycle_shutdown(backend, lines):
+    async def run():
+        app = web.Application()
+        routes.setup_routes(app, lines)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post('/relays/0/cycle?off_ms=50')
+            assert resp.status == 200
+        # Shutting down cancels the switch back on
+        await asyncio.sleep(0.1)
+        assert backend.chips['gpiochip0'].levels[0] == 0
+    asyncio.run(run())
+
+def test_events(lines):
+    async def test(client):
+        resp = await client.get('/relays/events')
+        event = await resp.content.readuntil(b"\n\n")
+        assert event == b'event: snapshot\ndata: {"0":"1","1":"0","2":"0"}\n\n'
+        await client.put('/relays/2/state/1')
+        event = await resp.content.readuntil(b"\n\n")
+        assert event == b'event: change\ndata: {"2":"1"}\n\n'
+        resp.close()
+    with_client(lines, test)
+
+def test_cache_verify(backend, lines):
+    async def test(client):
+        # Change the line behind the cache's back
+        backend.chips['gpiochip1'].levels[2] = 1
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "0"
+        resp = await client.get('/relays/2/state/?verify=1')
+        assert await resp.json() == "1"
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "1"
+    with_client(lines, test, cache=True)
+
+def test_cache_verify_during_write(backend, lines):
+    # The read of relay 0's chip is slow, relay 2's chip answers at once
+    request = lines['0'].request
+    get_values = request.get_values
+    def slow_get_values(*args):
+        values = get_values(*args)
+        time.sleep(0.2)
+        return values
+    request.get_values = slow_get_values
+
+    async def test(client):
+        # Relay 2 is switched while the verify read is pending
+        verify = asyncio.ensure_future(client.get('/relays/state?verify=1'))
+        await asyncio.sleep(0.05)
+        resp = await client.put('/relays/2/state/', data='1')
+        assert resp.status == 200
+        resp = await verify
+        assert resp.status == 200
+        assert (await resp.json())['2'] == "1"
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "1"
+    with_client(lines, test, cache=True, executor='chip')
+
+def test_reload(backend, tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("""
+host: 127.0.0.1
+port: 0
+gpio:
+  backend: simulator
+relays:
+  "0": {chip: gpiochip0, line: 0, default: 1}
+  "1": {chip: gpiochip0, line: 1}
+  "2": {chip: gpiochip1, line: 0}
+""")
+    config = main.read_config(str(config_file))
+    manager = main.RelayLineManager(backend)
+    lines, _ = manager.update(config['relays'])
+    main.set_relay_defaults(lines, config['relays'])
+    reloader = ConfigReloader(str(config_file), config, manager)
+    chip0 = backend.chips['gpiochip0']
+
+    async def run():
+        app = make_app(config, lines, reloader)
+        async with TestClient(TestServer(app)) as client:
+            await client.put('/relays/1/state/1')
+            config_file.write_text("""
+host: 127.0.0.1
+port: 0
+gpio:
+  backend: simulator
+relays:
+  "0": {chip: gpiochip0, line: 0, active: low, default: 0}
+  "1": {chip: gpiochip0, line: 1}
+  "3": {chip: gpiochip0, line: 2, default: 1}
+""")
+            resp = await client.post('/admin/reload')
+            assert await resp.json() == {'added': ['3'], 'changed': ['0'], 'removed': ['2']}
+            resp = await client.get('/relays/state')
+            assert await resp.json() == {'0': '0', '1': '1', '3': '1'}
+    asyncio.run(run())
+
+    # Relay 1 was left alone, relay 0 is now active low, and relay 3
+    # was added to the chip's request
+    assert chip0.levels[:3] == [1, 1, 1]
+    assert manager.lines['3'].request is manager.lines['1'].request
+    assert not backend.chips['gpiochip1'].requested
+
+def test_inrush_staggering(backend, lines):
+    async def test(client):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        resp = await client.put('/relays/state', json={'0': 0})
+        resp = await client.put('/relays/state', json={'0': 1, 'RELAY1': 1})
+        assert await resp.json() == {'0': {'status': 'ok', 'changed': True},
+                                     'RELAY1': {'status': 'ok', 'changed': True}}
+        assert loop.time() - start >= 0.1
+
+        # An off-transition cancels a queued on-transition
+        await client.put('/relays/state', json={'0': 0, 'RELAY1': 0})
+        resp = await client.put('/relays/0/state/1?wait=0')
+        resp = await client.put('/relays/RELAY1/state/1?wait=0')
+        assert resp.status == 202
+        assert await resp.json() == {'status': 'queued'}
+        waiting = asyncio.ensure_future(client.put('/relays/state', json={'RELAY1': 1}))
+        await asyncio.sleep(0.01)
+        await client.put('/relays/RELAY1/state/0')
+        resp = await waiting
+        assert await resp.json() == {'RELAY1': {'status': 'superseded'}}
+        await asyncio.sleep(0.2)
+        resp = await client.get('/relays/state?relay=0&relay=RELAY1')
+        assert await resp.json() == {'0': '1', 'RELAY1': '0'}
+    with_client(lines, test, cache=True, inrush_spacing=0.1, inrush_max=1)
+
+def test_groups(backend):
+    relays = dict(RELAYS, **{'3': {'chip': 'gpiochip1', 'line': 4, 'active': 'high',
+                                     'default': 0, 'aliases': ['fan']}})
+    groups = {'dut': {'relays': ['0', 'RELAY1', 'fan'], 'aliases': ['DUT-7 power']}}
+    assert main.validate_groups(groups, relays) == (True, None)
+    assert not main.validate_groups({'fan': {'relays': ['0']}}, relays)[0]
+    assert not main.validate_groups({'g': {'relays': ['nope']}}, relays)[0]
+
+    lines = main.request_relay_lines(relays, backend)
+    main.set_relay_defaults(lines, relays)
+    async def test(client):
+        resp = await client.get('/groups/dut')
+        assert await resp.json() == {'group_id': 'dut', 'status': 'mixed',
+                                     'relays': {'0': '1', '1': '0', '3': '0'}}
+        resp = await client.put('/groups/DUT-7 power/state/', data="1")
+        assert await resp.json() == {'0': {'status': 'ok', 'changed': False},
+                                     '1': {'status': 'ok', 'changed': True},
+                                     '3': {'status': 'ok', 'changed': True}}
+        resp = await client.get('/relays/fan/state/')
+        assert await resp.json() == "1"
+        resp = await client.put('/relays/state', json={'dut': 0, '2': 1})
+        assert await resp.json() == {'dut': {'status': 'ok', 'changed': True},
+                                     '2': {'status': 'ok', 'changed': True}}
+        resp = await client.get('/relays/state')
+        assert await resp.json() == {'0': '0', '1': '0', '2': '1', '3': '0'}
+        resp = await client.get('/relays/dut')
+        assert resp.status == 404
+    with_client(lines, test, groups=groups)
+
+def test_control_protocol(lines):
+    from powerrelay.control import ControlServer
+
+    async def run():
+        app = web.Application()
+        controller = routes.setup_routes(app, lines)
+        server = ControlServer(controller, '127.0.0.1', 0)
+        app.on_startup.append(server.startup)
+        app.on_shutdown.append(server.shutdown)
+        async with TestClient(TestServer(app)):
+            reader, writer = await asyncio.open_connection(*server.address)
+            # Pipelined requests are answered in order
+            writer.write(b"GET RELAY1\n@7 SET 1 1\nGET 1\nSET 1 2\nGET nope\nSTATE\nFOO\n")
+            responses = [await reader.readline() for _ in range(7)]
+            assert responses == [b"OK 0\n", b"@7 OK\n", b"OK 1\n",
+                                 b"ERR Invalid state, must be 0 or 1\n",
+                                 b"ERR Relay 'nope' not found\n",
+                                 b"OK 0=1 1=1 2=0\n",
+                                 b"ERR Unknown command 'FOO'\n"]
+            writer.close()
+    asyncio.run(run())
+
+def test_listen_sockets(tmp_path):
+    from powerrelay.listen import parse_address, listen_sockets
+
+    assert parse_address('[::1]:80') == ('tcp', ('::1', 80))
+    assert parse_address('unix:/run/a.sock') == ('unix', '/run/a.sock')
+    with pytest.raises(ValueError):
+        parse_address('localhost')
+
+    path = str(tmp_path / "powerrelay.sock")
+    listen = [{'address': '127.0.0.1:0'}, {'address': 'unix:' + path, 'mode': 0o660}]
+    sockets, paths = listen_sockets(listen)
+    assert paths == [path]
+    assert oct(os.stat(path).st_mode & 0o777) == oct(0o660)
+    # A socket still being listened on is not taken over
+    sockets[1].listen()
+    with pytest.raises(OSError, match="in use"):
+        listen_sockets(listen[1:])
+    for sock in sockets:
+        sock.close()
+    # A stale one is
+    sockets, paths = listen_sockets(listen[1:])
+    sockets[0].close()
+
+def test_feedback_inputs():
+    backend = SimulatorBackend(chips={'gpiochip0': {'lines': 8, 'loopback': {0: 4}}})
+    relays = {'0': {'chip': 'gpiochip0', 'line': 0, 'active': 'high', 'default': 0,
+                    'feedback': 'fb0', 'confirm': 0.5},
+              '1': {'chip': 'gpiochip0', 'line': 1, 'active': 'high', 'default': 0,
+                    'feedback': 'fb1', 'confirm': 0.05}}
+    inputs = {'fb0': {'chip': 'gpiochip0', 'line': 4, 'active': 'high', 'bias': 'as-is',
+                      'debounce': 0.02},
+              'fb1': {'chip': 'gpiochip0', 'line': 5, 'active': 'high', 'bias': 'as-is',
+                      'debounce': 0}}
+    assert main.validate_inputs(inputs, relays) == (True, None)
+    assert not main.validate_inputs({}, relays)[0]
+    lines = main.request_relay_lines(relays, backend)
+    main.set_relay_defaults(lines, relays)
+    input_lines = main.request_input_lines(inputs, backend)
+
+    async def test(client):
+        resp = await client.get('/relays/0')
+        assert await resp.json() == {'relay_id': '0', 'status': '0', 'feedback': '0'}
+        # Confirmed by the looped back input, once debounced
+        resp = await client.put('/relays/0/state/1')
+        assert resp.status == 200
+        resp = await client.get('/relays/?compact=1')
+        assert (await resp.json())[0] == {'id': '0', 'state': '1', 'feedback': '1'}
+
+        # A bounce shorter than the debounce time is not seen
+        resp = await client.get('/relays/0')
+        generation = resp.headers['X-Generation']
+        backend.drive('gpiochip0', 4, 0)
+        await asyncio.sleep(0.005)
+        resp = await client.get('/inputs/fb0')
+        assert await resp.json() == {'input_id': 'fb0', 'state': '1'}
+        backend.drive('gpiochip0', 4, 1)
+        await asyncio.sleep(0.05)
+        resp = await client.get('/inputs/fb0')
+        assert await resp.json() == {'input_id': 'fb0', 'state': '1'}
+        resp = await client.get('/relays/0')
+        assert resp.headers['X-Generation'] == generation
+
+        # Relay 1 has no feedback wired up, so confirming fails
+        resp = await client.put('/relays/state', json={'1': 1})
+        result = await resp.json()
+        assert result['1']['status'] == 'error'
+        assert 'did not confirm' in result['1']['error']
+        resp = await client.put('/relays/1/state/1?force=1')
+        assert resp.status == 504
+        assert 'did not confirm' in await resp.text()
+    with_client(lines, test, inputs=input_lines)
+
+def test_write_coalescing():
+    backend = SimulatorBackend(chips=CHIPS, latency={'write': 0.05})
+    lines = main.request_relay_lines(RELAYS, backend)
+    main.set_relay_defaults(lines, RELAYS)
+
+    async def run():
+        app = web.Application()
+        controller = routes.setup_routes(app, lines, cache=True)
+        writes = controller.metrics.relay_writes.labels('2')
+        async with TestClient(TestServer(app)) as client:
+            # Writes queued behind the first one are coalesced to the last
+            results = await asyncio.gather(*[client.put('/relays/2/state/%d' % state)
+                                             for state in (1, 0, 1, 0)])
+            assert all(resp.status == 200 for resp in results)
+            assert writes.value == 2
+            resp = await client.get('/relays/2/state/?verify=1')
+            assert await resp.json() == "0"
+
+            resp = await client.put('/relays/2/state/0')
+            assert await resp.json() == {'status': 'ok', 'changed': False}
+            resp = await client.put('/relays/2/state/0?force=1')
+            assert await resp.json() == {'status': 'ok', 'changed': True}
+            assert writes.value == 3
+
+            # A hold waits for the write in flight, and holds later ones
+            order = []
+            async def held():
+                order.append(backend.chips['gpiochip1'].levels[2])
+                await asyncio.sleep(0.1)
+                order.append(backend.chips['gpiochip1'].levels[2])
+            key = (lines['2'].request, lines['2'].offset)
+            first = asyncio.ensure_future(client.put('/relays/2/state/1'))
+            await asyncio.sleep(0.03)
+            hold = asyncio.ensure_future(controller.write_queue.hold([key], held))
+            await asyncio.sleep(0.04)
+            second = asyncio.ensure_future(client.put('/relays/2/state/0'))
+            await asyncio.gather(first, hold, second)
+            assert order == [1, 1]
+            assert backend.chips['gpiochip1'].levels[2] == 0
+    asyncio.run(run())
+
+def test_leases(lines):
+    async def test(client):
+        resp = await client.post('/leases/', json={'relays': ['0', 'RELAY1'], 'ttl': 0.2,
+                                                   'holder': "ci"})
+        assert resp.status == 200
+        lease = (await resp.json())['lease']
+        resp = await client.post('/leases/', json={'relays': ['1'], 'ttl': 1})
+        assert resp.status == 409
+        resp = await client.post('/leases/', json={'relays': ['2'], 'ttl': 0})
+        assert resp.status == 400
+
+        # Only the holder may switch leased relays
+        resp = await client.put('/relays/0/state/1')
+        assert resp.status == 409
+        resp = await client.put('/relays/0/state/1', headers={'X-Lease': lease})
+        assert resp.status == 200
+        resp = await client.put('/relays/2/state/1')
+        assert resp.status == 200
+
+        await asyncio.sleep(0.15)
+        resp = await client.post('/leases/%s/renew' % lease)
+        assert resp.status == 200
+        await asyncio.sleep(0.15)
+        resp = await client.get('/leases/')
+        assert [entry['holder'] for entry in await resp.json()] == ["ci"]
+
+        # Expired: back to the safe state, and free for others
+        await asyncio.sleep(0.15)
+        resp = await client.get('/relays/0/state/')
+        assert await resp.json() == "0"
+        resp = await client.put('/relays/0/state/1')
+        assert resp.status == 200
+        resp = await client.post('/leases/%s/renew' % lease)
+        assert resp.status == 404
+    with_client(lines, test)
+
+def test_lease_end_cancels_cycle(lines):
+    async def test(client):
+        resp = await client.post('/leases/', json={'relays': ['2'], 'ttl': 10})
+        lease = (await resp.json())['lease']
+        resp = await client.put('/relays/2/state/1', headers={'X-Lease': lease})
+        assert resp.status == 200
+        cycle = asyncio.ensure_future(client.post('/relays/2/cycle?off_ms=200&wait=1',
+                                                  headers={'X-Lease': lease}))
+        await asyncio.sleep(0.05)
+
+        # The relay stays in its safe state
+        resp = await client.delete('/leases/%s?safe=1' % lease)
+        assert resp.status == 200
+        resp = await cycle
+        assert resp.status == 409
+        await asyncio.sleep(0.25)
+        resp = await client.get('/relays/2/state/')
+        assert await resp.json() == "0"
+    with_client(lines, test)
+
+def test_history(lines):
+    async def run():
+        app = web.Application(middlewares=[track_origin])
+        routes.setup_routes(app, lines, history_size=3)
+        async with TestClient(TestServer(app)) as client:
+            start = time.time()
+            for state in (1, 1, 0, 1):
+                await client.put('/relays/2/state/%d' % state)
+            await client.put('/relays/state', json={'RELAY1': 1})
+
+            # Only the last 3 changes are kept, no-op writes are not changes
+            resp = await client.get('/history')
+            entries = await resp.json()
+            assert [(e['relay'], e['old'], e['new']) for e in entries] == \
+                [('2', '1', '0'), ('2', '0', '1'), ('1', None, '1')]
+            assert entries[-1]['route'] == "PUT /relays/state"
+            assert entries[-1]['client'] == "127.0.0.1"
+            assert entries[0]['time'] >= start
+
+            resp = await client.get('/relays/2/history?limit=1')
+            assert [e['new'] for e in await resp.json()] == ['1']
+            resp = await client.get('/relays/2/history?limit=0')
+            assert await resp.json() == []
+            resp = await client.get('/history?limit=-1')
+            assert resp.status == 400
+            resp = await client.get('/history?relay=RELAY1&until=%f' % start)
+            assert await resp.json() == []
+            resp = await client.get('/history?since=soon')
+            assert resp.status == 400
+    asyncio.run(run())
+
+def test_conditional_get(lines):
+    async def test(client):
+        resp = await client.get('/relays/')
+        etag = resp.headers['ETag']
+        resp = await client.get('/relays/', headers={'If-None-Match': etag})
+        assert resp.status == 304
+        resp = await client.get('/relays/2', headers={'If-None-Match': '*'})
+        assert resp.status == 304
+
+        resp = await client.get('/relays/2/state/')
+        relay_etag = resp.headers['ETag']
+        generation = int(resp.headers['X-Generation'])
+        await client.put('/relays/0/state/0')
+        # Other relays changing don't touch a relay's generation
+        resp = await client.get('/relays/2/state/', headers={'If-None-Match': relay_etag})
+        assert resp.status == 304
+        resp = await client.get('/relays/', headers={'If-None-Match': etag})
+        assert resp.status == 200
+
+        # Long-poll: answered once the relay changes, or on timeout
+        async def switch():
+            await asyncio.sleep(0.05)
+            await client.put('/relays/2/state/1')
+        poll = client.get('/relays/2/state/?since=%d' % generation)
+        resp, _ = await asyncio.gather(poll, switch())
+        assert await resp.json() == "1"
+        assert int(resp.headers['X-Generation']) > generation
+        resp = await client.get('/relays/2/state/?since=%s&timeout=0.05' % resp.headers['X-Generation'],
+                                headers={'If-None-Match': resp.headers['ETag']})
+        assert resp.status == 304
+        resp = await client.get('/relays/?since=now')
+        assert resp.status == 400
+    with_client(lines, test)
+
+def test_config_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('POWERRELAY_CACHE_DIR', str(tmp_path / "cache"))
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("""
+host: 127.0.0.1
+port: 0
+gpio:
+  backend: simulator
+  simulator:
+    chips:
+      gpiochip0: {names: {3: RELAY1}}
+relays:
+  "0": {chip: gpiochip0, line: 0, default: 1}
+""")
+    config, cached = main.load_config(str(config_file))
+    assert not cached
+    assert main.load_config(str(config_file)) == (config, True)
+    assert config['gpio']['simulator']['chips']['gpiochip0']['names'] == {3: 'RELAY1'}
+
+    # A changed file is validated again
+    config_file.write_text(config_file.read_text().replace("default: 1", "default: 0"))
+    config, cached = main.load_config(str(config_file))
+    assert not cached and config['relays']['0']['default'] == 0
+
+    config_file.write_text(config_file.read_text().replace("port: 0", "port: zero"))
+    with pytest.raises(main.ConfigError):
+        main.load_config(str(config_file))
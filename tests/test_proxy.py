@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Tests for the aggregating proxy."""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from powerrelay import main, routes
+from powerrelay.app import make_proxy_app, terminate_exception_body_by_newline
+from powerrelay.schema import PROXY_TRAFARET
+from powerrelay.backends import SimulatorBackend
+
+RELAYS = {
+    '0': {'chip': 'gpiochip0', 'line': 0, 'active': 'high', 'default': 1},
+    '1': {'chip': 'gpiochip0', 'line': 1, 'active': 'high', 'default': 0},
+}
+
+async def start_upstream():
+    """
+        A powerrelay server on a loopback port, on a simulator.
+    """
+    lines = main.request_relay_lines(RELAYS, SimulatorBackend())
+    main.set_relay_defaults(lines, RELAYS)
+    app = web.Application(middlewares=[terminate_exception_body_by_newline])
+    routes.setup_routes(app, lines, cache=True)
+    server = TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    return server
+
+def proxy_config(servers, **options):
+    config = {'host': '127.0.0.1', 'port': 0,
+              'upstreams': {name: {'url': str(server.make_url('')), 'prefix': name + '-'}
+                            for name, server in servers.items()}}
+    config.update(options)
+    return PROXY_TRAFARET.check(config)
+
+async def wait_live(client, count):
+    for _ in range(100):
+        resp = await client.get('/upstreams')
+        if sum(upstream['live'] for upstream in (await resp.json()).values()) == count:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("upstreams not live")
+
+def test_proxy():
+    async def run():
+        servers = {'a': await start_upstream(), 'b': await start_upstream()}
+        app = make_proxy_app(proxy_config(servers))
+        async with TestClient(TestServer(app)) as client:
+            await wait_live(client, 2)
+            resp = await client.get('/relays/')
+            assert await resp.json() == [
+                {'id': 'a-0', 'state': '1', 'upstream': 'a'},
+                {'id': 'a-1', 'state': '0', 'upstream': 'a'},
+                {'id': 'b-0', 'state': '1', 'upstream': 'b'},
+                {'id': 'b-1', 'state': '0', 'upstream': 'b'},
+            ]
+            resp = await client.put('/relays/b-1/state/', data="1")
+            assert resp.status == 200
+            resp = await client.get('/relays/b-1')
+            assert await resp.json() == {'relay_id': 'b-1', 'status': '1'}
+            resp = await client.put('/relays/state', json={'a-0': 0, 'b-0': 0})
+            assert await resp.json() == {'a-0': {'status': 'ok', 'changed': True},
+                                         'b-0': {'status': 'ok', 'changed': True}}
+            resp = await client.get('/relays/state?relay=a-0&relay=b-0&verify=1')
+            assert await resp.json() == {'a-0': '0', 'b-0': '0'}
+            resp = await client.put('/relays/a-0/state/2')
+            assert resp.status == 400
+            resp = await client.get('/relays/c-0')
+            assert resp.status == 404
+
+            # Writes pass the lease token on
+            async with aiohttp.ClientSession() as session:
+                async with session.post(servers['b'].make_url('/leases/'),
+                                        json={'relays': ['1'], 'ttl': 10}) as resp:
+                    lease = (await resp.json())['lease']
+            resp = await client.put('/relays/b-1/state/', data="0")
+            assert resp.status == 409
+            # Refused by its upstream, the other relays are still switched
+            resp = await client.put('/relays/state', json={'a-1': 1, 'b-1': 0})
+            result = await resp.json()
+            assert result['a-1'] == {'status': 'ok', 'changed': True}
+            assert result['b-1']['status'] == 'error' and "leased" in result['b-1']['error']
+            resp = await client.put('/relays/state', json={'a-1': 0, 'b-1': 2})
+            assert resp.status == 400
+            resp = await client.get('/relays/state?relay=a-1')
+            assert await resp.json() == {'a-1': '1'}
+            resp = await client.put('/relays/b-1/state/', data="0", headers={'X-Lease': lease})
+            assert resp.status == 200
+            resp = await client.put('/relays/state', json={'b-1': 1}, headers={'X-Lease': lease})
+            assert await resp.json() == {'b-1': {'status': 'ok', 'changed': True}}
+            async with aiohttp.ClientSession() as session:
+                await session.delete(servers['b'].make_url('/leases/' + lease))
+
+            # A lost upstream is reported, the others keep working
+            await servers['a'].close()
+            resp = await client.put('/relays/state', json={'a-1': 1, 'b-1': 0})
+            result = await resp.json()
+            assert result['a-1']['status'] == 'error'
+            assert result['b-1'] == {'status': 'ok', 'changed': True}
+            resp = await client.get('/upstreams')
+            health = await resp.json()
+            assert health['a']['healthy'] is False
+            assert health['b']['healthy'] is True
+        await servers['b'].close()
+    asyncio.run(run())